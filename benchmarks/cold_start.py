@@ -0,0 +1,112 @@
+"""Benchmark the app's start-up and the cost of building YoutubeDL instances
+
+    python -m benchmarks.cold_start --runs 5 --extractions 20
+
+Measures, each in a fresh interpreter, how long importing the download
+modules the app imports takes and whether that loads yt-dlp, and how long
+the first info extraction of a process takes, straight after the imports
+and after warm_up() had --think seconds (the user pasting a URL). Then extracts a DASH
+manifest from a local server over and over, once building a new YoutubeDL
+for every extraction (as before the pool) and once borrowing one from
+youtubedl.ydl_pool. Prints medians (or JSON with --json). Needs FFmpeg for
+the test media.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from . import media
+from .http_server import MediaServer
+
+IMPORT_SCRIPT = '''
+import sys, time
+started = time.perf_counter()
+import youtube_downloader.download, youtube_downloader.batch, youtube_downloader.prefetch
+print(time.perf_counter() - started, 'yt_dlp' in sys.modules)
+'''
+
+FIRST_EXTRACTION_SCRIPT = '''
+import sys, time
+from youtube_downloader.info_cache import extract_info, warm_up
+from youtube_downloader.ratelimit import INTERACTIVE
+if sys.argv[2] == 'warm':
+    warm_up()
+    time.sleep(float(sys.argv[3]))
+started = time.perf_counter()
+extract_info(sys.argv[1], {'request_priority': INTERACTIVE})
+print(time.perf_counter() - started)
+'''
+
+
+def run_fresh(script, *args):
+    """Run a script in a new interpreter and return its output fields"""
+    output = subprocess.run([sys.executable, '-c', script, *args], capture_output=True, text=True, check=True,
+                            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).stdout
+    return output.split()
+
+
+def extraction_seconds(url, extractions, pooled):
+    """Return the median seconds of extracting url with a new or a pooled YoutubeDL"""
+    from youtube_downloader.youtubedl import ScheduledYoutubeDL, ydl_pool
+
+    opts = {'quiet': True, 'no_warnings': True}
+    timings = []
+    for n in range(extractions):
+        started = time.perf_counter()
+        if pooled:
+            with ydl_pool.get(opts) as ydl:
+                ydl.extract_info(f'{url}?n={n}', download=False)
+        else:
+            with ScheduledYoutubeDL(opts) as ydl:
+                ydl.extract_info(f'{url}?n={n}', download=False)
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n', 1)[0])
+    parser.add_argument('--runs', type=int, default=5, help='fresh interpreters per start-up measurement')
+    parser.add_argument('--extractions', type=int, default=20, help='extractions per YoutubeDL mode')
+    parser.add_argument('--think', type=float, default=2, help='seconds between warm_up() and the first extraction')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds of latency per request')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as root:
+        # Scratch settings for this process and the interpreters it starts
+        os.environ.update({'YTDL_DATA_DIR': os.path.join(root, 'data'), 'YTDL_METRICS_PORT': '0'})
+        library = os.path.join(root, 'media')
+        os.makedirs(library)
+        media.generate(library, duration=4, large_mb=1)
+
+        imports = [run_fresh(IMPORT_SCRIPT) for _ in range(args.runs)]
+        with MediaServer(library, latency=args.latency) as server:
+            url = server.url('dash.mpd')
+            first = {
+                mode: [float(run_fresh(FIRST_EXTRACTION_SCRIPT, f'{url}?{mode}={run}', mode, str(args.think))[0])
+                       for run in range(args.runs)]
+                for mode in ('cold', 'warm')
+            }
+            results = {
+                'import_seconds': round(statistics.median(float(seconds) for seconds, _ in imports), 3),
+                'import_loads_yt_dlp': any(loaded == 'True' for _, loaded in imports),
+                'first_extraction_seconds': round(statistics.median(first['cold']), 3),
+                'first_extraction_after_warm_up_seconds': round(statistics.median(first['warm']), 3),
+                'new_instance_extraction_seconds': round(extraction_seconds(url, args.extractions, False), 4),
+                'pooled_extraction_seconds': round(extraction_seconds(url, args.extractions, True), 4),
+            }
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for name, value in results.items():
+        print(f"{name:>38}: {value}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""Local HTTP server standing in for a video host in tests and benchmarks
+
+Serves files from a directory with single byte-range support. Each
+connection is throttled and every request waits a fixed latency, which
+imitates a high-latency link where one TCP stream can't fill the pipe.
+"""
+import os
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CHUNK_SIZE = 64 * 1024
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self._serve(send_body=False)
+
+    def do_GET(self):
+        self._serve(send_body=True)
+
+    def _serve(self, send_body):
+        server = self.server
+        path = os.path.join(server.root, os.path.basename(self.path.split('?', 1)[0]))
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        time.sleep(server.latency)
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        match = re.fullmatch(r'bytes=(\d+)-(\d*)', self.headers.get('Range', '')) if server.ranges else None
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+        self.send_response(206 if match else 200)
+        self.send_header('Content-Type', server.content_type(path))
+        self.send_header('Content-Length', str(end - start + 1))
+        if server.ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        if match:
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        self.end_headers()
+        if not send_body:
+            return
+        with open(path, 'rb') as f:
+            f.seek(start)
+            remaining = end - start + 1
+            began = time.monotonic()
+            sent = 0
+            try:
+                while remaining > 0:
+                    chunk = f.read(min(CHUNK_SIZE, remaining))
+                    self.wfile.write(chunk)
+                    remaining -= len(chunk)
+                    sent += len(chunk)
+                    if server.rate:
+                        # Per-connection throttle
+                        delay = sent / server.rate - (time.monotonic() - began)
+                        if delay > 0:
+                            time.sleep(delay)
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+
+class MediaServer(ThreadingHTTPServer):
+    """Throttled file server: rate is bytes per second per connection, latency seconds per request"""
+
+    daemon_threads = True
+    CONTENT_TYPES = {
+        '.mp4': 'video/mp4', '.m4a': 'audio/mp4', '.webm': 'video/webm', '.bin': 'audio/mp4',
+        '.mpd': 'application/dash+xml', '.m4s': 'video/iso.segment',
+        '.m3u8': 'application/vnd.apple.mpegurl', '.ts': 'video/mp2t',
+    }
+
+    def __init__(self, root, rate=None, latency=0.0, ranges=True, port=0):
+        super().__init__(('127.0.0.1', port), _Handler)
+        self.root = root
+        self.rate = rate
+        self.latency = latency
+        self.ranges = ranges
+
+    def handle_error(self, request, client_address):
+        # Clients hanging up early (probes, cancelled downloads) are expected
+        if not isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            super().handle_error(request, client_address)
+
+    def content_type(self, path):
+        return self.CONTENT_TYPES.get(os.path.splitext(path)[1], 'application/octet-stream')
+
+    def url(self, name):
+        return f'http://127.0.0.1:{self.server_address[1]}/{name}'
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
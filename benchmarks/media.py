@@ -0,0 +1,93 @@
+"""Synthetic test media, generated with FFmpeg
+
+Builds a small library the local media server (http_server) can stand in for
+a video host with: progressive MP4 (H.264 + AAC) in a short and a large
+version, video-only MP4 and WebM, M4A and WebM audio, a DASH manifest with
+two video renditions and a separate audio track, and an HLS master playlist
+with two muxed variants. yt-dlp's generic extractor picks up every one of
+these from its URL. Files that already exist are reused.
+"""
+import os
+import subprocess
+
+# name -> what is in it
+LIBRARY = {
+    'av.mp4': 'progressive MP4, H.264 720p + AAC',
+    'large.mp4': 'progressive MP4, H.264 720p + AAC, looped to a large file',
+    'video.mp4': 'video-only MP4, H.264 720p',
+    'video.webm': 'video-only WebM, VP9 720p',
+    'audio.m4a': 'audio-only M4A, AAC',
+    'audio.webm': 'audio-only WebM, Opus',
+    'dash.mpd': 'DASH manifest: H.264 720p and 360p, AAC audio',
+    'hls.m3u8': 'HLS master playlist: muxed 720p and 360p variants',
+}
+
+VIDEO_SOURCE = 'testsrc2=size=1280x720:rate=30'
+AUDIO_SOURCE = 'sine=frequency=440:sample_rate=48000'
+
+
+def _ffmpeg(ffmpeg, *args):
+    subprocess.run([ffmpeg, '-y', '-hide_banner', '-loglevel', 'error', *args], check=True)
+
+
+def _lavfi(duration, audio=True, video=True):
+    """Input arguments for the synthetic video and/or audio source"""
+    args = []
+    if video:
+        args += ['-f', 'lavfi', '-t', str(duration), '-i', VIDEO_SOURCE]
+    if audio:
+        args += ['-f', 'lavfi', '-t', str(duration), '-i', AUDIO_SOURCE]
+    return args
+
+
+H264 = ['-c:v', 'libx264', '-preset', 'ultrafast', '-b:v', '3M', '-g', '60', '-pix_fmt', 'yuv420p']
+AAC = ['-c:a', 'aac', '-b:a', '128k']
+
+
+def generate(root, duration=30, large_mb=200, ffmpeg='ffmpeg'):
+    """Create the media library in root and return {name: path}"""
+    os.makedirs(root, exist_ok=True)
+    paths = {name: os.path.join(root, name) for name in LIBRARY}
+
+    def missing(name):
+        return not os.path.exists(paths[name])
+
+    if missing('av.mp4'):
+        _ffmpeg(ffmpeg, *_lavfi(duration), *H264, *AAC, '-movflags', '+faststart', paths['av.mp4'])
+    if missing('large.mp4'):
+        # Loop the short file (stream copy, so this is quick) until it reaches the requested size
+        loops = max(1, int(large_mb * 1024 * 1024 / os.path.getsize(paths['av.mp4'])))
+        _ffmpeg(ffmpeg, '-stream_loop', str(loops - 1), '-i', paths['av.mp4'], '-c', 'copy',
+                '-movflags', '+faststart', paths['large.mp4'])
+    if missing('video.mp4'):
+        _ffmpeg(ffmpeg, *_lavfi(duration, audio=False), *H264, paths['video.mp4'])
+    if missing('video.webm'):
+        _ffmpeg(ffmpeg, *_lavfi(duration, audio=False), '-c:v', 'libvpx-vp9', '-deadline', 'realtime',
+                '-cpu-used', '8', '-b:v', '2M', paths['video.webm'])
+    if missing('audio.m4a'):
+        _ffmpeg(ffmpeg, *_lavfi(duration, video=False), *AAC, paths['audio.m4a'])
+    if missing('audio.webm'):
+        _ffmpeg(ffmpeg, *_lavfi(duration, video=False), '-c:a', 'libopus', '-b:a', '128k', paths['audio.webm'])
+    if missing('dash.mpd'):
+        # Segments are written next to the manifest (the server serves a flat directory)
+        _ffmpeg(
+            ffmpeg, *_lavfi(duration),
+            '-map', '0:v', '-map', '0:v', '-map', '1:a',
+            *H264, '-s:v:1', '640x360', '-b:v:1', '800k', *AAC,
+            '-f', 'dash', '-seg_duration', '4', '-use_template', '1', '-use_timeline', '0',
+            '-init_seg_name', 'dash-init-$RepresentationID$.m4s',
+            '-media_seg_name', 'dash-$RepresentationID$-$Number%05d$.m4s',
+            '-adaptation_sets', 'id=0,streams=v id=1,streams=a',
+            paths['dash.mpd'],
+        )
+    if missing('hls.m3u8'):
+        _ffmpeg(
+            ffmpeg, *_lavfi(duration),
+            '-map', '0:v', '-map', '1:a', '-map', '0:v', '-map', '1:a',
+            *H264, '-s:v:1', '640x360', '-b:v:1', '800k', *AAC,
+            '-f', 'hls', '-hls_time', '4', '-hls_playlist_type', 'vod',
+            '-hls_segment_filename', os.path.join(root, 'hls-%v-%05d.ts'),
+            '-master_pl_name', 'hls.m3u8', '-var_stream_map', 'v:0,a:0 v:1,a:1',
+            os.path.join(root, 'hls-%v.m3u8'),
+        )
+    return paths
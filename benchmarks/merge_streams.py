@@ -0,0 +1,98 @@
+"""Benchmark downloading the video and audio of a merge side by side
+
+    python -m benchmarks.merge_streams --duration 40 --rate-mb 4
+
+Generates a video-only MP4 and an audio-only M4A with FFmpeg, serves them
+from a throttled local server and downloads + merges them with yt-dlp, once
+with the streams one after the other and once side by side. Prints the
+per-phase timings of both runs (or JSON with --json). Needs FFmpeg.
+"""
+import argparse
+import json
+import os
+import subprocess
+import tempfile
+import time
+
+from youtube_downloader.parallel import ParallelYoutubeDL
+from youtube_downloader.progress import ProgressReporter, format_timings
+
+from .http_server import MediaServer
+
+
+def make_media(root, duration):
+    """Write v.mp4 (H.264, no audio) and a.m4a (AAC) into root"""
+    ffmpeg = ['ffmpeg', '-y', '-loglevel', 'error', '-f', 'lavfi']
+    subprocess.run([*ffmpeg, '-i', 'testsrc2=size=1280x720:rate=30', '-t', str(duration),
+                    '-c:v', 'libx264', '-preset', 'ultrafast', '-b:v', '4M', os.path.join(root, 'v.mp4')], check=True)
+    subprocess.run([*ffmpeg, '-i', 'sine=frequency=440', '-t', str(duration),
+                    '-c:a', 'aac', '-b:a', '256k', os.path.join(root, 'a.m4a')], check=True)
+
+
+def info_dict(server, duration):
+    """A hand-made info dict with separate video and audio formats"""
+    return {
+        'id': 'bench',
+        'title': 'bench',
+        'webpage_url': server.url('page'),
+        'extractor': 'generic',
+        'extractor_key': 'Generic',
+        'duration': duration,
+        'formats': [
+            {'format_id': 'v', 'url': server.url('v.mp4'), 'ext': 'mp4', 'vcodec': 'avc1.64001f',
+             'acodec': 'none', 'height': 720, 'protocol': 'http'},
+            {'format_id': 'a', 'url': server.url('a.m4a'), 'ext': 'm4a', 'vcodec': 'none',
+             'acodec': 'mp4a.40.2', 'protocol': 'http'},
+        ],
+    }
+
+
+def run(server, duration, outdir, parallel_streams, connections):
+    """Download and merge once; return the phase timings"""
+    reporter = ProgressReporter(lambda event: None)
+    opts = {
+        'quiet': True,
+        'no_warnings': True,
+        'noprogress': True,
+        'outtmpl': os.path.join(outdir, '%(id)s.%(ext)s'),
+        'format': 'v+a',
+        'merge_output_format': 'mp4',
+        'parallel_streams': parallel_streams,
+        'range_connections': connections,
+        'progress_hooks': [reporter.progress_hook],
+        'postprocessor_hooks': [reporter.postprocessor_hook],
+    }
+    start = time.perf_counter()
+    with ParallelYoutubeDL(opts) as ydl:
+        info = ydl.process_ie_result(info_dict(server, duration), download=True)
+    timings = dict(reporter.timings, total=time.perf_counter() - start)
+    os.remove(info['requested_downloads'][0]['filepath'])
+    return {phase: round(seconds, 3) for phase, seconds in timings.items()}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n', 1)[0])
+    parser.add_argument('--duration', type=int, default=40, help='length of the test video in seconds')
+    parser.add_argument('--rate-mb', type=float, default=4, help='throttle per connection in MB/s (0 = none)')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds of latency per request')
+    parser.add_argument('--connections', type=int, default=1, help='connections per stream (0 = auto-tune)')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args(argv)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as root:
+        make_media(root, args.duration)
+        outdir = os.path.join(root, 'out')
+        with MediaServer(root, rate=args.rate_mb * 1024 * 1024 or None, latency=args.latency) as server:
+            for label, parallel_streams in (('sequential', False), ('side by side', True)):
+                results[label] = run(server, args.duration, outdir, parallel_streams, args.connections)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for label, timings in results.items():
+        print(f"{label:>12}: {format_timings(timings)}")
+
+
+if __name__ == '__main__':
+    main()
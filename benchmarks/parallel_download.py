@@ -0,0 +1,69 @@
+"""Benchmark parallel range downloading against a throttled local server
+
+    python -m benchmarks.parallel_download --size-mb 64 --rate-mb 4 --latency 0.05
+
+Downloads the same file with 1, 2, 4 and 8 connections and with auto-tuning,
+and prints the throughput of each run (or JSON with --json).
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+from youtube_downloader.parallel import ParallelYoutubeDL, tuner
+
+from .http_server import MediaServer
+
+
+def run(url, connections, outdir):
+    """Download url once and return (seconds, bytes)"""
+    outtmpl = os.path.join(outdir, f'{connections}-%(id)s.%(ext)s')
+    opts = {'quiet': True, 'no_warnings': True, 'noprogress': True, 'outtmpl': outtmpl, 'range_connections': connections}
+    start = time.perf_counter()
+    with ParallelYoutubeDL(opts) as ydl:
+        info = ydl.extract_info(url, download=True)
+        path = ydl.prepare_filename(info)
+    elapsed = time.perf_counter() - start
+    size = os.path.getsize(path)
+    os.remove(path)
+    return elapsed, size
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n', 1)[0])
+    parser.add_argument('--size-mb', type=int, default=64, help='size of the test file')
+    parser.add_argument('--rate-mb', type=float, default=4, help='throttle per connection in MB/s (0 = none)')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds of latency per request')
+    parser.add_argument('--connections', type=int, nargs='+', default=[1, 2, 4, 8, 0],
+                        help='connection counts to compare (0 = auto-tune)')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as root:
+        with open(os.path.join(root, 'media.m4a'), 'wb') as f:
+            f.write(os.urandom(args.size_mb * 1024 * 1024))
+        outdir = os.path.join(root, 'out')
+        rate = args.rate_mb * 1024 * 1024 or None
+        results = []
+        with MediaServer(root, rate=rate, latency=args.latency) as server:
+            for connections in args.connections:
+                elapsed, size = run(server.url('media.m4a'), connections, outdir)
+                results.append({
+                    'connections': connections or 'auto',
+                    'tuned_to': tuner.stats().get('127.0.0.1') if not connections else connections,
+                    'seconds': round(elapsed, 3),
+                    'mb_per_s': round(size / elapsed / (1024 * 1024), 2),
+                })
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{args.size_mb} MB file, {args.rate_mb} MB/s per connection, {args.latency * 1000:.0f} ms latency")
+    for result in results:
+        print(f"{str(result['connections']):>5} connections: {result['mb_per_s']:7.2f} MB/s "
+              f"({result['seconds']:.2f}s, used {result['tuned_to']})")
+
+
+if __name__ == '__main__':
+    main()
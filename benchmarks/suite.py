@@ -0,0 +1,316 @@
+"""Offline benchmark suite for the whole download pipeline
+
+    python -m benchmarks.suite
+    python -m benchmarks.suite --scenario single-merge concurrent-users --iterations 5
+    python -m benchmarks.suite --rate-mb 8 --compare benchmarks/results/20260101-120000.json
+
+Generates synthetic media with FFmpeg (see benchmarks.media), serves it
+from a local server and runs every scenario through the app's real path:
+jobs on the job queue calling run_download (or run_batch), with format
+selection, the yt-dlp options, merging, audio extraction and publishing
+through the delivery server, whose links are then fetched like a browser
+would. Every download uses a URL of its own, so nothing is served from the
+info or download caches.
+
+For each scenario it reports latency percentiles (submit to file fetched),
+throughput, peak RSS and CPU time, and saves the results as JSON under
+benchmarks/results/ to compare later runs against (--compare).
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from datetime import datetime, timezone
+
+from . import media
+from .http_server import MediaServer
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), 'results')
+POLL_INTERVAL = 0.02
+RSS_SAMPLE_INTERVAL = 0.05
+FETCH_CHUNK_SIZE = 1024 * 1024
+
+# name -> what to run: the media file, download options and how many users or batch items
+SCENARIOS = {
+    'single-progressive': dict(media='av.mp4', mode='video', has_ffmpeg=False,
+                               description='one progressive MP4 without FFmpeg'),
+    'single-merge': dict(media='dash.mpd', mode='video', has_ffmpeg=True,
+                         description='one DASH video + audio download merged with FFmpeg'),
+    'single-hls': dict(media='hls.m3u8', mode='video', has_ffmpeg=True,
+                       description='one HLS download (muxed variant)'),
+    'audio-mp3': dict(media='av.mp4', mode='audio', has_ffmpeg=True,
+                      description='audio extracted to MP3'),
+    'large-file': dict(media='large.mp4', mode='video', has_ffmpeg=True,
+                       description='one large progressive MP4'),
+    'concurrent-users': dict(media='av.mp4', mode='video', has_ffmpeg=True, users=8,
+                             description='8 users downloading different videos at once'),
+    'batch': dict(media='dash.mpd', mode='video', has_ffmpeg=True, batch=6,
+                  description='a batch of 6 DASH videos'),
+}
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def configure(data_dir, workers):
+    """Point the app's settings at a scratch directory (before youtube_downloader is imported)"""
+    delivery_port = _free_port()
+    os.environ.update({
+        'YTDL_DATA_DIR': data_dir,
+        'YTDL_DELIVERY_HOST': '127.0.0.1',
+        'YTDL_DELIVERY_PORT': str(delivery_port),
+        'YTDL_DELIVERY_PUBLIC_URL': f'http://127.0.0.1:{delivery_port}',
+        # Every run has to do the work: no download cache, no metrics server
+        'YTDL_DOWNLOAD_CACHE_MB': '0',
+        'YTDL_METRICS_PORT': '0',
+        'YTDL_JOB_WORKERS': str(workers),
+        'YTDL_JOB_QUEUE_SIZE': '1000',
+    })
+
+
+def percentile(values, p):
+    """Return the p-th percentile (0-100) of values, interpolating between ranks"""
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    rank = (len(ordered) - 1) * p / 100
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+class ResourceSampler:
+    """Peak RSS of this process while running, and the CPU time it and its children used"""
+
+    def __init__(self):
+        self.peak_rss = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, name='rss-sampler', daemon=True)
+
+    @staticmethod
+    def rss():
+        """Current resident set size in bytes (peak so far where /proc isn't available)"""
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError):
+            maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            # ru_maxrss is in kilobytes on Linux and bytes on macOS
+            return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+    def _sample(self):
+        while not self._stop.is_set():
+            self.peak_rss = max(self.peak_rss, self.rss())
+            self._stop.wait(RSS_SAMPLE_INTERVAL)
+
+    def __enter__(self):
+        self._times = os.times()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        end = os.times()
+        self.cpu_seconds = (end.user - self._times.user) + (end.system - self._times.system)
+        # FFmpeg and other subprocesses
+        self.children_cpu_seconds = ((end.children_user - self._times.children_user)
+                                     + (end.children_system - self._times.children_system))
+
+
+def fetch(url):
+    """Download a delivery link like a browser and return the number of bytes"""
+    size = 0
+    with urllib.request.urlopen(url) as response:
+        while chunk := response.read(FETCH_CHUNK_SIZE):
+            size += len(chunk)
+    return size
+
+
+def _wait(job):
+    while job.finished is None:
+        time.sleep(POLL_INTERVAL)
+
+
+def _download_results(job):
+    """Return the download results of a finished download or batch job"""
+    if job.error:
+        raise RuntimeError(job.error)
+    if 'items' in (job.result or {}):
+        failed = [item for item in job.result['items'] if item.get('error')]
+        if failed:
+            raise RuntimeError(failed[0]['error'])
+        return job.result['items']
+    return [job.result]
+
+
+def run_scenario(name, spec, server, iterations, run_id):
+    """Run a scenario and return its measurements"""
+    from youtube_downloader.batch import run_batch
+    from youtube_downloader.download import flight_key, run_download
+    from youtube_downloader.jobs import job_manager
+
+    quality = 'best'
+    latencies, phases, errors = [], {}, []
+    total_bytes = 0
+    started = time.perf_counter()
+    with ResourceSampler() as sampler:
+        for iteration in range(iterations):
+            # A URL of its own per download, so no cache or in-flight download is reused
+            def url(n):
+                return f"{server.url(spec['media'])}?run={run_id}-{name}-{iteration}-{n}"
+
+            submitted = []
+            if spec.get('batch'):
+                sources = [url(n) for n in range(spec['batch'])]
+                job = job_manager.submit('bench-batch', run_batch, sources=sources, mode=spec['mode'],
+                                         quality=quality, has_ffmpeg=spec['has_ffmpeg'])
+                submitted.append(job)
+            else:
+                for user in range(spec.get('users', 1)):
+                    job = job_manager.submit(
+                        f'bench-{user}', run_download,
+                        key=flight_key(url(user), spec['mode'], quality, spec['has_ffmpeg']),
+                        url=url(user), mode=spec['mode'], quality=quality, has_ffmpeg=spec['has_ffmpeg'],
+                    )
+                    submitted.append(job)
+
+            for job in submitted:
+                _wait(job)
+                try:
+                    results = _download_results(job)
+                    for result in results:
+                        total_bytes += fetch(result['download_url'])
+                        for phase, seconds in (result.get('timings') or {}).items():
+                            phases.setdefault(phase, []).append(seconds)
+                except Exception as e:
+                    errors.append(str(e))
+                    continue
+                latencies.append(time.time() - job.created)
+    wall = time.perf_counter() - started
+
+    return {
+        'description': spec['description'],
+        'downloads': len(latencies) * (spec.get('batch') or 1),
+        'errors': errors,
+        'latency_seconds': {
+            'p50': percentile(latencies, 50),
+            'p90': percentile(latencies, 90),
+            'p99': percentile(latencies, 99),
+            'mean': sum(latencies) / len(latencies) if latencies else None,
+            'max': max(latencies, default=None),
+        },
+        'phase_seconds_mean': {phase: sum(values) / len(values) for phase, values in phases.items()},
+        'bytes': total_bytes,
+        'wall_seconds': wall,
+        'throughput_mb_s': total_bytes / wall / (1024 * 1024) if wall else None,
+        'cpu_seconds': sampler.cpu_seconds,
+        'children_cpu_seconds': sampler.children_cpu_seconds,
+        'cpu_percent': 100 * (sampler.cpu_seconds + sampler.children_cpu_seconds) / wall if wall else None,
+        'peak_rss_mb': sampler.peak_rss / (1024 * 1024),
+    }
+
+
+def environment():
+    """Versions and machine details recorded with the results"""
+    import yt_dlp
+
+    from youtube_downloader import ffmpeg
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(__file__), timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'yt_dlp': yt_dlp.version.__version__,
+        'ffmpeg': ffmpeg.get_probe().ffmpeg_version,
+    }
+
+
+def print_results(results, baseline=None):
+    """Print a table of the scenarios, with changes against a baseline run if given"""
+    print(f"{'scenario':<20} {'n':>3} {'p50 s':>8} {'p90 s':>8} {'p99 s':>8} {'MB/s':>8} "
+          f"{'CPU %':>7} {'RSS MB':>7}  errors")
+    for name, result in results['scenarios'].items():
+        latency = result['latency_seconds']
+
+        def number(value, digits=2):
+            return f'{value:.{digits}f}' if value is not None else '-'
+
+        line = (f"{name:<20} {result['downloads']:>3} {number(latency['p50']):>8} {number(latency['p90']):>8} "
+                f"{number(latency['p99']):>8} {number(result['throughput_mb_s'], 1):>8} "
+                f"{number(result['cpu_percent'], 0):>7} {number(result['peak_rss_mb'], 0):>7}  {len(result['errors'])}")
+        before = (baseline or {}).get('scenarios', {}).get(name)
+        if before and before['latency_seconds']['p50'] and latency['p50']:
+            change = latency['p50'] / before['latency_seconds']['p50'] - 1
+            line += f"  (p50 {change:+.0%} vs baseline)"
+        print(line)
+        for error in result['errors'][:3]:
+            print(f"    error: {error[:200]}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n', 1)[0])
+    parser.add_argument('--scenario', nargs='+', choices=SCENARIOS, default=list(SCENARIOS),
+                        help='scenarios to run (default: all)')
+    parser.add_argument('--iterations', type=int, default=3, help='runs per scenario')
+    parser.add_argument('--rate-mb', type=float, default=0, help='throttle per connection in MB/s (0 = none)')
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds of latency per request')
+    parser.add_argument('--workers', type=int, default=4, help='download workers (YTDL_JOB_WORKERS)')
+    parser.add_argument('--duration', type=int, default=30, help='length of the generated videos in seconds')
+    parser.add_argument('--large-mb', type=int, default=200, help='size of the large-file video')
+    parser.add_argument('--media-dir', default=os.path.join(tempfile.gettempdir(), 'ytdl-benchmark-media'),
+                        help='where generated media is kept between runs')
+    parser.add_argument('--output', help='JSON file to write (default: benchmarks/results/<time>.json)')
+    parser.add_argument('--compare', metavar='JSON', help='earlier results to compare against')
+    args = parser.parse_args(argv)
+
+    print(f"Generating media in {args.media_dir} (reused once it exists)...", file=sys.stderr)
+    media.generate(args.media_dir, duration=args.duration, large_mb=args.large_mb)
+
+    run_id = datetime.now(timezone.utc).strftime('%Y%m%d-%H%M%S')
+    with tempfile.TemporaryDirectory(prefix='ytdl-benchmark-') as data_dir:
+        configure(data_dir, args.workers)
+        results = {
+            'created': datetime.now(timezone.utc).isoformat(),
+            'environment': environment(),
+            'settings': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+            'scenarios': {},
+        }
+        rate = args.rate_mb * 1024 * 1024 or None
+        with MediaServer(args.media_dir, rate=rate, latency=args.latency) as server:
+            for name in args.scenario:
+                print(f"Running {name}...", file=sys.stderr)
+                results['scenarios'][name] = run_scenario(name, SCENARIOS[name], server, args.iterations, run_id)
+
+    output = args.output or os.path.join(RESULTS_DIR, f'{run_id}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+    print(f"\nResults saved to {output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""Shared fixtures: scratch settings, synthetic media and a local server standing in for the video host
+
+youtube_downloader reads its settings when it is imported, so they are set
+here, before any test module imports it. Tests that need media are skipped
+when FFmpeg isn't installed, except on CI, where they fail instead.
+"""
+import os
+import shutil
+import socket
+import tempfile
+
+import pytest
+
+DATA_DIR = tempfile.mkdtemp(prefix='ytdl-tests-')
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+_delivery_port = _free_port()
+os.environ.update({
+    'YTDL_DATA_DIR': DATA_DIR,
+    'YTDL_DELIVERY_HOST': '127.0.0.1',
+    'YTDL_DELIVERY_PORT': str(_delivery_port),
+    'YTDL_DELIVERY_PUBLIC_URL': f'http://127.0.0.1:{_delivery_port}',
+    'YTDL_DELIVERY_SECRET': 'test-secret',
+    'YTDL_METRICS_PORT': '0',
+    # The local server standing in for the video host needs no rate limit
+    'YTDL_HOST_RATE': '0',
+})
+
+
+def pytest_sessionfinish(session, exitstatus):
+    shutil.rmtree(DATA_DIR, ignore_errors=True)
+
+
+@pytest.fixture(scope='session')
+def media_dir(tmp_path_factory):
+    """A small library of the media in benchmarks.media (2 s long)"""
+    if shutil.which('ffmpeg') is None:
+        if os.environ.get('CI'):
+            pytest.fail('FFmpeg must be installed on CI')
+        pytest.skip('needs FFmpeg')
+    from benchmarks import media
+
+    root = tmp_path_factory.mktemp('media')
+    media.generate(str(root), duration=2, large_mb=1)
+    return str(root)
+
+
+@pytest.fixture(scope='session')
+def media_server(media_dir):
+    """benchmarks.http_server.MediaServer serving media_dir"""
+    from benchmarks.http_server import MediaServer
+
+    with MediaServer(media_dir) as server:
+        yield server
@@ -0,0 +1,54 @@
+import io
+import zipfile
+from urllib.request import urlopen
+
+from youtube_downloader import batch
+from youtube_downloader.batch import expand_sources, parse_sources, run_batch
+from youtube_downloader.jobs import DONE, FAILED, Job
+
+VIDEO = 'https://www.youtube.com/watch?v=dQw4w9WgXcQ'
+
+
+def test_sources_are_split_on_whitespace_and_commas():
+    text = f"{VIDEO}\n  https://youtu.be/abc, not-a-url\thttp://example.com/v.mp4"
+    assert parse_sources(text) == [VIDEO, 'https://youtu.be/abc', 'http://example.com/v.mp4']
+    assert parse_sources(None) == []
+
+
+def test_nested_playlists_are_flattened():
+    entries = [
+        {'url': 'a'},
+        None,
+        {'_type': 'playlist', 'entries': [{'url': 'b'}, {'url': 'c'}]},
+    ]
+    assert [entry['url'] for entry in batch._flatten(entries, limit=10, depth=0)] == ['a', 'b', 'c']
+
+
+def test_sources_are_deduplicated_and_limited():
+    items = expand_sources([VIDEO, VIDEO, 'https://youtu.be/aaaaaaaaaaa', 'https://youtu.be/bbbbbbbbbbb'], limit=2)
+    assert [item['url'] for item in items] == [VIDEO, 'https://youtu.be/aaaaaaaaaaa']
+
+
+def test_sources_that_cannot_be_expanded_become_failed_items(media_server):
+    items = expand_sources([media_server.url('missing.mp4')])
+    assert len(items) == 1
+    assert items[0]['error']
+
+
+def test_batch_downloads_every_item_and_zips_them(media_server):
+    sources = [media_server.url('av.mp4?batch'), media_server.url('missing.mp4'), media_server.url('video.mp4?batch')]
+    result = run_batch(Job('tester'), sources, 'video', 'best', True, concurrency=2, make_zip=True)
+    assert [item['status'] for item in result['items']] == [DONE, FAILED, DONE]
+    assert all(item['download_url'] for item in result['items'] if item['status'] == DONE)
+    with urlopen(result['zip_url']) as response:
+        archive = zipfile.ZipFile(io.BytesIO(response.read()))
+    sizes = sorted(info.file_size for info in archive.infolist())
+    assert sizes == sorted(item['file_size'] for item in result['items'] if item['status'] == DONE)
+
+
+def test_a_cancelled_batch_stops(media_server):
+    job = Job('tester')
+    job._cancel_event.set()
+    job.target = lambda job: run_batch(job, [media_server.url('av.mp4?cancelled')], 'video', 'best', True)
+    job.run()
+    assert job.status == 'cancelled'
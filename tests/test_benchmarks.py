@@ -0,0 +1,60 @@
+import json
+import os
+import subprocess
+import sys
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+import pytest
+
+from benchmarks import media
+from benchmarks.http_server import MediaServer
+from benchmarks.suite import percentile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def files(tmp_path):
+    (tmp_path / 'blob.bin').write_bytes(bytes(range(256)) * 4)
+    return tmp_path
+
+
+def test_media_library_is_complete(media_dir):
+    for name in media.LIBRARY:
+        assert os.path.getsize(os.path.join(media_dir, name)) > 0
+
+
+def test_server_answers_range_requests(files):
+    with MediaServer(str(files)) as server:
+        with urlopen(Request(server.url('blob.bin?any-query'), headers={'Range': 'bytes=10-19'})) as response:
+            assert response.status == 206
+            assert response.headers['Content-Range'] == 'bytes 10-19/1024'
+            assert response.read() == bytes(range(10, 20))
+        with pytest.raises(HTTPError) as raised:
+            urlopen(server.url('missing.bin'))
+        assert raised.value.code == 404
+
+
+def test_server_can_ignore_ranges(files):
+    with MediaServer(str(files), ranges=False) as server:
+        with urlopen(Request(server.url('blob.bin'), headers={'Range': 'bytes=10-19'})) as response:
+            assert response.status == 200
+            assert 'Accept-Ranges' not in response.headers
+            assert len(response.read()) == 1024
+
+
+def test_percentiles_interpolate():
+    assert percentile([4, 1, 3, 2], 50) == 2.5
+    assert percentile([1, 2, 3], 100) == 3
+    assert percentile([], 50) is None
+
+
+def test_suite_runs_a_scenario(media_dir, tmp_path):
+    output = tmp_path / 'results.json'
+    subprocess.run([sys.executable, '-m', 'benchmarks.suite', '--scenario', 'single-progressive', '--iterations', '1',
+                    '--media-dir', media_dir, '--output', str(output)],
+                   cwd=ROOT, check=True, capture_output=True, timeout=300)
+    result = json.loads(output.read_text())['scenarios']['single-progressive']
+    assert result['downloads'] == 1
+    assert result['errors'] == []
@@ -0,0 +1,41 @@
+import json
+import os
+
+import pytest
+
+from youtube_downloader import download, get_info
+from youtube_downloader.__main__ import main
+
+
+def test_download_saves_into_the_output_directory(media_server, tmp_path):
+    events = []
+    result = download(media_server.url('av.mp4?api'), output_dir=str(tmp_path), on_progress=events.append)
+    assert os.path.dirname(result['file_path']) == str(tmp_path)
+    assert os.path.getsize(result['file_path']) == result['file_size']
+    assert result['download_url'] is None
+    assert events
+
+
+def test_get_info(media_server):
+    info = get_info(media_server.url('av.mp4?api-info'))
+    assert info['formats']
+
+
+def test_cli_prints_json_results(media_server, tmp_path, capsys):
+    assert main([media_server.url('av.mp4?cli'), '-o', str(tmp_path), '--json', '--quiet']) == 0
+    result = json.loads(capsys.readouterr().out)
+    assert result['url'] == media_server.url('av.mp4?cli')
+    assert os.path.isfile(result['file_path'])
+
+
+def test_cli_reports_failures_and_carries_on(media_server, tmp_path, capsys):
+    urls = [media_server.url('missing.mp4'), media_server.url('av.mp4?cli-after')]
+    assert main([*urls, '-o', str(tmp_path), '--quiet']) == 1
+    captured = capsys.readouterr()
+    assert f"error: {urls[0]}" in captured.err
+    assert os.path.isfile(captured.out.strip())
+
+
+def test_cli_rejects_unknown_modes(capsys):
+    with pytest.raises(SystemExit):
+        main(['https://example.com/v', '--mode', 'gif'])
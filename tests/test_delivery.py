@@ -0,0 +1,126 @@
+import os
+import time
+from urllib.error import HTTPError
+from urllib.parse import parse_qs, urlsplit
+from urllib.request import Request, urlopen
+
+import pytest
+
+from youtube_downloader import delivery
+from youtube_downloader.download_cache import download_cache
+
+DATA = bytes(range(256)) * 40
+
+
+@pytest.fixture
+def published(tmp_path):
+    path = tmp_path / 'clip.mp4'
+    path.write_bytes(DATA)
+    return delivery.publish(str(path), 'My clip: part 1.mp4', 'video/mp4')
+
+
+def fetch(url, **headers):
+    """Return (status, headers, body) of a GET, HTTP errors included"""
+    try:
+        with urlopen(Request(url, headers=headers)) as response:
+            return response.status, response.headers, response.read()
+    except HTTPError as e:
+        with e:
+            return e.code, e.headers, e.read()
+
+
+def with_query(url, **changes):
+    parts = urlsplit(url)
+    query = {key: values[0] for key, values in parse_qs(parts.query).items()}
+    query.update(changes)
+    return parts._replace(query='&'.join(f'{key}={value}' for key, value in query.items())).geturl()
+
+
+def test_publish_moves_the_file_out_of_its_directory(tmp_path, published):
+    assert not (tmp_path / 'clip.mp4').exists()
+    assert published.path.endswith('My clip_ part 1.mp4')
+    assert published.expires > time.time()
+
+
+def test_link_streams_the_whole_file(published):
+    status, headers, body = fetch(published.url)
+    assert status == 200
+    assert body == DATA
+    assert headers['Content-Type'] == 'video/mp4'
+    assert headers['Accept-Ranges'] == 'bytes'
+    assert "filename*=UTF-8''My%20clip_%20part%201.mp4" in headers['Content-Disposition']
+
+
+@pytest.mark.parametrize('header, start, end', [
+    ('bytes=10-19', 10, 19),
+    ('bytes=10000-', 10000, len(DATA) - 1),
+    ('bytes=-100', len(DATA) - 100, len(DATA) - 1),
+    ('bytes=0-99999', 0, len(DATA) - 1),
+])
+def test_range_requests(published, header, start, end):
+    status, headers, body = fetch(published.url, Range=header)
+    assert status == 206
+    assert headers['Content-Range'] == f'bytes {start}-{end}/{len(DATA)}'
+    assert body == DATA[start:end + 1]
+
+
+def test_unsatisfiable_range(published):
+    status, headers, _ = fetch(published.url, Range=f'bytes={len(DATA)}-')
+    assert status == 416
+    assert headers['Content-Range'] == f'bytes */{len(DATA)}'
+
+
+@pytest.mark.parametrize('change', [
+    {'sig': 'forged'},
+    {'type': 'text/html'},
+    {'expires': str(2 ** 40)},
+])
+def test_tampered_links_are_refused(published, change):
+    assert fetch(with_query(published.url, **change))[0] == 403
+
+
+def test_files_signature_does_not_open_the_cache(published):
+    assert fetch(published.url.replace('/files/', '/cache/'))[0] == 403
+
+
+def test_serving_cached_files_is_no_cache_use(tmp_path):
+    path = tmp_path / 'cached.mp4'
+    path.write_bytes(DATA)
+    key = 'c' * 64
+    download_cache.store(key, path, {})
+    meta_path = os.path.join(download_cache.root, key, 'meta.json')
+    os.utime(meta_path, (1, 1))
+    stats = download_cache.stats()
+    link = delivery.publish_cached(key, 'cached.mp4', 'video/mp4')
+    assert fetch(link.url)[2] == DATA
+    assert download_cache.stats() == stats
+    assert os.path.getmtime(meta_path) == 1
+
+
+def test_expired_links_are_gone(published):
+    file_id = urlsplit(published.url).path.split('/')[2]
+    expired = delivery._link('files', file_id, 'My clip_ part 1.mp4', 'video/mp4', int(time.time()) - 1)
+    assert fetch(expired)[0] == 410
+
+
+def test_unknown_files_are_not_found(published):
+    missing = delivery._link('files', 'missing', 'x.mp4', 'video/mp4', int(time.time()) + 60)
+    assert fetch(missing)[0] == 404
+
+
+def test_purge_removes_expired_files(tmp_path):
+    path = tmp_path / 'old.mp4'
+    path.write_bytes(b'old')
+    published = delivery.publish(str(path), ttl=0.01)
+    time.sleep(1.1)
+    delivery.purge_expired()
+    assert not os.path.exists(published.path)
+    assert fetch(published.url)[0] == 410
+
+
+@pytest.mark.parametrize('name, expected', [
+    ('a/b\\c:d*e?.mp4', 'a_b_c_d_e_.mp4'),
+    ('  ..  ', 'download'),
+])
+def test_safe_name(name, expected):
+    assert delivery.safe_name(name) == expected
@@ -0,0 +1,112 @@
+import os
+import time
+
+import pytest
+
+from youtube_downloader.download import run_download
+from youtube_downloader.download_cache import DownloadCache, cache_key
+from youtube_downloader.jobs import Job
+from youtube_downloader.state import SQLiteState
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return DownloadCache(str(tmp_path / 'cache'), 100, state=SQLiteState(str(tmp_path / 'state.db')))
+
+
+def download(tmp_path, name, size):
+    """A finished download of size bytes in its own working directory"""
+    work = tmp_path / 'work' / name
+    work.mkdir(parents=True)
+    path = work / f'{name}.mp4'
+    path.write_bytes(b'x' * size)
+    return path
+
+
+def used(cache, key, seconds_ago):
+    os.utime(os.path.join(cache.root, key, 'meta.json'), (time.time() - seconds_ago,) * 2)
+
+
+def test_key_depends_on_the_output_settings_only():
+    opts = {'format': 'bv+ba', 'merge_output_format': 'mp4', 'outtmpl': '/tmp/a/%(id)s.%(ext)s'}
+    assert cache_key('youtube:x', opts) == cache_key('youtube:x', dict(opts, outtmpl='/tmp/b/%(id)s.%(ext)s'))
+    assert cache_key('youtube:x', opts) != cache_key('youtube:x', dict(opts, format='best'))
+    assert cache_key('youtube:x', opts) != cache_key('youtube:y', opts)
+    assert cache_key('youtube:x', opts) != cache_key('youtube:x', opts, section=(10, 20, False))
+
+
+def test_stored_files_are_found_with_their_meta(cache, tmp_path):
+    path = download(tmp_path, 'a', 10)
+    stored = cache.store('a', path, {'title': 'A'})
+    assert not path.exists()
+    assert cache.lookup('a') == (stored, {'title': 'A', 'file': 'a.mp4'})
+    assert cache.lookup('b') is None
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 1
+
+
+def test_peeking_leaves_stats_and_lru_order_alone(cache, tmp_path):
+    stored = cache.store('a', download(tmp_path, 'a', 10), {})
+    used(cache, 'a', 60)
+    last_used = os.path.getmtime(os.path.join(cache.root, 'a', 'meta.json'))
+    assert cache.peek('a') == (stored, {'file': 'a.mp4'})
+    assert cache.peek('b') is None
+    assert os.path.getmtime(os.path.join(cache.root, 'a', 'meta.json')) == last_used
+    assert (cache.stats()['hits'], cache.stats()['misses']) == (0, 0)
+
+
+def test_files_over_the_budget_are_not_cached(cache, tmp_path):
+    path = download(tmp_path, 'big', 101)
+    assert cache.store('big', path, {}) == path
+    assert path.exists()
+    assert cache.lookup('big') is None
+
+
+def test_the_first_store_of_a_key_wins(cache, tmp_path):
+    first = cache.store('a', download(tmp_path, 'first', 10), {'n': 1})
+    second = cache.store('a', download(tmp_path, 'second', 10), {'n': 2})
+    assert second == first
+    assert cache.lookup('a')[1]['n'] == 1
+    # Nothing is left half-published
+    assert not [name for name in os.listdir(cache.root) if name.startswith('.tmp-')]
+
+
+def test_least_recently_used_entries_are_evicted(cache, tmp_path):
+    # Entries of 25 bytes plus their meta.json: two fit the budget of 100
+    for name, seconds_ago in (('old', 30), ('older', 60), ('recent', 10)):
+        cache.store(name, download(tmp_path, name, 25), {})
+        used(cache, name, seconds_ago)
+    # Storing the third made room by evicting the least recently used
+    assert cache.lookup('older') is None
+    cache.lookup('old')
+    cache.store('new', download(tmp_path, 'new', 25), {})
+    assert cache.lookup('recent') is None
+    assert cache.lookup('old') is not None
+    assert cache.lookup('new') is not None
+    assert cache.stats()['bytes'] <= cache.max_bytes
+
+
+def test_staging_directories_are_removed_after_use(cache):
+    with cache.staging_dir() as path:
+        assert os.path.isdir(path)
+    assert not os.path.exists(path)
+
+
+def test_orphaned_staging_directories_are_cleaned_up(cache, tmp_path):
+    cache.store('a', download(tmp_path, 'a', 10), {})
+    orphans = [os.path.join(cache.root, '.tmp-crashed'), os.path.join(cache.staging_root, 'crashed')]
+    for orphan in orphans:
+        os.makedirs(orphan)
+        os.utime(orphan, (0, 0))
+    cache.cleanup_orphans()
+    assert not any(os.path.exists(orphan) for orphan in orphans)
+    assert cache.lookup('a') is not None
+
+
+def test_a_second_download_is_served_from_the_cache(media_server):
+    url = media_server.url('av.mp4?cached')
+    first = run_download(Job('tester'), url, 'video', 'best', True)
+    second = run_download(Job('tester'), url, 'video', 'best', True)
+    assert not first['cached']
+    assert second['cached']
+    assert second['file_size'] == first['file_size']
@@ -0,0 +1,71 @@
+import os
+import stat
+import sys
+
+import pytest
+
+from youtube_downloader import ffmpeg
+
+FAKE_FFMPEG = '''#!/bin/sh
+echo probed >> "$(dirname "$0")/calls"
+case "$*" in
+  *-encoders*) printf ' V..... = Video\\n ------\\n V....D libx264  H.264\\n V....D h264_vaapi  H.264 VAAPI\\n A....D aac  AAC\\n' ;;
+  *) echo "ffmpeg version 6.1-test Copyright" ;;
+esac
+'''
+
+
+@pytest.fixture
+def fake_ffmpeg(tmp_path, monkeypatch):
+    """A directory on PATH holding a scripted ffmpeg (and no ffprobe)"""
+    if sys.platform == 'win32':
+        pytest.skip('needs a POSIX shell')
+    path = tmp_path / 'ffmpeg'
+    path.write_text(FAKE_FFMPEG)
+    path.chmod(path.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv('PATH', str(tmp_path))
+    ffmpeg.invalidate()
+    yield tmp_path
+    ffmpeg.invalidate()
+
+
+def calls(directory):
+    return len((directory / 'calls').read_text().splitlines()) if (directory / 'calls').exists() else 0
+
+
+def test_probe_reads_version_and_encoders(fake_ffmpeg):
+    probe = ffmpeg.probe_system()
+    assert probe.available
+    assert probe.in_path
+    assert probe.ffmpeg_version == '6.1-test'
+    assert probe.ffprobe_path is None
+    assert probe.location == str(fake_ffmpeg)
+    assert probe.encoders == {'libx264', 'h264_vaapi', 'aac'}
+    assert probe.hardware_encoders == ['h264_vaapi']
+
+
+def test_probe_runs_once_until_invalidated(fake_ffmpeg):
+    assert ffmpeg.check_ffmpeg()
+    probed = calls(fake_ffmpeg)
+    assert ffmpeg.check_ffmpeg()
+    assert ffmpeg.get_probe() is ffmpeg.get_probe()
+    assert calls(fake_ffmpeg) == probed
+    ffmpeg.invalidate()
+    ffmpeg.get_probe()
+    assert calls(fake_ffmpeg) == 2 * probed
+
+
+def test_missing_ffmpeg(tmp_path, monkeypatch):
+    monkeypatch.setenv('PATH', str(tmp_path))
+    monkeypatch.setattr(ffmpeg.platform, 'system', lambda: 'Linux')
+    probe = ffmpeg.probe_system()
+    assert not probe.available
+    assert probe.location is None
+
+
+def test_broken_ffmpeg_is_reported(fake_ffmpeg):
+    (fake_ffmpeg / 'ffmpeg').write_text('#!/bin/sh\nexit 1\n')
+    probe = ffmpeg.probe_system()
+    assert not probe.available
+    assert probe.error
+    assert os.path.basename(probe.ffmpeg_path) == 'ffmpeg'
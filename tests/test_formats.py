@@ -0,0 +1,189 @@
+import pytest
+
+from youtube_downloader import config, parallel
+from youtube_downloader.download import (
+    DownloadError, _note_budget, clip_section, section_share, select_formats, select_progressive_format, size_budget,
+    video_policy,
+)
+from youtube_downloader.formats import (
+    AUDIO_CODEC_FAMILIES, UNKNOWN_CODEC, VIDEO_CODEC_FAMILIES, FormatIndex, Policy, codec_family, index_for,
+    protocol_family,
+)
+from youtube_downloader.jobs import Job
+from youtube_downloader.parallel import ThroughputMeter
+
+
+def video(format_id, height, vcodec='avc1.640028', tbr=1000, ext='mp4', **fields):
+    return dict(fields, format_id=format_id, height=height, vcodec=vcodec, acodec='none', tbr=tbr, ext=ext,
+                protocol='https')
+
+
+def audio(format_id, acodec='mp4a.40.2', tbr=128, ext='m4a', **fields):
+    return dict(fields, format_id=format_id, vcodec='none', acodec=acodec, tbr=tbr, ext=ext, protocol='https')
+
+
+def progressive(format_id, height, ext='mp4', vcodec='avc1.42001E', tbr=800, **fields):
+    return dict(fields, format_id=format_id, height=height, vcodec=vcodec, acodec='mp4a.40.2', tbr=tbr, ext=ext,
+                protocol='https')
+
+
+INFO = {
+    'id': 'video', 'extractor_key': 'Youtube', 'epoch': 1, 'duration': 100,
+    'formats': [
+        {'format_id': 'sb0', 'vcodec': 'none', 'acodec': 'none', 'ext': 'mhtml'},
+        progressive('18', 360),
+        progressive('22', 720, tbr=2000),
+        video('137', 1080, tbr=4000),
+        video('248', 1080, vcodec='vp9', tbr=3000, ext='webm'),
+        video('136', 720, tbr=2000),
+        video('135', 480, tbr=1000),
+        audio('140'),
+        audio('251', acodec='opus', tbr=130, ext='webm'),
+    ],
+}
+
+
+@pytest.fixture
+def index():
+    return FormatIndex(INFO)
+
+
+@pytest.mark.parametrize('codec, family', [
+    ('avc1.64001F', 'h264'), ('vp09.00.40.08', 'vp9'), ('av01.0.08M.08', 'av1'), ('hev1.1.6', 'h265'),
+    ('none', None), ('', None), (None, UNKNOWN_CODEC), ('theora', 'theora'),
+])
+def test_video_codec_families(codec, family):
+    assert codec_family(codec, VIDEO_CODEC_FAMILIES) == family
+
+
+def test_audio_codec_families():
+    assert codec_family('mp4a.40.2', AUDIO_CODEC_FAMILIES) == 'aac'
+    assert codec_family('opus', AUDIO_CODEC_FAMILIES) == 'opus'
+
+
+@pytest.mark.parametrize('protocol, family', [
+    ('https', 'http'), (None, 'http'), ('m3u8_native', 'hls'), ('http_dash_segments', 'dash'), ('rtmp', 'rtmp'),
+])
+def test_protocol_families(protocol, family):
+    assert protocol_family(protocol) == family
+
+
+def test_rows_are_normalized(index):
+    # Storyboards are left out
+    assert len(index) == 8
+    row = index.get('22')
+    assert (row.vcodec, row.acodec, row.height, row.protocol) == ('h264', 'aac', 720, 'http')
+    assert row.progressive
+    # Sizes are estimated from the bitrate and duration
+    assert row.filesize == 2000 * 125 * 100
+    assert index.get('137').vcodec == 'h264' and index.get('137').acodec is None
+    assert {row.format_id for row in index.audio_only()} == {'140', '251'}
+
+
+def test_heights_may_be_strings():
+    index = FormatIndex({'formats': [progressive('a', '720p'), progressive('b', 'tall')]})
+    assert [row.height for row in index.formats] == [720, 0]
+
+
+@pytest.mark.parametrize('quality, expected', [
+    ('best', Policy()), ('720p', Policy(max_height=720)), ('worst', Policy(worst=True)),
+])
+def test_policies_for_quality_names(quality, expected):
+    assert Policy.for_quality(quality) == expected
+
+
+def test_higher_resolutions_rank_first_then_codec_preference(index):
+    ranked = FormatIndex.rank_video(index.video_only(), Policy())
+    assert [row.format_id for row in ranked] == ['248', '137', '136', '135']
+    h264_first = Policy().prefer_video_codecs('h264')
+    assert FormatIndex.rank_video(index.video_only(), h264_first)[0].format_id == '137'
+
+
+def test_resolution_limit_falls_back_to_the_lowest_available(index):
+    assert FormatIndex.rank_video(index.video_only(), Policy(max_height=720))[0].format_id == '136'
+    ranked = FormatIndex.rank_video(index.video_only(), Policy(max_height=240))
+    assert [row.format_id for row in ranked] == ['135']
+
+
+def test_merge_pairs_the_best_video_and_audio(index):
+    video_row, audio_row = index.select_merge(Policy(max_height=1080))
+    assert (video_row.format_id, audio_row.format_id) == ('248', '251')
+    assert [row.format_id for row in index.select_merge(Policy(worst=True))] == ['135', '140']
+
+
+def test_select_formats_without_ffmpeg_takes_a_complete_mp4(index):
+    assert [row.format_id for row in select_formats(index, '720p', has_ffmpeg=False)] == ['22']
+    assert [row.format_id for row in select_formats(index, 'worst', has_ffmpeg=False)] == ['18']
+    assert [row.format_id for row in select_formats(index, '1080p', has_ffmpeg=True)] == ['248', '251']
+
+
+def test_videos_without_complete_files_need_ffmpeg(index):
+    separate = FormatIndex({'formats': [video('137', 1080), audio('140')]})
+    with pytest.raises(DownloadError) as raised:
+        select_progressive_format(separate, video_policy('best'))
+    assert raised.value.kind == 'ffmpeg_required'
+    webm_only = FormatIndex({'formats': [progressive('43', 360, ext='webm', vcodec='vp8')]})
+    with pytest.raises(DownloadError) as raised:
+        select_progressive_format(webm_only, video_policy('best'))
+    assert raised.value.kind == 'no_mp4'
+
+
+def test_complete_files_are_used_when_there_are_no_streams():
+    index = FormatIndex({'formats': [progressive('only', 720)]})
+    assert [row.format_id for row in select_formats(index, 'best', has_ffmpeg=True)] == ['only']
+
+
+def test_indexes_are_shared_by_copies_of_an_extraction():
+    assert index_for(dict(INFO)) is index_for(dict(INFO))
+    assert index_for(dict(INFO, epoch=2)) is not index_for(INFO)
+    assert index_for({'formats': []}) is not index_for({'formats': []})
+
+
+MB = 1024 * 1024
+
+
+def test_size_budget_lowers_the_quality(index):
+    # Sizes estimated from the bitrates: 248 36 MB, 137 48 MB, 136 24 MB, 135 12 MB, audio 1.5 MB
+    selected = select_formats(index, 'best', has_ffmpeg=True, max_size=30 * MB)
+    assert [row.format_id for row in selected] == ['136', '251']
+    assert [row.format_id for row in select_formats(index, 'best', True, max_size=1 * MB)] == ['135', '140']
+    assert select_formats(index, 'best', has_ffmpeg=False, max_size=20 * MB)[0].format_id == '18'
+
+
+def test_lowered_quality_is_noted(index):
+    job = Job('tester')
+    _note_budget(job, select_formats(index, 'best', True, 30 * MB), select_formats(index, 'best', True), 30 * MB)
+    assert job.messages == [('info', "📉 Picked 720p instead of 1080p to stay within 30 MB (about 25 MB)")]
+    job = Job('tester')
+    _note_budget(job, select_formats(index, 'best', True), select_formats(index, 'best', True), 30 * MB)
+    assert job.messages == []
+
+
+@pytest.fixture
+def meter(monkeypatch):
+    meter = ThroughputMeter()
+    monkeypatch.setattr(parallel, 'throughput', meter)
+    monkeypatch.setattr(config, 'MAX_DOWNLOAD_MB', 0)
+    monkeypatch.setattr(config, 'TARGET_DOWNLOAD_SECONDS', 0)
+    return meter
+
+
+def test_size_budget_from_a_size_or_a_time(meter, monkeypatch):
+    assert size_budget() is None
+    assert size_budget(max_size_mb=100) == 100 * MB
+    # No measured throughput yet: a target time can't be turned into a size
+    assert size_budget(target_seconds=10) is None
+    meter.record(10 * MB, 1)
+    assert size_budget(target_seconds=10) == 100 * MB
+    assert size_budget(max_size_mb=50, target_seconds=10) == 50 * MB
+    # Configured limits are ceilings
+    monkeypatch.setattr(config, 'MAX_DOWNLOAD_MB', 20)
+    assert size_budget(max_size_mb=100) == 20 * MB
+    assert size_budget() == 20 * MB
+
+
+def test_sections_only_need_their_share_of_the_budget():
+    section = clip_section(25, 75)
+    assert section_share(section, 100) == 0.5
+    assert section_share(section, None) == 1.0
+    assert section_share(None, 100) == 1.0
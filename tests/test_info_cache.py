@@ -0,0 +1,80 @@
+import time
+
+import pytest
+
+from youtube_downloader import info_cache as info_cache_module
+from youtube_downloader.info_cache import EXPIRY_MARGIN, InfoCache, extract_info, info_expiry, video_key
+from youtube_downloader.youtubedl import ScheduledYoutubeDL
+
+
+@pytest.fixture
+def extractions(monkeypatch):
+    """URLs extracted by yt-dlp during the test"""
+    urls = []
+    extract = ScheduledYoutubeDL.extract_info
+
+    def counting_extract(self, url, *args, **kwargs):
+        urls.append(url)
+        return extract(self, url, *args, **kwargs)
+
+    monkeypatch.setattr(ScheduledYoutubeDL, 'extract_info', counting_extract)
+    return urls
+
+
+def test_youtube_urls_share_a_key():
+    assert video_key('https://www.youtube.com/watch?v=dQw4w9WgXcQ&t=10') == 'youtube:dQw4w9WgXcQ'
+    assert video_key(' https://youtu.be/dQw4w9WgXcQ ') == 'youtube:dQw4w9WgXcQ'
+    assert video_key('https://example.com/video.mp4') == 'https://example.com/video.mp4'
+
+
+def test_entries_expire_before_their_format_urls():
+    expires = int(time.time()) + 3600
+    info = {'formats': [{'url': f'https://host/videoplayback?expire={expires}&id=1'}]}
+    assert info_expiry(info, ttl=86400) == expires - EXPIRY_MARGIN
+    assert info_expiry({'formats': []}, ttl=10) == pytest.approx(time.time() + 10, abs=1)
+
+
+def test_cache_returns_private_copies():
+    cache = InfoCache(max_entries=2, ttl=60)
+    cache.put('a', {'title': 'A', 'formats': []})
+    cache.get('a')['title'] = 'changed'
+    assert cache.get('a')['title'] == 'A'
+
+
+def test_least_recently_used_entries_are_evicted():
+    cache = InfoCache(max_entries=2, ttl=60)
+    cache.put('a', {'formats': []})
+    cache.put('b', {'formats': []})
+    cache.get('a')
+    cache.put('c', {'formats': []})
+    assert cache.get('b') is None
+    assert cache.get('a') is not None
+    assert cache.stats()['evictions'] == 1
+
+
+def test_expired_entries_are_misses():
+    cache = InfoCache(max_entries=2, ttl=60)
+    cache.put('a', {'formats': []}, expires=time.time() + 0.05)
+    cache.put('gone', {'formats': []}, expires=time.time() - 1)
+    time.sleep(0.1)
+    assert cache.get('a') is None
+    assert cache.get('gone') is None
+    assert cache.stats()['hits'] == 0
+
+
+def test_info_is_extracted_once(media_server, extractions):
+    url = media_server.url('av.mp4?info-once')
+    first = extract_info(url)
+    second = extract_info(url)
+    assert extractions == [url]
+    assert first == second
+    assert first is not second
+
+
+def test_other_processes_find_extractions_in_the_metadata_store(media_server, extractions):
+    url = media_server.url('av.mp4?stored')
+    extract_info(url)
+    # As in a new process: nothing in memory
+    info_cache_module.info_cache.invalidate()
+    assert extract_info(url)['webpage_url'] == url
+    assert extractions == [url]
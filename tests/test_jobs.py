@@ -0,0 +1,264 @@
+import threading
+import time
+
+import pytest
+
+from youtube_downloader import config, jobs
+from youtube_downloader.jobs import (
+    CANCELLED, DONE, FAILED, QUEUED, RUNNING, Job, JobManager, QueueFull, TooManyJobs,
+)
+from youtube_downloader.progress import ProgressEvent
+from youtube_downloader.state import SQLiteState
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def make_manager(tmp_path, **limits):
+    settings = dict(workers=2, queue_size=10, user_running=2, user_pending=5, retention=60)
+    settings.update(limits)
+    return JobManager(state=SQLiteState(str(tmp_path / 'state.db')), **settings)
+
+
+@pytest.fixture
+def manager(tmp_path):
+    return make_manager(tmp_path)
+
+
+@pytest.fixture
+def release():
+    """Lets the blocking jobs of a test finish"""
+    event = threading.Event()
+    yield event
+    event.set()
+
+
+def blocking(job, release, value=None):
+    """A job that runs until released (or cancelled)"""
+    while not release.wait(0.01):
+        job.check_cancelled()
+    return value
+
+
+def test_job_outcomes():
+    def fail(job):
+        raise ValueError('broken')
+
+    done = Job('user', lambda job, x: x * 2, (21,))
+    done.run()
+    failed = Job('user', fail)
+    failed.run()
+    assert (done.status, done.result) == (DONE, 42)
+    assert (failed.status, failed.error) == (FAILED, 'broken')
+
+
+def test_workers_bound_concurrent_jobs(manager, release):
+    jobs = [manager.submit(f'user{n}', blocking, release) for n in range(3)]
+    wait_until(lambda: manager.stats()['running'] == 2)
+    assert jobs[2].status == QUEUED
+    assert manager.position(jobs[2]) == 1
+    release.set()
+    wait_until(lambda: all(job.status == DONE for job in jobs))
+
+
+def test_users_run_a_limited_number_of_jobs_at_once(tmp_path, release):
+    manager = make_manager(tmp_path, user_running=1)
+    first = manager.submit('user', blocking, release)
+    second = manager.submit('user', blocking, release)
+    other = manager.submit('other', blocking, release)
+    wait_until(lambda: other.status == RUNNING)
+    # A worker is free, but the user already has a job running
+    assert first.status == RUNNING
+    assert second.status == QUEUED
+
+
+def test_users_queue_a_limited_number_of_jobs(tmp_path, release):
+    manager = make_manager(tmp_path, user_pending=2)
+    manager.submit('user', blocking, release)
+    manager.submit('user', blocking, release)
+    with pytest.raises(TooManyJobs):
+        manager.submit('user', blocking, release)
+    manager.submit('other', blocking, release)
+
+
+def test_the_queue_is_bounded(tmp_path, release):
+    manager = make_manager(tmp_path, workers=1, queue_size=1)
+    running = manager.submit('a', blocking, release)
+    wait_until(lambda: running.status == RUNNING)
+    manager.submit('b', blocking, release)
+    with pytest.raises(QueueFull):
+        manager.submit('c', blocking, release)
+
+
+def test_cancelling_a_queued_job_drops_it(tmp_path, release):
+    manager = make_manager(tmp_path, workers=1)
+    running = manager.submit('a', blocking, release)
+    queued = manager.submit('b', blocking, release)
+    assert manager.cancel(queued.id, 'b')
+    assert queued.status == CANCELLED
+    assert manager.position(queued) == 0
+    release.set()
+    wait_until(lambda: running.status == DONE)
+    assert queued.started is None
+
+
+def test_cancelling_a_running_job_stops_it(manager, release):
+    job = manager.submit('user', blocking, release)
+    wait_until(lambda: job.status == RUNNING)
+    # Only the users who submitted or joined a job can cancel it
+    assert not manager.cancel(job.id, 'someone else')
+    assert manager.cancel(job.id, 'user')
+    wait_until(lambda: job.status == CANCELLED)
+
+
+def test_jobs_are_found_by_id(manager):
+    job = manager.submit('user', lambda job: 'ok')
+    wait_until(lambda: job.status == DONE)
+    assert manager.get(job.id) is job
+    assert manager.get('unknown') is None
+
+
+def test_identical_jobs_run_once(manager, release):
+    calls = []
+
+    def download(job, release):
+        calls.append(job.id)
+        return blocking(job, release, 'file')
+
+    first = manager.submit('a', download, release, key='video')
+    second = manager.submit('b', download, release, key='video')
+    assert second is first
+    assert first.waiters == {'a', 'b'}
+    release.set()
+    wait_until(lambda: first.status == DONE and manager.stats()['running'] == 0)
+    assert calls == [first.id]
+    # Once finished, the key starts a new job
+    assert manager.submit('a', download, release, key='video') is not first
+
+
+def test_a_joined_job_runs_until_every_waiter_cancels(manager, release):
+    job = manager.submit('a', blocking, release, key='video')
+    manager.submit('b', blocking, release, key='video')
+    wait_until(lambda: job.status == RUNNING)
+    assert not manager.cancel(job.id, 'a')
+    assert not job.cancelled
+    assert manager.cancel(job.id, 'b')
+    wait_until(lambda: job.status == CANCELLED)
+
+
+def test_users_at_their_limit_can_join_running_jobs(tmp_path, release):
+    manager = make_manager(tmp_path, user_pending=1)
+    shared = manager.submit('a', blocking, release, key='video')
+    manager.submit('b', blocking, release, key='other')
+    assert manager.submit('b', blocking, release, key='video') is shared
+    with pytest.raises(TooManyJobs):
+        manager.submit('b', blocking, release, key='third')
+
+
+def reporting(job, release):
+    """A blocking job that reports progress, which is when it hears of other replicas' cancellations"""
+    while not release.wait(0.01):
+        job.publish_progress(ProgressEvent('downloading', 'downloading'))
+        job.check_cancelled()
+
+
+def test_identical_jobs_of_other_replicas_are_joined(tmp_path, release, monkeypatch):
+    monkeypatch.setattr(jobs, 'PUBLISH_INTERVAL', 0)
+    shared = SQLiteState(str(tmp_path / 'state.db'))
+    settings = dict(workers=2, queue_size=10, user_running=2, user_pending=5, retention=60)
+    here, there = JobManager(state=shared, **settings), JobManager(state=shared, **settings)
+    job = here.submit('a', reporting, release, key='video')
+    wait_until(lambda: job.status == RUNNING)
+
+    copy = there.submit('b', reporting, release, key='video')
+    assert copy.id == job.id
+    assert copy.remote is not None
+    assert there.stats()['jobs'] == 0
+    # 'b' still waits on it, from the other replica
+    assert not here.cancel(job.id, 'a')
+    assert not there.cancel(job.id, 'b')
+    wait_until(lambda: job.status == CANCELLED)
+    assert there.get(job.id).status == CANCELLED
+
+
+def test_jobs_of_stopped_replicas_are_failed(tmp_path, release):
+    shared = SQLiteState(str(tmp_path / 'state.db'))
+    manager = JobManager(state=shared, workers=1, queue_size=10, user_running=1, user_pending=5, retention=60)
+    job = manager.submit('a', blocking, release, key='video')
+    wait_until(lambda: job.status == RUNNING)
+    shared.delete(f'replica:{config.REPLICA_ID}')
+    other = JobManager(state=shared, workers=1, queue_size=10, user_running=1, user_pending=5, retention=60)
+    assert other.get(job.id).status == FAILED
+    # and aren't joined: the key starts a new job
+    assert other.submit('b', blocking, release, key='video').id != job.id
+
+
+def run_in_thread(target, *args, **kwargs):
+    """Start target(*args, **kwargs) in a thread; the returned list receives its result"""
+    result = []
+    threading.Thread(target=lambda: result.append(target(*args, **kwargs)), daemon=True).start()
+    return result
+
+
+def test_sub_tasks_share_the_worker_slots(manager, release):
+    running = manager.submit('a', blocking, release)
+    wait_until(lambda: running.status == RUNNING)
+    batch = Job('b')
+    children = [run_in_thread(manager.run_child, batch, blocking, release, n) for n in range(2)]
+    wait_until(lambda: sum(job.status == RUNNING for job in manager._jobs.values()) == 2)
+    # Only one of the sub-tasks got the free slot
+    time.sleep(0.1)
+    assert sum(job.status == RUNNING for job in manager._jobs.values()) == 2
+    release.set()
+    wait_until(lambda: all(children))
+    assert sorted(child[0].result for child in children) == [0, 1]
+
+
+def test_a_job_lends_its_slot_to_its_sub_tasks(tmp_path):
+    manager = make_manager(tmp_path, workers=1)
+
+    def run_batch(job):
+        with manager.lend_slot(job):
+            return [manager.run_child(job, lambda child, n: n * 2, n).result for n in range(3)]
+
+    job = manager.submit('user', run_batch)
+    wait_until(lambda: job.status == DONE)
+    assert job.result == [0, 2, 4]
+    assert manager._busy == 0
+
+
+def test_sub_tasks_join_identical_jobs(manager, release):
+    job = manager.submit('a', blocking, release, 'file', key='video')
+    batch = Job('b')
+    child = run_in_thread(manager.run_child, batch, blocking, release, key='video')
+    wait_until(lambda: f'b:{batch.id}' in job.waiters)
+    # and submissions join the sub-tasks
+    other = run_in_thread(manager.run_child, batch, blocking, release, 'other file', key='other')
+    wait_until(lambda: len(manager._jobs) == 2)
+    joined = manager.submit('c', blocking, release, key='other')
+    assert joined.waiters == {f'b:{batch.id}', 'c'}
+    release.set()
+    wait_until(lambda: child and other)
+    assert child[0] is job
+    assert job.result == 'file'
+    assert other[0] is joined
+    assert joined.result == 'other file'
+
+
+def test_sub_tasks_are_cancelled_with_their_parent(manager, release):
+    batch = Job('b')
+    child = run_in_thread(manager.run_child, batch, reporting, release, key='video')
+    wait_until(lambda: any(job.status == RUNNING for job in manager._jobs.values()))
+    job, = manager._jobs.values()
+    # A user who joined keeps it running
+    assert manager.submit('c', reporting, release, key='video') is job
+    batch._cancel_event.set()
+    wait_until(lambda: f'b:{batch.id}' not in job.waiters)
+    assert job.status == RUNNING
+    assert manager.cancel(job.id, 'c')
+    wait_until(lambda: child)
+    assert child[0].status == CANCELLED
@@ -0,0 +1,98 @@
+import os
+import threading
+
+import pytest
+
+from benchmarks.http_server import MediaServer
+from youtube_downloader.parallel import ParallelYoutubeDL
+
+
+@pytest.fixture(scope='module')
+def slow_server(media_dir):
+    with MediaServer(media_dir, rate=512 * 1024) as server:
+        yield server
+
+
+def info_dict(server):
+    """Separate video and audio formats, as YouTube lists them"""
+    return {
+        'id': 'merge',
+        'title': 'merge',
+        'webpage_url': server.url('page'),
+        'extractor': 'generic',
+        'extractor_key': 'Generic',
+        'formats': [
+            {'format_id': 'v', 'url': server.url('video.mp4'), 'ext': 'mp4', 'vcodec': 'avc1.64001f',
+             'acodec': 'none', 'height': 720, 'protocol': 'http'},
+            # The audio of av.mp4: as large as the video, so the two downloads can't miss each other
+            {'format_id': 'a', 'url': server.url('av.mp4'), 'ext': 'm4a', 'vcodec': 'none',
+             'acodec': 'mp4a.40.2', 'protocol': 'http'},
+        ],
+    }
+
+
+class StreamLog:
+    """Progress hook recording when each stream downloaded"""
+
+    def __init__(self):
+        self.events = []
+        self._lock = threading.Lock()
+
+    def __call__(self, d):
+        with self._lock:
+            self.events.append((d['info_dict']['format_id'], d['status']))
+
+    def overlapped(self):
+        """Return True if one stream was still downloading after the other had started"""
+        first = self.events[0][0]
+        other_started = next(i for i, (stream, _) in enumerate(self.events) if stream != first)
+        first_finished = self.events.index((first, 'finished'))
+        return other_started < first_finished
+
+
+class RecordingPP:
+    """A live postprocessor recording the files its hooks were called for"""
+
+    def __init__(self):
+        self.seen = {}
+        self.detached = []
+
+    def attach(self, filename, info_dict):
+        seen = self.seen.setdefault(info_dict['format_id'], set())
+        return lambda d: seen.add(d['info_dict']['format_id'])
+
+    def detach(self, filename, success):
+        self.detached.append(success)
+
+    def abort_all(self):
+        pass
+
+
+def merge(server, tmp_path, parallel_streams=True, live=()):
+    log = StreamLog()
+    opts = {'quiet': True, 'no_warnings': True, 'noprogress': True, 'outtmpl': str(tmp_path / '%(id)s.%(ext)s'),
+            'format': 'v+a', 'merge_output_format': 'mp4', 'parallel_streams': parallel_streams,
+            'range_connections': 1, 'progress_hooks': [log]}
+    with ParallelYoutubeDL(opts) as ydl:
+        ydl.live_postprocessors.extend(live)
+        hooks = list(ydl._progress_hooks)
+        info = ydl.process_ie_result(info_dict(server), download=True)
+        # Per-stream hooks never leak into the instance's own
+        assert ydl._progress_hooks == hooks
+    assert os.path.getsize(info['requested_downloads'][0]['filepath']) > 0
+    return log
+
+
+def test_streams_download_side_by_side(slow_server, tmp_path):
+    assert merge(slow_server, tmp_path).overlapped()
+
+
+def test_streams_download_one_after_the_other_when_disabled(slow_server, tmp_path):
+    assert not merge(slow_server, tmp_path, parallel_streams=False).overlapped()
+
+
+def test_live_postprocessors_only_see_their_own_stream(slow_server, tmp_path):
+    pp = RecordingPP()
+    merge(slow_server, tmp_path, live=[pp])
+    assert pp.seen == {'v': {'v'}, 'a': {'a'}}
+    assert pp.detached == [True, True]
@@ -0,0 +1,114 @@
+import time
+
+import pytest
+
+from youtube_downloader.info_cache import video_metadata
+from youtube_downloader.metadata import MetadataStore, metadata_store
+from youtube_downloader.youtubedl import ScheduledYoutubeDL
+
+
+def info(video_id='abc', **fields):
+    return dict({
+        'id': video_id,
+        'extractor_key': 'Youtube',
+        'title': 'A video',
+        'duration': 60,
+        'uploader': 'someone',
+        'view_count': 10,
+        'formats': [{'height': 360}, {'height': 1080}, {'acodec': 'opus'}],
+    }, **fields)
+
+
+@pytest.fixture
+def store(tmp_path):
+    return MetadataStore(str(tmp_path / 'metadata.db'), ttl=60)
+
+
+def test_the_database_is_created_on_first_use(tmp_path):
+    path = tmp_path / 'data' / 'metadata.db'
+    store = MetadataStore(str(path), ttl=60)
+    assert not path.exists()
+    assert store.get('unknown') is None
+    assert path.exists()
+
+
+def test_stored_fields_are_found(store):
+    store.put('youtube:abc', info())
+    fields = store.get('youtube:abc')
+    assert (fields['title'], fields['uploader'], fields['duration']) == ('A video', 'someone', 60)
+    assert (fields['format_count'], fields['max_height']) == (3, 1080)
+    assert not fields['stale']
+    assert store.get('youtube:other') is None
+    assert (store.stats()['hits'], store.stats()['misses']) == (1, 1)
+
+
+def test_volatile_fields_go_stale_after_the_ttl(tmp_path):
+    store = MetadataStore(str(tmp_path / 'metadata.db'), ttl=0.05)
+    store.put('youtube:abc', info())
+    time.sleep(0.1)
+    assert store.get('youtube:abc')['stale']
+    store.put('youtube:abc', info())
+    assert not store.get('youtube:abc')['stale']
+
+
+def test_a_refresh_keeps_the_stable_fields_it_did_not_get(store):
+    store.put('youtube:abc', info())
+    store.put('youtube:abc', info(title=None, view_count=20, formats=[]))
+    fields = store.get('youtube:abc')
+    assert fields['title'] == 'A video'
+    assert (fields['view_count'], fields['format_count'], fields['max_height']) == (20, 0, None)
+
+
+def test_info_dicts_are_served_until_their_urls_expire(store):
+    store.put('youtube:abc', info(), info_expires=time.time() + 0.05)
+    stored, expires = store.get_info('youtube:abc')
+    assert stored == info()
+    time.sleep(0.1)
+    assert store.get_info('youtube:abc') is None
+    # Without an expiry nothing but the fields is kept
+    store.put('youtube:def', info('def'))
+    assert store.get_info('youtube:def') is None
+    assert store.get('youtube:def') is not None
+
+
+def test_rows_and_search(store):
+    store.put('youtube:a', info('a', duration=30))
+    store.put('youtube:b', info('b', duration=300, formats=[{'height': 480}]))
+    store.put('youtube:c', info('c', uploader='other'))
+    assert set(store.rows(['youtube:a', 'youtube:c', 'youtube:missing', 'youtube:a'])) == {'youtube:a', 'youtube:c'}
+    assert [row['key'] for row in store.search(uploader='someone', max_duration=100)] == ['youtube:a']
+    assert [row['key'] for row in store.search(min_height=720, limit=1)] == ['youtube:c']
+    assert store.stats()['entries'] == 3
+
+
+@pytest.fixture
+def extractions(monkeypatch):
+    """The URLs extracted during the test"""
+    urls = []
+    extract = ScheduledYoutubeDL.extract_info
+
+    def counting_extract(self, url, *args, **kwargs):
+        urls.append(url)
+        return extract(self, url, *args, **kwargs)
+
+    monkeypatch.setattr(ScheduledYoutubeDL, 'extract_info', counting_extract)
+    return urls
+
+
+def test_known_videos_are_answered_without_extracting(media_server, extractions):
+    url = media_server.url('av.mp4?metadata')
+    first = video_metadata(url)
+    second = video_metadata(url)
+    assert first['webpage_url'] == url
+    assert second['title'] == first['title']
+    assert extractions == [url]
+
+
+def test_stale_fields_are_extracted_again(media_server, extractions, monkeypatch):
+    url = media_server.url('av.mp4?stale')
+    first = video_metadata(url)
+    monkeypatch.setattr(metadata_store, 'ttl', 0)
+    # The extraction is still cached, but the refresh doesn't use it
+    second = video_metadata(url)
+    assert extractions == [url, url]
+    assert second['fetched'] > first['fetched']
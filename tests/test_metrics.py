@@ -0,0 +1,104 @@
+import json
+import logging
+
+import pytest
+
+from youtube_downloader import metrics
+from youtube_downloader.download import run_download
+from youtube_downloader.jobs import Job
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    """An empty set of metrics for render(), so the pipeline's own don't get in the way"""
+    monkeypatch.setattr(metrics, '_metrics', [])
+    monkeypatch.setattr(metrics, '_caches', {})
+
+
+def test_counters_add_up_per_label(registry):
+    counter = metrics.Counter('test_total', 'Test', ['kind'])
+    counter.inc(kind='a')
+    counter.inc(2, kind='a')
+    assert counter.get(kind='a') == 3
+    assert counter.get(kind='b') == 0
+    with pytest.raises(ValueError):
+        counter.inc(other='a')
+
+
+def test_histograms_count_into_cumulative_buckets(registry):
+    histogram = metrics.Histogram('test_seconds', 'Test', buckets=(1, 5))
+    for value in (0.5, 1, 3, 10):
+        histogram.observe(value)
+    assert histogram.get() == (4, 14.5)
+    assert metrics.render().splitlines()[2:] == [
+        'test_seconds_bucket{le="1"} 2',
+        'test_seconds_bucket{le="5"} 3',
+        'test_seconds_bucket{le="+Inf"} 4',
+        'test_seconds_sum 14.5',
+        'test_seconds_count 4',
+    ]
+
+
+def test_exposition_format(registry):
+    gauge = metrics.Gauge('test_gauge', 'A "gauge"', ['path'])
+    gauge.set(1.5, path='a\\b"c')
+    assert metrics.render() == (
+        '# HELP test_gauge A "gauge"\n'
+        '# TYPE test_gauge gauge\n'
+        'test_gauge{path="a\\\\b\\"c"} 1.5\n'
+    )
+
+
+def test_collected_metrics_are_read_at_scrape_time(registry):
+    values = {('a',): 1}
+    metrics.Gauge('test_broken', 'Test', collect=lambda: 1 / 0)
+    metrics.Gauge('test_collected', 'Test', ['name'], collect=lambda: values)
+    values[('a',)] = 2
+    lines = metrics.render().splitlines()
+    # A failing callback only loses its own samples
+    assert 'test_collected{name="a"} 2' in lines
+    assert not [line for line in lines if line.startswith('test_broken')]
+
+
+def test_cache_stats_become_hit_ratios(monkeypatch):
+    monkeypatch.setattr(metrics, '_caches', {})
+
+    class Cache:
+        def stats(self):
+            return {'hits': 3, 'misses': 1}
+
+    metrics.register_cache('test', Cache())
+    assert metrics._cache_requests() == {('test', 'hit'): 3, ('test', 'miss'): 1}
+    assert metrics._cache_hit_ratio() == {('test',): 0.75}
+
+
+@pytest.mark.parametrize('message, kind, category', [
+    ('Read timed out', None, 'timeout'),
+    ('ffprobe exited with 1', None, 'ffmpeg'),
+    ('Requested format is not available', None, 'format'),
+    ('Connection reset by peer', None, 'network'),
+    ('Something else', None, 'other'),
+    ('FFmpeg is needed', 'ffmpeg_required', 'ffmpeg_required'),
+])
+def test_error_categories(message, kind, category):
+    assert metrics.classify_error(message, kind) == category
+
+
+def test_downloads_are_counted_timed_and_logged(media_server, caplog):
+    done = metrics.downloads.get(outcome='done')
+    total = metrics.phase_seconds.get(phase='total')[0]
+    with caplog.at_level(logging.INFO, logger='youtube_downloader.spans'):
+        run_download(Job('tester'), media_server.url('av.mp4?metrics'), 'video', 'best', True)
+    assert metrics.downloads.get(outcome='done') == done + 1
+    assert metrics.phase_seconds.get(phase='total')[0] == total + 1
+    [span] = [json.loads(record.message) for record in caplog.records if record.name == 'youtube_downloader.spans']
+    assert span['span'] == 'download'
+    assert span['outcome'] == 'done'
+    assert span['timings']['total'] > 0
+
+
+def test_failures_are_counted_by_category(media_server):
+    failed = metrics.downloads.get(outcome='failed')
+    with pytest.raises(Exception):
+        run_download(Job('tester'), media_server.url('missing.mp4'), 'video', 'best', True, retry_count=0)
+    assert metrics.downloads.get(outcome='failed') == failed + 1
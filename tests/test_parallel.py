@@ -0,0 +1,157 @@
+import json
+import os
+
+import pytest
+
+from benchmarks.http_server import MediaServer
+from youtube_downloader import config, parallel
+from youtube_downloader.parallel import (
+    MIN_SEGMENT_SIZE, ConnectionTuner, ParallelHttpFD, ParallelYoutubeDL, ThroughputMeter, ranges_downloaded,
+)
+
+SIZE = 2 * 1024 * 1024 + 12345
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture(scope='module')
+def blob_dir(tmp_path_factory):
+    root = tmp_path_factory.mktemp('blob')
+    (root / 'blob.bin').write_bytes(os.urandom(SIZE))
+    return root
+
+
+@pytest.fixture(scope='module')
+def server(blob_dir):
+    with MediaServer(str(blob_dir)) as server:
+        yield server
+
+
+@pytest.fixture(scope='module')
+def no_range_server(blob_dir):
+    with MediaServer(str(blob_dir), ranges=False) as server:
+        yield server
+
+
+def download(server, target, connections=2, events=None):
+    """Download blob.bin with ParallelHttpFD into target"""
+    ydl = ParallelYoutubeDL({'quiet': True, 'range_connections': connections})
+    fd = ParallelHttpFD(ydl, ydl.params)
+    if events is not None:
+        fd.add_progress_hook(events.append)
+    info = {'url': server.url('blob.bin'), 'http_headers': {}, 'ext': 'bin'}
+    assert fd.real_download(str(target), info)
+
+
+def segment_size(connections=2):
+    # As ParallelHttpFD lays the file out
+    return max(MIN_SEGMENT_SIZE, min(config.DOWNLOAD_CHUNK_MB * 1024 * 1024, SIZE // (connections * 2)))
+
+
+def test_segments_are_reassembled(server, blob_dir, tmp_path):
+    events = []
+    download(server, tmp_path / 'out.bin', connections=3, events=events)
+    assert (tmp_path / 'out.bin').read_bytes() == (blob_dir / 'blob.bin').read_bytes()
+    assert not os.path.exists(tmp_path / 'out.bin.part-ranges')
+    assert events[-1]['status'] == 'finished'
+
+
+def test_contiguous_bytes_only_count_the_finished_prefix(server, tmp_path):
+    events = []
+    download(server, tmp_path / 'out.bin', events=events)
+    progress = [event for event in events if event['status'] == 'downloading']
+    contiguous = [event['contiguous_bytes'] for event in progress]
+    assert contiguous == sorted(contiguous)
+    assert all(event['contiguous_bytes'] <= event['downloaded_bytes'] for event in progress)
+    assert all(value % segment_size() == 0 or value == SIZE for value in contiguous)
+
+
+def test_finished_segments_are_not_downloaded_again(server, blob_dir, tmp_path):
+    size = segment_size()
+    target = tmp_path / 'out.bin'
+    # An earlier attempt finished the first two segments (marked so we can tell them apart)
+    with open(f'{target}.part-ranges', 'wb') as f:
+        f.truncate(SIZE)
+        f.write(b'R' * 2 * size)
+    with open(f'{target}.part-ranges.json', 'w') as f:
+        json.dump({'total': SIZE, 'segment_size': size, 'done': [0, 1]}, f)
+    assert ranges_downloaded(f'{target}.part-ranges') == 2 * size
+
+    events = []
+    download(server, target, events=events)
+    data = target.read_bytes()
+    assert data[:2 * size] == b'R' * 2 * size
+    assert data[2 * size:] == (blob_dir / 'blob.bin').read_bytes()[2 * size:]
+    first = next(event for event in events if event['status'] == 'downloading')
+    assert first['downloaded_bytes'] >= 2 * size
+    assert first['contiguous_bytes'] >= 2 * size
+
+
+def test_state_of_another_layout_starts_over(server, blob_dir, tmp_path):
+    target = tmp_path / 'out.bin'
+    with open(f'{target}.part-ranges', 'wb') as f:
+        f.write(b'R' * SIZE)
+    with open(f'{target}.part-ranges.json', 'w') as f:
+        json.dump({'total': SIZE, 'segment_size': 12345, 'done': [0, 1, 2]}, f)
+    download(server, target)
+    assert target.read_bytes() == (blob_dir / 'blob.bin').read_bytes()
+
+
+def test_servers_without_ranges_get_one_connection(no_range_server, blob_dir, tmp_path):
+    download(no_range_server, tmp_path / 'out.bin')
+    assert (tmp_path / 'out.bin').read_bytes() == (blob_dir / 'blob.bin').read_bytes()
+
+
+def test_climb_doubles_connections_while_throughput_grows(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(parallel, 'time', clock)
+    climb = parallel._Climb(2, limit=16)
+    assert climb.update(0) == 0
+    clock.now = 1
+    assert climb.update(100) == 2
+    clock.now = 2
+    # Throughput doubled with twice the connections
+    assert climb.update(300) == 4
+    clock.now = 3
+    # A gain below TUNE_MIN_GAIN: settle on the count that last paid off
+    assert climb.update(500) == 0
+    assert climb.plateaued
+    assert (climb.connections, climb.best) == (8, 4)
+    clock.now = 4
+    assert climb.update(10 ** 9) == 0
+
+
+def test_climb_stops_at_the_limit(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(parallel, 'time', clock)
+    climb = parallel._Climb(2, limit=3)
+    clock.now = 1
+    assert climb.update(100) == 1
+    assert climb.settled
+    assert not climb.plateaued
+
+
+def test_tuner_remembers_the_best_count_per_host():
+    tuner = ConnectionTuner(max_connections=8, start=2)
+    assert tuner.initial('a') == 2
+    tuner.record('a', 6)
+    tuner.record('b', 100)
+    assert tuner.initial('a') == 6
+    assert tuner.initial('b') == 8
+    # Unknown hosts start with the most recent result
+    assert tuner.initial('c') == 8
+
+
+def test_throughput_ignores_small_downloads():
+    meter = ThroughputMeter(weight=0.5)
+    meter.record(1000, 10)
+    assert meter.estimate() is None
+    meter.record(4 * 1024 * 1024, 1)
+    meter.record(2 * 1024 * 1024, 1)
+    assert meter.estimate() == 3 * 1024 * 1024
@@ -0,0 +1,106 @@
+import threading
+import time
+
+import pytest
+
+from youtube_downloader import prefetch, ratelimit
+from youtube_downloader.download import request_key
+from youtube_downloader.jobs import CANCELLED, DONE, RUNNING, JobManager
+from youtube_downloader.prefetch import Prefetcher
+from youtube_downloader.progress import ProgressEvent
+from youtube_downloader.state import SQLiteState
+
+REQUEST = {'url': 'https://www.youtube.com/watch?v=dQw4w9WgXcQ', 'mode': 'video', 'quality': 'best',
+           'has_ffmpeg': True}
+KEY = request_key(REQUEST)
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def manager(tmp_path, monkeypatch):
+    manager = JobManager(state=SQLiteState(str(tmp_path / 'state.db')), workers=2, queue_size=10, user_running=2,
+                         user_pending=5, retention=60)
+    monkeypatch.setattr(prefetch, 'job_manager', manager)
+    return manager
+
+
+@pytest.fixture
+def release(monkeypatch):
+    """Stands in for run_download: reports total_bytes (if set) and runs until released"""
+    event = threading.Event()
+    event.total_bytes = None
+
+    def download(job, **request):
+        if event.total_bytes:
+            job.publish_progress(ProgressEvent('downloading', 'downloading', 10, event.total_bytes))
+        while not event.wait(0.01):
+            job.check_cancelled()
+        return 'file'
+
+    monkeypatch.setattr(prefetch, 'run_download', download)
+    yield event
+    event.set()
+
+
+def test_nothing_is_prefetched_without_a_budget(manager, release):
+    assert Prefetcher(0, 60).start('session', REQUEST) is None
+
+
+def test_a_prefetch_is_a_bulk_job_handed_over_to_the_download(manager, release):
+    prefetcher = Prefetcher(1024 * 1024, 60)
+    job = prefetcher.start('session', REQUEST)
+    assert job.priority == ratelimit.BULK
+    # Asking again (a rerun) doesn't start another
+    assert prefetcher.start('session', REQUEST) is job
+    wait_until(lambda: job.status == RUNNING)
+
+    download = manager.submit('user', prefetch.run_download, key=KEY, **REQUEST)
+    assert download is job
+    assert job.priority == ratelimit.NORMAL
+    assert prefetcher.claim('session', KEY)
+    # The prefetch let go of the job, which keeps running for the user
+    assert job.waiters == {'user'}
+    release.set()
+    wait_until(lambda: job.status == DONE)
+    assert (prefetcher.stats()['hits'], prefetcher.stats()['entries']) == (1, 0)
+    assert not prefetcher.claim('session', KEY)
+
+
+def test_changed_settings_drop_the_prefetch(manager, release):
+    prefetcher = Prefetcher(1024 * 1024, 60)
+    job = prefetcher.start('session', REQUEST)
+    prefetcher.keep('session', KEY)
+    assert prefetcher.stats()['entries'] == 1
+    prefetcher.keep('session', request_key(dict(REQUEST, quality='720p')))
+    wait_until(lambda: job.status == CANCELLED)
+    assert prefetcher.stats()['misses'] == 1
+
+
+def test_prefetches_only_take_idle_workers(manager, release):
+    for n in range(2):
+        manager.submit(f'user{n}', lambda job: release.wait())
+    assert Prefetcher(1024 * 1024, 60).start('session', REQUEST) is None
+
+
+def test_prefetches_over_the_budget_are_dropped(manager, release):
+    release.total_bytes = 2000
+    prefetcher = Prefetcher(1000, 60)
+    job = prefetcher.start('session', REQUEST)
+    wait_until(lambda: job.status == CANCELLED)
+    assert prefetcher.stats()['entries'] == 0
+    assert not prefetcher.claim('session', KEY)
+
+
+def test_unclaimed_prefetches_expire(manager, release):
+    prefetcher = Prefetcher(1024 * 1024, 0.05)
+    job = prefetcher.start('session', REQUEST)
+    time.sleep(0.1)
+    prefetcher.keep('other session', KEY)
+    wait_until(lambda: job.status == CANCELLED)
+    assert prefetcher.stats()['entries'] == 0
@@ -0,0 +1,75 @@
+from youtube_downloader.download import run_download
+from youtube_downloader.jobs import Job
+from youtube_downloader.progress import ProgressEvent, ProgressReporter, format_timings
+
+
+def hook(format_id, downloaded, total, speed=None, status='downloading', **fields):
+    return dict(fields, status=status, info_dict={'format_id': format_id}, downloaded_bytes=downloaded,
+                total_bytes=total, speed=speed)
+
+
+def test_fraction():
+    assert ProgressEvent('downloading', 'downloading', downloaded_bytes=25, total_bytes=100).fraction == 0.25
+    assert ProgressEvent('downloading', 'downloading', fragment_index=3, fragment_count=4).fraction == 0.75
+    assert ProgressEvent('downloading', 'downloading', downloaded_bytes=25).fraction is None
+    assert ProgressEvent('merging', 'finished').fraction == 1.0
+    assert ProgressEvent('batch', 'downloading', items_done=1, items_total=4).fraction == 0.25
+
+
+def test_describe():
+    event = ProgressEvent('downloading', 'downloading', downloaded_bytes=1024 * 1024, total_bytes=4 * 1024 * 1024,
+                          speed=512 * 1024, eta=75, stream_count=2)
+    assert event.describe() == "Downloading 2 streams: 1.0 MB of 4.0 MB, 0.50 MB/s, ETA 1:15"
+    assert ProgressEvent('batch', 'downloading').describe() == "Expanding playlist..."
+    assert ProgressEvent('merging', 'started').describe() == "Merging video and audio..."
+
+
+def test_streams_are_reported_as_one_download():
+    events = []
+    reporter = ProgressReporter(events.append, interval=0)
+    reporter.progress_hook(hook('video', 100, 1000, speed=10))
+    reporter.progress_hook(hook('audio', 50, 200, speed=5))
+    event = events[-1]
+    assert (event.downloaded_bytes, event.total_bytes, event.speed) == (150, 1200, 15)
+    assert (event.stream_index, event.stream_count) == (1, 2)
+    assert event.eta == (1200 - 150) / 15
+
+    reporter.progress_hook(hook('audio', 200, 200, status='finished'))
+    assert events[-1].status == 'downloading'
+    assert events[-1].stream_index == 2
+    reporter.progress_hook(hook('video', 1000, 1000, status='finished'))
+    assert events[-1].status == 'finished'
+    assert reporter.downloaded_bytes == 1200
+    assert 'downloading' in reporter.timings
+
+
+def test_updates_are_throttled_but_phase_changes_are_not():
+    events = []
+    reporter = ProgressReporter(events.append, interval=60)
+    for downloaded in range(0, 1000, 100):
+        reporter.progress_hook(hook('video', downloaded, 1000))
+    reporter.progress_hook(hook('video', 1000, 1000, status='finished'))
+    reporter.postprocessor_hook({'status': 'started', 'postprocessor': 'Merger'})
+    reporter.postprocessor_hook({'status': 'finished', 'postprocessor': 'Merger'})
+    assert [(event.phase, event.status) for event in events] == [
+        ('downloading', 'downloading'),
+        ('downloading', 'finished'),
+        ('merging', 'started'),
+        ('merging', 'finished'),
+    ]
+    assert set(reporter.timings) == {'downloading', 'merging'}
+
+
+def test_format_timings():
+    assert format_timings({'downloading': 1.25, 'merging': 0.5}) == "Downloading 1.2s, Merging video and audio 0.5s"
+
+
+def test_downloads_report_progress(media_server):
+    job = Job('tester')
+    events = []
+    job.subscribe(events.append)
+    result = run_download(job, media_server.url('av.mp4?progress'), 'video', 'best', True)
+    downloads = [event for event in events if event.phase == 'downloading']
+    assert downloads[-1].status == 'finished'
+    assert downloads[-1].downloaded_bytes == result['file_size']
+    assert 'downloading' in result['timings']
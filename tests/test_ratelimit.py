@@ -0,0 +1,166 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from youtube_downloader import config, ratelimit, youtubedl
+from youtube_downloader.ratelimit import (
+    BULK, INTERACTIVE, MIN_RATE, NORMAL, RECOVERY_STEP, HostScheduler, host_of, parse_retry_after,
+)
+from youtube_downloader.youtubedl import ScheduledYoutubeDL
+
+URL = 'https://media.example.com/video.mp4'
+
+
+@pytest.fixture
+def no_jitter(monkeypatch):
+    """Backoffs last their full length"""
+    monkeypatch.setattr(ratelimit.random, 'uniform', lambda low, high: high)
+
+
+def test_host_of():
+    assert host_of('https://Media.Example.com:8443/a?b=c') == 'media.example.com'
+    assert host_of('not a url') == ''
+
+
+def test_parse_retry_after():
+    assert parse_retry_after('3') == 3.0
+    assert parse_retry_after('-1') == 0.0
+    assert parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT') is None
+    assert parse_retry_after(None) is None
+
+
+def test_a_rested_host_takes_a_burst_then_the_rate():
+    scheduler = HostScheduler(rate=20, burst=2, backoff_max=10)
+    assert scheduler.acquire(URL) < 0.01
+    assert scheduler.acquire(URL) < 0.01
+    # The bucket is empty: the next token comes 1/20 s later
+    assert scheduler.acquire(URL) == pytest.approx(0.05, abs=0.03)
+    # Other hosts have buckets of their own
+    assert scheduler.acquire('https://other.example.com/') < 0.01
+
+
+def test_a_rate_of_zero_disables_the_limit():
+    scheduler = HostScheduler(rate=0, burst=1, backoff_max=10)
+    started = time.monotonic()
+    for _ in range(50):
+        scheduler.acquire(URL)
+    assert time.monotonic() - started < 0.1
+
+
+def test_waiting_requests_go_out_by_priority():
+    scheduler = HostScheduler(rate=20, burst=1, backoff_max=10)
+    scheduler.backoff(URL, 'test', retry_after=0.3)
+    order = []
+
+    def request(priority):
+        scheduler.acquire(URL, priority)
+        order.append(priority)
+
+    threads = []
+    for priority in (BULK, NORMAL, INTERACTIVE):
+        thread = threading.Thread(target=request, args=(priority,))
+        thread.start()
+        threads.append(thread)
+        time.sleep(0.02)
+    assert scheduler.stats()[host_of(URL)]['waiting'] == 3
+    for thread in threads:
+        thread.join(5)
+    assert order == [INTERACTIVE, NORMAL, BULK]
+
+
+def test_backoffs_double_up_to_the_maximum(no_jitter):
+    scheduler = HostScheduler(rate=8, burst=1, backoff_max=3)
+    assert [scheduler.backoff(URL, 'test') for _ in range(4)] == [1, 2, 3, 3]
+    # A success ends the streak
+    scheduler.success(URL)
+    assert scheduler.backoff(URL, 'test') == 1
+
+
+def test_backoffs_last_at_least_the_retry_after(no_jitter):
+    scheduler = HostScheduler(rate=8, burst=1, backoff_max=10)
+    assert scheduler.backoff(URL, 'test', retry_after=4) == 4
+    # but no longer than the maximum
+    assert scheduler.backoff('https://other.example.com/', 'test', retry_after=60) == 10
+
+
+def test_backed_off_hosts_wait(no_jitter, monkeypatch):
+    monkeypatch.setattr(ratelimit, 'BACKOFF_BASE', 0.1)
+    scheduler = HostScheduler(rate=0, burst=1, backoff_max=10)
+    scheduler.backoff(URL, 'test')
+    assert scheduler.stats()[host_of(URL)]['backoff'] > 0
+    assert scheduler.acquire(URL) == pytest.approx(0.1, abs=0.05)
+
+
+def test_the_rate_halves_on_throttling_and_recovers_on_success():
+    scheduler = HostScheduler(rate=4, burst=1, backoff_max=0)
+    for _ in range(5):
+        scheduler.backoff(URL, 'test')
+    assert scheduler.stats()[host_of(URL)]['rate'] == MIN_RATE
+    scheduler.success(URL)
+    assert scheduler.stats()[host_of(URL)]['rate'] == MIN_RATE + RECOVERY_STEP
+    for _ in range(10):
+        scheduler.success(URL)
+    # Recovered hosts aren't listed
+    assert host_of(URL) not in scheduler.stats()
+
+
+def test_throttled_speeds_back_off(monkeypatch):
+    monkeypatch.setattr(config, 'THROTTLED_KBPS', 100)
+    scheduler = HostScheduler(rate=4, burst=1, backoff_max=0)
+    scheduler.report_speed(URL, 500 * 1024)
+    assert scheduler.stats() == {}
+    scheduler.report_speed(URL, 50 * 1024)
+    assert scheduler.stats()[host_of(URL)]['rate'] == 2
+
+
+def test_idle_hosts_are_forgotten():
+    scheduler = HostScheduler(rate=4, burst=1, backoff_max=0, max_hosts=2)
+    for n in range(5):
+        scheduler.acquire(f'https://host{n}.example.com/')
+    assert len(scheduler._hosts) == 2
+
+
+class _ThrottlingHandler(BaseHTTPRequestHandler):
+    """Answers 429 to the first request, then 200"""
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests += 1
+        if self.server.requests == 1:
+            self.send_response(429)
+            self.send_header('Retry-After', '0')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = b'ok'
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def throttling_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _ThrottlingHandler)
+    server.requests = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_youtubedl_requests_are_sent_again_after_a_429(throttling_server, monkeypatch, no_jitter):
+    monkeypatch.setattr(ratelimit, 'BACKOFF_BASE', 0.05)
+    scheduler = HostScheduler(rate=0, burst=1, backoff_max=10)
+    monkeypatch.setattr(youtubedl, 'scheduler', scheduler)
+    url = f'http://127.0.0.1:{throttling_server.server_port}/'
+    with ScheduledYoutubeDL({'quiet': True}) as ydl:
+        with ydl.urlopen(url) as response:
+            assert response.read() == b'ok'
+    assert throttling_server.requests == 2
+    # The success ended the backoff streak
+    assert scheduler._hosts['127.0.0.1'].failures == 0
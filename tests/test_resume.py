@@ -0,0 +1,86 @@
+import os
+import shutil
+import sys
+import time
+
+import pytest
+
+from benchmarks.http_server import MediaServer
+from youtube_downloader import journal
+from youtube_downloader.download import request_key, resume_interrupted, run_download
+from youtube_downloader.download_cache import download_cache
+from youtube_downloader.jobs import DONE, Job, job_manager
+from youtube_downloader.journal import Journal, output_files, partial_files
+
+
+@pytest.fixture
+def slow_server(media_dir):
+    # 1 MB at 256 KB/s: time enough to cancel halfway
+    with MediaServer(media_dir, rate=256 * 1024) as server:
+        yield server
+
+
+def test_journal_records_partial_files(tmp_path):
+    (tmp_path / 'video.mp4.part').write_bytes(b'x' * 10)
+    (tmp_path / 'video.f1.mp4.part-Frag3').write_bytes(b'x' * 5)
+    (tmp_path / 'video.mp4').write_bytes(b'done')
+    entry = Journal(str(tmp_path))
+    entry.update(status=journal.RUNNING, job_id='job')
+    assert Journal(str(tmp_path)).get('parts') == {'video.mp4.part': 10, 'video.f1.mp4.part-Frag3': 5}
+    assert Journal(str(tmp_path)).get('job_id') == 'job'
+    assert entry.resumed_bytes == 15
+    assert partial_files(str(tmp_path)) == entry.get('parts')
+    assert [path.name for path in output_files(str(tmp_path))] == ['video.mp4']
+
+
+def test_owner_alive(tmp_path):
+    entry = Journal(str(tmp_path))
+    assert not entry.owner_alive()
+    # This process doesn't count: its own jobs are never "still running elsewhere"
+    entry.update(pid=os.getpid())
+    assert not entry.owner_alive()
+
+
+def test_a_cancelled_download_resumes_from_its_partial_files(slow_server):
+    url = slow_server.url('large.mp4?resumed')
+    job = Job('tester')
+
+    def cancel_halfway(event):
+        if event.phase == 'downloading' and event.downloaded_bytes > 300 * 1024:
+            job._cancel_event.set()
+
+    job.subscribe(cancel_halfway)
+    # (yt-dlp may wrap the JobCancelled raised in its hooks)
+    with pytest.raises(Exception):
+        run_download(job, url, 'video', 'best', True, connections=1)
+    assert job.cancelled
+    [work_dir] = [path for path in download_cache.work_dirs() if Journal(path).get('request', {}).get('url') == url]
+    assert Journal(work_dir).get('status') == journal.CANCELLED
+    assert Journal(work_dir).resumed_bytes > 300 * 1024
+
+    retry = Job('tester')
+    result = run_download(retry, url, 'video', 'best', True, connections=1)
+    assert any('Resuming' in text for _, text in retry.messages)
+    assert result['file_size'] == os.path.getsize(os.path.join(slow_server.root, 'large.mp4'))
+    assert not os.path.exists(work_dir)
+
+
+def test_downloads_running_at_a_restart_are_requeued(media_server, monkeypatch):
+    monkeypatch.setattr(sys.modules['youtube_downloader.download'], '_resumed', False)
+    request = dict(url=media_server.url('av.mp4?restarted'), mode='video', quality='best', has_ffmpeg=True)
+    work_dir = os.path.join(download_cache.work_root, 'interrupted')
+    os.makedirs(work_dir)
+    # Written by a process that has since died
+    Journal(work_dir).update(status=journal.RUNNING, job_id='interrupted-job', owner='tester', pid=None,
+                             restart=True, request=request)
+    [job] = resume_interrupted()
+    assert job.id == 'interrupted-job'
+    assert job.key == request_key(request)
+    deadline = time.monotonic() + 30
+    while job.active and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert job.status == DONE, job.error
+    assert job_manager.get('interrupted-job') is job
+    # Only once per process
+    assert resume_interrupted() == []
+    shutil.rmtree(work_dir)
@@ -0,0 +1,67 @@
+import subprocess
+
+import pytest
+
+from youtube_downloader.download import (
+    DownloadError, Section, clip_section, parse_time, run_download, section_share,
+)
+from youtube_downloader.download_cache import cache_key
+from youtube_downloader.jobs import Job
+
+
+def duration_of(path):
+    output = subprocess.run(['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'csv=p=0', path],
+                            capture_output=True, text=True, check=True).stdout
+    return float(output)
+
+
+def test_parse_time():
+    assert parse_time(90) == 90.0
+    assert parse_time('1:30') == 90.0
+    assert parse_time(' 01:00:05 ') == 3605.0
+    assert parse_time('') is None
+    assert parse_time(None) is None
+    with pytest.raises(ValueError):
+        parse_time('soon')
+    with pytest.raises(ValueError):
+        parse_time(-1)
+
+
+def test_clip_section():
+    assert clip_section() is None
+    assert clip_section('0', '') is None
+    assert clip_section('1:00', None) == Section(60.0, None, False)
+    assert clip_section(5, '0:10', precise_cuts=1) == Section(5.0, 10.0, True)
+    with pytest.raises(ValueError):
+        clip_section(10, 5)
+
+
+def test_section_share():
+    assert section_share(Section(10, 40, False), 120) == 0.25
+    # Sections running past the end, or to the end, stop at the duration
+    assert section_share(Section(90, 200, False), 120) == 0.25
+    assert section_share(Section(90, None, False), 120) == 0.25
+    assert section_share(Section(10, 40, False), None) == 1.0
+    assert section_share(None, 120) == 1.0
+
+
+def test_sections_are_cached_apart_from_the_whole_video():
+    opts = {'format': 'best'}
+    assert cache_key('k', opts, Section(0, 10, False)) != cache_key('k', opts)
+    assert cache_key('k', opts, Section(0, 10, False)) != cache_key('k', opts, Section(0, 10, True))
+
+
+def test_sections_need_ffmpeg(media_server):
+    with pytest.raises(DownloadError) as raised:
+        run_download(Job('tester'), media_server.url('av.mp4?no-ffmpeg'), 'video', 'best', False, start_time=1)
+    assert raised.value.kind == 'section_ffmpeg'
+
+
+def test_a_section_is_downloaded_and_cut(media_server):
+    result = run_download(Job('tester'), media_server.url('large.mp4?section'), 'video', 'best', True,
+                          start_time='0.5', end_time='1.5', precise_cuts=True)
+    assert result['file_path'].endswith('[0.5s-1.5s].mp4')
+    assert duration_of(result['file_path']) == pytest.approx(1.0, abs=0.2)
+    whole = run_download(Job('tester'), media_server.url('large.mp4?section'), 'video', 'best', True)
+    assert not whole['cached']
+    assert result['file_size'] < whole['file_size']
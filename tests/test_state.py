@@ -0,0 +1,107 @@
+import threading
+import time
+
+import pytest
+
+from youtube_downloader import state
+from youtube_downloader.download_cache import DownloadCache
+from youtube_downloader.state import LockLost, RedisState, SQLiteState
+
+
+@pytest.fixture(params=['sqlite', 'redis'])
+def shared(request, tmp_path, monkeypatch):
+    monkeypatch.setattr(state, 'LOCK_POLL', 0.01)
+    if request.param == 'sqlite':
+        return SQLiteState(str(tmp_path / 'state.db'))
+    fakeredis = pytest.importorskip('fakeredis')
+    return RedisState(fakeredis.FakeRedis())
+
+
+class Cancelled(Exception):
+    pass
+
+
+def test_add_only_sets_absent_keys(shared):
+    assert shared.add('key', 'first')
+    assert not shared.add('key', 'second')
+    assert shared.get('key') == 'first'
+
+
+def test_keys_expire(shared):
+    shared.set('key', 'value', ttl=0.1)
+    time.sleep(0.2)
+    assert shared.get('key') is None
+    assert shared.add('key', 'again')
+
+
+def test_delete_and_expire_need_the_holders_value(shared):
+    shared.set('key', 'mine')
+    assert not shared.expire('key', 'theirs', 10)
+    assert not shared.delete('key', 'theirs')
+    assert shared.expire('key', 'mine', 10)
+    assert shared.delete('key', 'mine')
+    assert shared.get('key') is None
+
+
+def test_scan_returns_keys_under_a_prefix(shared):
+    shared.set('job:1', {'n': 1})
+    shared.set('job:2', {'n': 2})
+    shared.set('jobs', 'other')
+    assert dict(shared.scan('job:')) == {'job:1': {'n': 1}, 'job:2': {'n': 2}}
+
+
+def test_lock_excludes_other_holders(shared):
+    with shared.lock('work'):
+        assert shared.locked('work')
+        with pytest.raises(TimeoutError):
+            with shared.lock('work', timeout=0.05):
+                pass
+    assert not shared.locked('work')
+
+
+def test_waiting_for_a_lock_can_be_cancelled(shared):
+    cancel = threading.Event()
+
+    def check():
+        if cancel.is_set():
+            raise Cancelled()
+
+    with shared.lock('work'):
+        threading.Timer(0.05, cancel.set).start()
+        started = time.monotonic()
+        with pytest.raises(Cancelled):
+            with shared.lock('work', check=check):
+                pass
+        assert time.monotonic() - started < 5
+
+
+def test_lease_notices_when_another_holder_takes_the_lock(shared):
+    with shared.lock('work', ttl=0.3) as lease:
+        lease.check()
+        # As if the lock expired and another replica took it
+        shared.set('lock:work', 'elsewhere', ttl=10)
+        deadline = time.monotonic() + 5
+        while not lease.lost and time.monotonic() < deadline:
+            time.sleep(0.02)
+        assert lease.lost
+        with pytest.raises(LockLost):
+            lease.check()
+    # Releasing a lost lock leaves the new holder's alone
+    assert shared.get('lock:work') == 'elsewhere'
+
+
+def test_work_dir_is_kept_for_the_new_holder_of_a_lost_lease(shared, tmp_path):
+    cache = DownloadCache(str(tmp_path / 'cache'), 10 ** 6, state=shared)
+    with pytest.raises(LockLost):
+        with cache.work_dir('key') as (path, lease):
+            (tmp_path / 'cache' / '.work' / 'key' / 'video.part').write_bytes(b'x')
+            lease.lost = True
+    assert (tmp_path / 'cache' / '.work' / 'key' / 'video.part').exists()
+
+
+def test_work_dir_is_removed_after_success(shared, tmp_path):
+    cache = DownloadCache(str(tmp_path / 'cache'), 10 ** 6, state=shared)
+    with cache.work_dir('key') as (path, lease):
+        assert cache.working('key')
+    assert not cache.working('key')
+    assert not (tmp_path / 'cache' / '.work' / 'key').exists()
@@ -0,0 +1,91 @@
+import io
+import math
+import sys
+import zipfile
+from urllib.parse import urlsplit
+
+import pytest
+
+from youtube_downloader import batch
+from youtube_downloader.download_cache import download_cache
+from youtube_downloader.jobs import DONE, Job
+from youtube_downloader.storage import MAX_PARTS, MIN_PART_SIZE, MultipartWriter, S3Storage
+
+boto3 = pytest.importorskip('boto3')
+moto_server = pytest.importorskip('moto.server')
+
+
+@pytest.fixture(scope='module')
+def s3_client():
+    server = moto_server.ThreadedMotoServer(port=0)
+    server.start()
+    host, port = server.get_host_and_port()
+    client = boto3.client('s3', endpoint_url=f'http://{host}:{port}', aws_access_key_id='test',
+                          aws_secret_access_key='test', region_name='us-east-1')
+    client.create_bucket(Bucket='media')
+    yield client
+    server.stop()
+
+
+@pytest.fixture
+def s3(s3_client, request):
+    return S3Storage(s3_client, 'media', prefix=request.node.name)
+
+
+def test_part_size_grows_to_fit_the_part_limit(s3):
+    assert s3.writer('small', 'video/mp4', size=10).part_size == s3.part_size
+    huge = 1024 * s3.part_size * MAX_PARTS
+    assert s3.writer('huge', 'video/mp4', size=huge).part_size == math.ceil(huge / MAX_PARTS)
+
+
+def test_parts_are_at_least_the_s3_minimum(s3_client):
+    assert MultipartWriter(s3_client, 'media', 'key', 'video/mp4', 1024, 2).part_size == MIN_PART_SIZE
+
+
+def test_multipart_upload_is_reassembled(s3, s3_client, tmp_path):
+    data = bytes(range(256)) * (MIN_PART_SIZE * 2 // 256 + 100)
+    with s3.writer('object', 'video/mp4') as writer:
+        for start in range(0, len(data), 1000 * 1000):
+            writer.write(data[start:start + 1000 * 1000])
+    body = s3_client.get_object(Bucket='media', Key=s3.prefix + 'object')['Body'].read()
+    assert body == data
+
+
+def test_lookup_finds_published_downloads(s3, tmp_path):
+    path = tmp_path / 'video.mp4'
+    path.write_bytes(b'video')
+    assert s3.lookup('key') is None
+    published = s3.publish(str(path), 'Video.mp4', 'video/mp4', key='key', meta={'title': 'Video'}, move=False)
+    # The caller's copy isn't the storage's to hand out
+    assert published.path is None
+    assert path.exists()
+    entry = s3.lookup('key')
+    assert entry == {'file': 'video.mp4', 'size': 5, 'meta': {'title': 'Video'}}
+
+
+def test_lookup_errors_are_misses(s3):
+    from botocore.stub import Stubber
+
+    with Stubber(s3.client) as stubber:
+        stubber.add_client_error('get_object', service_error_code='AccessDenied', http_status_code=403)
+        stubber.add_client_error('get_object', service_error_code='InternalError', http_status_code=500)
+        assert s3.lookup('key') is None
+        assert s3.lookup('key') is None
+
+
+def test_batch_zip_includes_files_only_the_bucket_keeps(s3, media_server, monkeypatch):
+    # (the package exports functions named like the download module)
+    monkeypatch.setattr(sys.modules['youtube_downloader.download'], 'storage', s3)
+    monkeypatch.setattr(batch, 'storage', s3)
+    # Over the cache budget, so the files are only in the working directories (which go) and the bucket
+    monkeypatch.setattr(download_cache, 'max_bytes', 1)
+    job = Job('tester')
+    result = batch.run_batch(job, [media_server.url('av.mp4'), media_server.url('video.mp4')], 'video', 'best',
+                             True, make_zip=True)
+    assert [item['status'] for item in result['items']] == [DONE, DONE]
+    assert all(item['file_path'] is None for item in result['items'])
+    object_key = urlsplit(result['zip_url']).path.split('/media/', 1)[1]
+    body = s3.client.get_object(Bucket='media', Key=object_key)['Body'].read()
+    with zipfile.ZipFile(io.BytesIO(body)) as zf:
+        assert sorted(info.file_size for info in zf.infolist()) == sorted(
+            item['file_size'] for item in result['items'])
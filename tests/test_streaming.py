@@ -0,0 +1,92 @@
+import os
+import shutil
+import threading
+
+import pytest
+from yt_dlp.postprocessor import PostProcessor
+from yt_dlp.utils import PostProcessingError
+
+from youtube_downloader.download import run_download
+from youtube_downloader.jobs import Job
+from youtube_downloader.parallel import ParallelYoutubeDL
+from youtube_downloader.streaming import StreamingAudioEncoder, StreamingExtractAudioPP
+from youtube_downloader.transcode import transcode_pool
+
+
+class FailingPP(PostProcessor):
+    def run(self, information):
+        raise PostProcessingError('fixup failed')
+
+
+@pytest.fixture
+def encoders(monkeypatch):
+    """The StreamingAudioEncoders started during the test"""
+    started = []
+    attach = StreamingExtractAudioPP.attach
+
+    def recording_attach(self, filename, info_dict):
+        hook = attach(self, filename, info_dict)
+        if hook is not None:
+            started.append(self._encoders[os.path.abspath(filename)])
+        return hook
+
+    monkeypatch.setattr(StreamingExtractAudioPP, 'attach', recording_attach)
+    return started
+
+
+def assert_pool_idle():
+    assert transcode_pool.stats()['running'] == 0
+    # Every slot can be taken again
+    taken = [transcode_pool.try_acquire() for _ in range(transcode_pool.cores)]
+    for _ in range(sum(taken)):
+        transcode_pool.release()
+    assert all(taken)
+
+
+def test_streamed_encode_releases_its_slot(media_server, encoders):
+    result = run_download(Job('tester'), media_server.url('dash.mpd?streamed'), 'audio', 'best', True,
+                          audio_format='mp3')
+
+    assert result['extension'] == 'mp3'
+    assert len(encoders) == 1
+    assert_pool_idle()
+
+
+def test_failing_postprocessor_aborts_encoders(media_server, encoders, monkeypatch):
+    add_post_processor = ParallelYoutubeDL.add_post_processor
+
+    def add_failing_first(self, pp, when='post_process'):
+        # Fails before the audio postprocessor gets to run
+        if isinstance(pp, StreamingExtractAudioPP):
+            add_post_processor(self, FailingPP(self), when)
+        add_post_processor(self, pp, when)
+
+    monkeypatch.setattr(ParallelYoutubeDL, 'add_post_processor', add_failing_first)
+
+    with pytest.raises(Exception, match='fixup failed'):
+        run_download(Job('tester'), media_server.url('dash.mpd?failing'), 'audio', 'best', True, audio_format='mp3')
+
+    assert len(encoders) == 1
+    assert encoders[0].process.poll() is not None
+    assert not os.path.exists(encoders[0].tmp_path)
+    assert_pool_idle()
+
+
+def test_an_encode_whose_source_goes_away_fails(media_dir, tmp_path):
+    source = tmp_path / 'audio.webm.part'
+    shutil.copy(os.path.join(media_dir, 'audio.webm'), source)
+    size = source.stat().st_size
+    assert transcode_pool.try_acquire()
+    encoder = StreamingAudioEncoder(shutil.which('ffmpeg'), str(tmp_path / 'audio.mp3'), ['-f', 'mp3'])
+    encoder.progress_hook({'status': 'downloading', 'tmpfilename': str(source), 'downloaded_bytes': size // 2})
+    source.unlink()
+    encoder.progress_hook({'status': 'downloading', 'tmpfilename': str(source), 'downloaded_bytes': size})
+
+    finished = []
+    thread = threading.Thread(target=lambda: finished.append(encoder.finish()), daemon=True)
+    thread.start()
+    thread.join(10)
+    assert finished == [False]
+    assert encoder.error
+    assert not os.path.exists(encoder.tmp_path)
+    assert_pool_idle()
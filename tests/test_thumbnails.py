@@ -0,0 +1,85 @@
+import os
+import threading
+
+import pytest
+from PIL import Image
+
+from benchmarks.http_server import MediaServer
+from youtube_downloader.thumbnails import WIDTHS, ThumbnailCache
+
+
+@pytest.fixture(scope='module')
+def image_server(tmp_path_factory):
+    """A server with a 1280x720 JPEG thumbnail and a file that isn't an image"""
+    root = tmp_path_factory.mktemp('thumbnails')
+    Image.new('RGB', (1280, 720), (200, 30, 30)).save(root / 'maxres.jpg', quality=90)
+    (root / 'broken.jpg').write_bytes(b'not an image')
+    with MediaServer(str(root)) as server:
+        yield server
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return ThumbnailCache(str(tmp_path / 'thumbnails'), 1024 * 1024)
+
+
+def test_thumbnails_are_stored_resized_as_webp(cache, image_server):
+    path = cache.get(image_server.url('maxres.jpg?resized'), width=300)
+    assert path.endswith('-320.webp')
+    with Image.open(path) as image:
+        assert (image.format, image.size) == ('WEBP', (320, 180))
+    # Every width was written by the one fetch
+    assert cache.stats()['entries'] == len(WIDTHS)
+    small = cache.get(image_server.url('maxres.jpg?resized'), width=100)
+    with Image.open(small) as image:
+        assert image.size == (160, 90)
+    assert (cache.stats()['hits'], cache.stats()['misses']) == (1, 1)
+
+
+def test_uncached_thumbnails_are_not_fetched_when_asked_not_to(cache, image_server):
+    url = image_server.url('maxres.jpg?no-fetch')
+    assert cache.get(url, fetch=False) is None
+    assert cache.data_url(url, fetch=False) is None
+    cache.get(url)
+    assert cache.data_url(url, fetch=False).startswith('data:image/webp;base64,')
+
+
+def test_failed_fetches_fall_back_to_the_remote_url(cache, image_server):
+    assert cache.get(image_server.url('missing.jpg')) is None
+    assert cache.get(image_server.url('broken.jpg')) is None
+    assert cache.get(None) is None
+    assert ThumbnailCache(cache.root, 0).get(image_server.url('maxres.jpg')) is None
+
+
+def test_concurrent_requests_fetch_once(cache, image_server, monkeypatch):
+    fetches = []
+    fetch = ThumbnailCache._fetch
+
+    def counting_fetch(url, priority):
+        fetches.append(url)
+        return fetch(url, priority)
+
+    monkeypatch.setattr(ThumbnailCache, '_fetch', staticmethod(counting_fetch))
+    url = image_server.url('maxres.jpg?concurrent')
+    paths = []
+    threads = [threading.Thread(target=lambda: paths.append(cache.get(url))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    assert fetches == [url]
+    assert len(set(paths)) == 1 and paths[0] is not None
+
+
+def test_least_recently_used_thumbnails_are_evicted(tmp_path, image_server):
+    probe = ThumbnailCache(str(tmp_path / 'probe'), 1024 * 1024)
+    probe.get(image_server.url('maxres.jpg?probe'))
+    # Room for the sizes of one thumbnail and a half
+    cache = ThumbnailCache(str(tmp_path / 'thumbnails'), probe.stats()['bytes'] * 3 // 2)
+    first = cache.get(image_server.url('maxres.jpg?first'))
+    os.utime(first, (0, 0))
+    second = cache.get(image_server.url('maxres.jpg?second'))
+    assert not os.path.exists(first)
+    assert os.path.exists(second)
+    assert cache.stats()['evictions'] >= 1
+    assert cache.stats()['bytes'] <= cache.max_bytes
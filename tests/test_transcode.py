@@ -0,0 +1,96 @@
+import os
+import subprocess
+import threading
+import time
+
+import pytest
+
+from youtube_downloader.download import run_download
+from youtube_downloader.jobs import Job
+from youtube_downloader.transcode import (
+    KEEP, REMUX, TRANSCODE, TranscodePool, audio_selector, plan_audio, probe_codec,
+)
+
+
+def test_sources_in_the_target_codec_are_kept_or_remuxed():
+    assert plan_audio('mp4a.40.2', 'm4a', 'm4a') == (KEEP, 'm4a', [])
+    assert plan_audio('mp3', 'mp3', 'mp3').action == KEEP
+    plan = plan_audio('opus', 'webm', 'opus')
+    assert (plan.action, plan.ext) == (REMUX, 'opus')
+    assert plan.args == ['-c:a', 'copy', '-f', 'opus']
+
+
+def test_other_sources_are_transcoded_on_one_thread():
+    plan = plan_audio('opus', 'webm', 'mp3', quality='128')
+    assert (plan.action, plan.ext) == (TRANSCODE, 'mp3')
+    assert plan.args[-2:] == ['-f', 'mp3']
+    assert '128k' in plan.args
+    assert plan.args[plan.args.index('-threads') + 1] == '1'
+    # Unknown codecs can't be copied
+    assert plan_audio(None, 'webm', 'opus').action == TRANSCODE
+
+
+def test_best_keeps_codecs_with_an_audio_container():
+    assert plan_audio('vorbis', 'webm', 'best') == (REMUX, 'ogg', ['-c:a', 'copy', '-f', 'ogg'])
+    assert plan_audio('mp4a.40.2', 'm4a', 'best').action == KEEP
+    assert plan_audio('ac-3', 'mp4', 'best')[:2] == (TRANSCODE, 'mp3')
+
+
+def test_selectors_prefer_sources_in_the_target_codec():
+    assert audio_selector('best') == 'bestaudio/best'
+    assert audio_selector('opus') == 'bestaudio[acodec^=opus]/bestaudio/best'
+    assert audio_selector('m4a').startswith('bestaudio[acodec^=mp4a]')
+
+
+def test_the_pool_runs_encodes_in_its_slots_in_order():
+    pool = TranscodePool(cores=1, niceness=0)
+    assert pool.try_acquire()
+    assert not pool.try_acquire()
+    order = []
+
+    def encode(n):
+        with pool.slot():
+            order.append(n)
+
+    threads = []
+    for n in range(3):
+        thread = threading.Thread(target=encode, args=(n,))
+        thread.start()
+        threads.append(thread)
+        while pool.stats()['queued'] < n + 1:
+            time.sleep(0.01)
+    # The waiting encodes take the slot in turn, in the order they asked for it
+    pool.release()
+    for thread in threads:
+        thread.join(5)
+    assert order == [0, 1, 2]
+    assert pool.stats() == {'cores': 1, 'running': 0, 'queued': 0}
+
+
+def test_failed_runs_raise_with_stderr_and_free_their_slot():
+    if not os.path.exists('/bin/sh'):
+        pytest.skip('needs a POSIX shell')
+    pool = TranscodePool(cores=1, niceness=5)
+    with pytest.raises(subprocess.CalledProcessError) as raised:
+        pool.run(['/bin/sh', '-c', 'echo broken >&2; exit 3'])
+    assert raised.value.returncode == 3
+    assert 'broken' in raised.value.stderr
+    assert pool.try_acquire()
+
+
+def test_probe_codec(media_dir):
+    assert probe_codec(os.path.join(media_dir, 'audio.m4a')) == 'aac'
+    assert probe_codec(os.path.join(media_dir, 'video.mp4')) is None
+
+
+@pytest.mark.parametrize('source, audio_format, extension, codec', [
+    ('audio.m4a', 'm4a', 'm4a', 'aac'),
+    ('audio.webm', 'opus', 'opus', 'opus'),
+    ('audio.webm', 'mp3', 'mp3', 'mp3'),
+    ('audio.webm', 'best', 'opus', 'opus'),
+])
+def test_audio_downloads_end_in_the_requested_format(media_server, source, audio_format, extension, codec):
+    result = run_download(Job('tester'), media_server.url(f'{source}?{audio_format}'), 'audio', 'best', True,
+                          audio_format=audio_format)
+    assert result['extension'] == extension
+    assert probe_codec(result['file_path']) == codec
@@ -0,0 +1,110 @@
+import subprocess
+import sys
+import time
+
+import pytest
+
+from youtube_downloader import youtubedl
+from youtube_downloader.info_cache import extract_info
+from youtube_downloader.youtubedl import ScheduledYoutubeDL, YoutubeDLPool, ydl_pool
+
+OPTS = {'quiet': True, 'no_warnings': True}
+
+
+@pytest.fixture
+def closed(monkeypatch):
+    """Instances closed during the test"""
+    instances = []
+    close = ScheduledYoutubeDL.close
+
+    def recording_close(self):
+        instances.append(self)
+        close(self)
+
+    monkeypatch.setattr(ScheduledYoutubeDL, 'close', recording_close)
+    return instances
+
+
+def test_instances_are_reused_per_option_profile():
+    pool = YoutubeDLPool(max_idle=2, max_age=60)
+    opts = dict(OPTS)
+    with pool.get(opts) as first:
+        pass
+    # The options dict is the caller's: yt-dlp doesn't fill its defaults into it
+    assert opts == OPTS
+    with pool.get(opts) as again:
+        pass
+    # Options compare by value, whatever their order
+    with pool.get(dict(reversed(list(OPTS.items())))) as second:
+        pass
+    with pool.get(dict(OPTS, format='best')) as other:
+        pass
+    assert again is first
+    assert second is first
+    assert other is not first
+    assert pool.stats() == {'entries': 2, 'profiles': 2, 'hits': 2, 'misses': 2}
+
+
+def test_concurrent_callers_get_instances_of_their_own():
+    pool = YoutubeDLPool(max_idle=1, max_age=60)
+    with pool.get(OPTS) as first, pool.get(OPTS) as second:
+        assert second is not first
+    # Only max_idle of them are kept
+    assert pool.stats()['entries'] == 1
+
+
+def test_instances_that_raised_are_not_lent_again(closed):
+    pool = YoutubeDLPool(max_idle=2, max_age=60)
+    with pytest.raises(RuntimeError):
+        with pool.get(OPTS) as broken:
+            raise RuntimeError('extraction failed')
+    assert closed == [broken]
+    with pool.get(OPTS) as ydl:
+        assert ydl is not broken
+
+
+def test_old_instances_are_retired(closed):
+    pool = YoutubeDLPool(max_idle=2, max_age=0.05)
+    with pool.get(OPTS) as old:
+        pass
+    time.sleep(0.1)
+    with pool.get(OPTS) as new:
+        assert new is not old
+    assert closed == [old]
+
+
+def test_the_least_recently_used_profile_is_dropped(closed, monkeypatch):
+    monkeypatch.setattr(youtubedl, 'MAX_PROFILES', 2)
+    pool = YoutubeDLPool(max_idle=1, max_age=60)
+    instances = []
+    for n in range(3):
+        with pool.get(dict(OPTS, format=str(n))) as ydl:
+            instances.append(ydl)
+    assert closed == instances[:1]
+    assert pool.stats()['profiles'] == 2
+
+
+def test_warm_builds_an_instance_ahead_of_time():
+    pool = YoutubeDLPool(max_idle=2, max_age=60)
+    pool.warm(OPTS)
+    pool.warm(OPTS)
+    assert pool.stats()['entries'] == 1
+    with pool.get(OPTS):
+        pass
+    # The first request already finds it
+    assert (pool.stats()['hits'], pool.stats()['misses']) == (1, 0)
+
+
+def test_extractions_share_warm_instances(media_server):
+    extract_info(media_server.url('av.mp4?pooled-1'))
+    hits = ydl_pool.stats()['hits']
+    extract_info(media_server.url('av.mp4?pooled-2'))
+    assert ydl_pool.stats()['hits'] == hits + 1
+
+
+def test_importing_the_package_leaves_yt_dlp_unloaded(tmp_path):
+    code = ('import sys, youtube_downloader, youtube_downloader.batch, youtube_downloader.prefetch; '
+            'print("yt_dlp" in sys.modules)')
+    output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True,
+                            env={'YTDL_DATA_DIR': str(tmp_path), 'PATH': ''}).stdout
+    assert output.strip() == 'False'
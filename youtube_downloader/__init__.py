@@ -0,0 +1,12 @@
+"""Download videos or audio from YouTube, from Python or the command line
+
+    >>> from youtube_downloader import download
+    >>> download('https://www.youtube.com/watch?v=...', mode='audio', output_dir='music')
+
+Run ``python -m youtube_downloader --help`` for the command line interface.
+The Streamlit app in youtube_downloader_app.py is a client of this package.
+"""
+from .api import download, get_info
+from .download import DownloadError
+
+__all__ = ['download', 'get_info', 'DownloadError']
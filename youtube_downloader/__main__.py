@@ -0,0 +1,80 @@
+"""Command line interface: python -m youtube_downloader URL [URL ...]"""
+import argparse
+import json
+import sys
+
+from .api import download
+from .download import MODES, QUALITIES
+from .transcode import AUDIO_FORMATS, DEFAULT_AUDIO_FORMAT
+
+
+def _print_progress(event):
+    """Show progress on a single, continuously rewritten stderr line"""
+    sys.stderr.write(f"\r\033[K{event.describe()}")
+    sys.stderr.flush()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m youtube_downloader',
+        description='Download videos or audio from YouTube.',
+    )
+    parser.add_argument('urls', nargs='+', metavar='URL', help='video URL(s) to download')
+    parser.add_argument('-m', '--mode', choices=MODES, default='video', help='download video (MP4) or audio only')
+    parser.add_argument('-q', '--quality', choices=QUALITIES, default='best', help='video quality')
+    parser.add_argument('-a', '--audio-format', choices=AUDIO_FORMATS, default=DEFAULT_AUDIO_FORMAT,
+                        help="output of audio downloads ('best' keeps the source's codec without re-encoding)")
+    parser.add_argument('-o', '--output-dir', default='.', help='directory to save files in')
+    parser.add_argument('--retries', type=int, default=10, help='retry attempts on failure')
+    parser.add_argument('--timeout', type=int, default=60, help='connection timeout in seconds')
+    parser.add_argument('-c', '--connections', type=int, default=None,
+                        help='parallel connections per stream (0 = tune automatically)')
+    parser.add_argument('--max-size', type=int, default=None, metavar='MB',
+                        help='highest video quality whose estimated size fits in MB')
+    parser.add_argument('--target-time', type=int, default=None, metavar='SECONDS',
+                        help='highest video quality that downloads within this time at the measured speed')
+    parser.add_argument('--start', default=None, metavar='TIME',
+                        help='download from this time on (seconds or [HH:]MM:SS; needs FFmpeg)')
+    parser.add_argument('--end', default=None, metavar='TIME', help='download up to this time')
+    parser.add_argument('--precise-cuts', action='store_true',
+                        help='re-encode around the cuts so the clip starts and ends exactly on time')
+    parser.add_argument('--json', action='store_true', help='print one JSON result per URL instead of file paths')
+    parser.add_argument('--quiet', action='store_true', help="don't show progress")
+    args = parser.parse_args(argv)
+
+    failed = 0
+    for url in args.urls:
+        try:
+            result = download(
+                url,
+                mode=args.mode,
+                quality=args.quality,
+                output_dir=args.output_dir,
+                retry_count=args.retries,
+                timeout_seconds=args.timeout,
+                connections=args.connections,
+                max_size_mb=args.max_size,
+                target_seconds=args.target_time,
+                start_time=args.start,
+                end_time=args.end,
+                precise_cuts=args.precise_cuts,
+                audio_format=args.audio_format,
+                on_progress=None if args.quiet else _print_progress,
+            )
+        except Exception as e:
+            failed += 1
+            if not args.quiet:
+                sys.stderr.write('\n')
+            if args.json:
+                print(json.dumps({'url': url, 'error': str(e), 'kind': getattr(e, 'kind', None)}))
+            else:
+                print(f"error: {url}: {e}", file=sys.stderr)
+            continue
+        if not args.quiet:
+            sys.stderr.write('\n')
+        print(json.dumps(dict(result, url=url)) if args.json else result['file_path'])
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
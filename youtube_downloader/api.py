@@ -0,0 +1,59 @@
+"""Library entry points for using the downloader without the Streamlit UI"""
+from .download import run_download
+from .ffmpeg import check_ffmpeg
+from .info_cache import extract_info
+from .jobs import Job
+from .ratelimit import INTERACTIVE
+from .transcode import DEFAULT_AUDIO_FORMAT
+
+
+def get_info(url, retry_count=10, timeout_seconds=60):
+    """Return yt-dlp's info dict for a URL (cached per video ID)"""
+    return extract_info(url, {'socket_timeout': timeout_seconds, 'retries': retry_count,
+                              'request_priority': INTERACTIVE})
+
+
+def download(url, mode='video', quality='best', output_dir='.', retry_count=10, timeout_seconds=60,
+             on_progress=None, has_ffmpeg=None, connections=None, max_size_mb=None, target_seconds=None,
+             start_time=None, end_time=None, precise_cuts=False, audio_format=DEFAULT_AUDIO_FORMAT):
+    """Download a video (or only its audio) into output_dir and return a dict describing the file
+
+    mode is 'video' or 'audio'; quality is one of 'best', '1080p', '720p',
+    '480p', '360p' or 'worst'. on_progress, if given, is called with a
+    ProgressEvent as the download advances. FFmpeg is detected automatically
+    unless has_ffmpeg is given. connections is the number of parallel
+    connections per stream (0 tunes it automatically; the default comes from
+    YTDL_DOWNLOAD_CONNECTIONS). max_size_mb and target_seconds lower the
+    video quality to one whose estimated size fits, or that downloads in
+    that time at the throughput measured so far. start_time and end_time
+    (seconds or '[HH:]MM:SS') download only that section of the video, cut
+    at keyframes, or exactly with precise_cuts (re-encodes around the cuts).
+    audio_format is the output of audio downloads: 'mp3', 'm4a', 'opus' or
+    'best' (keeps the source's codec); sources already in that codec are
+    only copied, not re-encoded.
+
+    Raises DownloadError for problems the caller can act on (e.g. FFmpeg is
+    needed), and yt-dlp's errors for network or extraction failures.
+    """
+    job = Job('api')
+    if on_progress is not None:
+        job.subscribe(on_progress)
+    if has_ffmpeg is None:
+        has_ffmpeg = check_ffmpeg()
+    return run_download(
+        job,
+        url,
+        mode=mode,
+        quality=quality,
+        has_ffmpeg=has_ffmpeg,
+        retry_count=retry_count,
+        timeout_seconds=timeout_seconds,
+        output_dir=output_dir,
+        connections=connections,
+        max_size_mb=max_size_mb,
+        target_seconds=target_seconds,
+        start_time=start_time,
+        end_time=end_time,
+        precise_cuts=precise_cuts,
+        audio_format=audio_format,
+    )
@@ -0,0 +1,199 @@
+"""Batch and playlist downloads
+
+A batch takes a mix of video, playlist and channel URLs, expands the
+playlists with flat extraction (one request per page instead of a full
+extraction per video) and downloads the items in parallel. Each item runs the
+normal download pipeline on its own, so one failing video doesn't stop the
+rest. Items take the job queue's worker slots like any other download, and
+one already being downloaded (by the user or anyone else) is joined instead
+of downloaded again. The result is a manifest with a link per item and, optionally, one ZIP
+of everything.
+"""
+import os
+import re
+import shutil
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.request import urlopen
+
+from . import config, delivery, ratelimit
+from .download import request_key, run_download
+from .download_cache import download_cache
+from .info_cache import video_key
+from .jobs import DONE, FAILED, QUEUED, job_manager
+from .metadata import metadata_store
+from .progress import ProgressEvent
+from .storage import storage
+from .thumbnails import thumbnail_cache
+from .transcode import DEFAULT_AUDIO_FORMAT
+
+# Flat-extracted entries pointing at another list (channel tabs, nested playlists)
+PLAYLIST_IE_KEYS = ('YoutubeTab', 'YoutubePlaylist')
+MAX_NESTING = 2
+# Width of the thumbnails shown in the manifest
+LIST_THUMBNAIL_WIDTH = 160
+# Seconds without data before fetching a file for the ZIP from its link gives up
+FETCH_TIMEOUT = 60
+
+
+def parse_sources(text):
+    """Return the URLs in pasted or uploaded text (one per line, or separated by spaces/commas)"""
+    return [token for token in re.split(r'[\s,]+', text or '') if token.startswith(('http://', 'https://'))]
+
+
+def _flatten(entries, limit, depth):
+    """Yield video entries from flat-extracted playlist entries, expanding nested lists"""
+    for entry in entries or []:
+        if entry is None:
+            continue
+        if entry.get('_type') == 'playlist':
+            yield from _flatten(entry.get('entries'), limit, depth)
+        elif entry.get('ie_key') in PLAYLIST_IE_KEYS and depth < MAX_NESTING:
+            yield from _expand_url(entry.get('url'), limit, depth + 1)
+        else:
+            yield entry
+
+
+def _expand_url(url, limit, depth=0):
+    """Yield {'url', 'title'} items for a video, playlist or channel URL"""
+    # Plain video links need no request at all
+    if video_key(url).startswith('youtube:'):
+        yield {'url': url, 'title': None, 'thumbnail': None}
+        return
+    from .youtubedl import ydl_pool
+
+    opts = {'quiet': True, 'no_warnings': True, 'extract_flat': 'in_playlist', 'playlistend': limit,
+            'request_priority': ratelimit.BULK, 'cachedir': config.YTDLP_CACHE_DIR}
+    with ydl_pool.get(opts) as ydl:
+        info = ydl.extract_info(url, download=False)
+    if info.get('_type') != 'playlist':
+        yield {'url': info.get('webpage_url') or url, 'title': info.get('title'), 'thumbnail': info.get('thumbnail')}
+        return
+    for entry in _flatten(info.get('entries'), limit, depth):
+        entry_url = entry.get('url') or entry.get('webpage_url')
+        if entry_url:
+            # Flat entries list their thumbnails smallest first
+            thumbnails = entry.get('thumbnails') or [{}]
+            yield {'url': entry_url, 'title': entry.get('title'),
+                   'thumbnail': entry.get('thumbnail') or thumbnails[-1].get('url')}
+
+
+def expand_sources(sources, limit=None):
+    """Expand video/playlist/channel URLs into a de-duplicated list of video items
+
+    A source that can't be expanded becomes a single item carrying the error,
+    so it is reported in the manifest without failing the whole batch.
+    """
+    limit = limit or config.BATCH_MAX_ITEMS
+    items, seen = [], set()
+    for source in sources:
+        try:
+            expanded = list(_expand_url(source, limit))
+        except Exception as e:
+            expanded = [{'url': source, 'title': None, 'error': str(e)}]
+        for item in expanded:
+            key = video_key(item['url'])
+            if key not in seen:
+                seen.add(key)
+                items.append(item)
+            if len(items) >= limit:
+                return items
+    return items
+
+
+def plan_items(items):
+    """Fill in the title, thumbnail and duration of items whose videos are in the metadata store"""
+    known = metadata_store.rows(video_key(item['url']) for item in items)
+    for item in items:
+        fields = known.get(video_key(item['url']))
+        if fields:
+            item['title'] = item.get('title') or fields['title']
+            item['thumbnail'] = item.get('thumbnail') or fields['thumbnail']
+            item.setdefault('duration', fields['duration'])
+    return items
+
+
+def build_zip(entries, zip_path):
+    """Write finished items into an uncompressed ZIP (media files don't compress further)
+
+    Items that aren't on this disk (kept only by the storage or another
+    replica) are streamed from their download links.
+    """
+    used_names = set()
+    with zipfile.ZipFile(zip_path, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as zf:
+        for entry in entries:
+            base = delivery.safe_name(f"{entry['title'][:50]}.{entry['extension']}")
+            name, n = base, 1
+            while name in used_names:
+                stem, ext = os.path.splitext(base)
+                name, n = f"{stem} ({n}){ext}", n + 1
+            used_names.add(name)
+            if entry.get('file_path') and os.path.isfile(entry['file_path']):
+                zf.write(entry['file_path'], arcname=name)
+                continue
+            info = zipfile.ZipInfo(name, time.localtime()[:6])
+            with urlopen(entry['download_url'], timeout=FETCH_TIMEOUT) as response, \
+                    zf.open(info, 'w', force_zip64=True) as out:
+                shutil.copyfileobj(response, out, 1024 * 1024)
+
+
+def run_batch(job, sources, mode, quality, has_ffmpeg,
+              retry_count=10, timeout_seconds=60, concurrency=None, make_zip=False, connections=None,
+              max_size_mb=None, target_seconds=None, audio_format=DEFAULT_AUDIO_FORMAT):
+    """Download every video in the sources and return the manifest (plus ZIP link if requested)"""
+    job.publish_progress(ProgressEvent(phase='batch', status='started'))
+    items = plan_items(expand_sources(sources))
+    job.check_cancelled()
+
+    concurrency = max(1, min(concurrency or config.BATCH_CONCURRENCY, config.BATCH_MAX_CONCURRENCY))
+    manifest = [dict(item, status=FAILED if item.get('error') else QUEUED) for item in items]
+    done = 0
+    job.publish_progress(ProgressEvent(phase='batch', status='downloading', items_total=len(items)))
+
+    def download_item(entry):
+        if entry['status'] == FAILED:
+            return
+        # Each item is a child job: it is cancelled with the batch (unless others wait on it) but fails on its own
+        request = dict(
+            url=entry['url'],
+            mode=mode,
+            quality=quality,
+            has_ffmpeg=has_ffmpeg,
+            retry_count=retry_count,
+            timeout_seconds=timeout_seconds,
+            connections=connections,
+            max_size_mb=max_size_mb,
+            target_seconds=target_seconds,
+            audio_format=audio_format,
+        )
+        item_job = job_manager.run_child(job, run_download, key=request_key(request), priority=ratelimit.BULK,
+                                         **request)
+        if item_job.status == DONE:
+            entry.update(item_job.result, status=DONE,
+                         thumbnail=item_job.result.get('thumbnail') or entry.get('thumbnail'))
+        else:
+            entry.update(status=item_job.status, error=item_job.error)
+        # Cache the list-sized thumbnail now, so showing the manifest doesn't fetch hundreds of images
+        thumbnail_cache.get(entry.get('thumbnail'), LIST_THUMBNAIL_WIDTH, priority=ratelimit.BULK)
+
+    # While the items download, the batch's own worker slot is theirs
+    with job_manager.lend_slot(job), \
+            ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='batch-item') as pool:
+        futures = [pool.submit(download_item, entry) for entry in manifest]
+        for _ in as_completed(futures):
+            done += 1
+            job.publish_progress(ProgressEvent(
+                phase='batch', status='downloading', items_done=done, items_total=len(items),
+            ))
+    job.check_cancelled()
+
+    result = {'items': manifest, 'zip_url': None}
+    finished = [entry for entry in manifest if entry['status'] == DONE]
+    if make_zip and finished:
+        with download_cache.staging_dir() as tmpdir:
+            zip_path = os.path.join(tmpdir, 'batch.zip')
+            build_zip(finished, zip_path)
+            published = storage.publish(zip_path, f"youtube-batch-{len(finished)}-items.zip", 'application/zip')
+        result['zip_url'] = published.url
+    return result
@@ -0,0 +1,126 @@
+"""Runtime settings, read from environment variables"""
+import os
+import socket
+import tempfile
+
+
+def env_str(name, default):
+    """Read a string setting from the environment"""
+    return os.environ.get(name) or default
+
+
+def env_int(name, default):
+    """Read an integer setting from the environment, falling back to the default on bad values"""
+    try:
+        return int(os.environ.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+# Root directory for everything the app keeps on disk between script runs
+DATA_DIR = env_str('YTDL_DATA_DIR', os.path.join(tempfile.gettempdir(), 'youtube_downloader'))
+
+# State shared by all processes and replicas of the app (jobs, locks, link and cache indexes):
+# empty for a SQLite database in the data directory (one machine only), or a redis:// URL, which replicas on
+# several machines need
+STATE_URL = env_str('YTDL_STATE_URL', '')
+# Name of this process in the shared state, and the URL other replicas reach its delivery server on
+# (set it when replicas don't share the data directory, so they can serve each other's files)
+REPLICA_ID = env_str('YTDL_REPLICA_ID', f'{socket.gethostname()}-{os.getpid()}')
+REPLICA_URL = env_str('YTDL_REPLICA_URL', '')
+
+# Where delivered files are kept: empty for this app's disk (served by the delivery server below),
+# or s3://bucket/prefix for an S3-compatible bucket that browsers download from through presigned URLs
+STORAGE_URL = env_str('YTDL_STORAGE_URL', '')
+# Endpoint of S3-compatible storage other than AWS (e.g. http://minio:9000) and the bucket's region
+S3_ENDPOINT_URL = env_str('YTDL_S3_ENDPOINT_URL', '')
+S3_REGION = env_str('YTDL_S3_REGION', '')
+# Uploads are sent in parts of this size, this many at a time (which bounds their memory use)
+S3_PART_MB = env_int('YTDL_S3_PART_MB', 16)
+S3_UPLOAD_CONCURRENCY = env_int('YTDL_S3_UPLOAD_CONCURRENCY', 4)
+
+# File delivery server (streams finished downloads to the browser)
+DELIVERY_DIR = env_str('YTDL_DELIVERY_DIR', os.path.join(DATA_DIR, 'delivery'))
+DELIVERY_HOST = env_str('YTDL_DELIVERY_HOST', '0.0.0.0')
+DELIVERY_PORT = env_int('YTDL_DELIVERY_PORT', 8510)
+# Base URL the browser uses to reach the delivery server (set this behind a proxy)
+DELIVERY_PUBLIC_URL = env_str('YTDL_DELIVERY_PUBLIC_URL', f'http://localhost:{DELIVERY_PORT}')
+# Secret used to sign download links; if unset, the first replica generates a random one and shares it with
+# the others through the shared state
+DELIVERY_SECRET = env_str('YTDL_DELIVERY_SECRET', '')
+DELIVERY_TTL = env_int('YTDL_DELIVERY_TTL', 3600)
+
+# In-memory cache of extracted video info (entries also expire with their signed format URLs)
+INFO_CACHE_SIZE = env_int('YTDL_INFO_CACHE_SIZE', 256)
+INFO_CACHE_TTL = env_int('YTDL_INFO_CACHE_TTL', 1800)
+
+# Warm YoutubeDL instances kept per set of options for info extraction, and their lifetime in seconds
+YDL_POOL_SIZE = env_int('YTDL_YDL_POOL_SIZE', 4)
+YDL_POOL_MAX_AGE = env_int('YTDL_YDL_POOL_MAX_AGE', 600)
+# yt-dlp's on-disk cache (YouTube player and signature functions), kept across restarts
+YTDLP_CACHE_DIR = env_str('YTDL_YTDLP_CACHE_DIR', os.path.join(DATA_DIR, 'yt-dlp'))
+
+# Persistent video metadata shared by all sessions; the view count and other volatile
+# fields are refreshed after the TTL (seconds), title, duration etc. are kept
+METADATA_DB = env_str('YTDL_METADATA_DB', os.path.join(DATA_DIR, 'metadata.sqlite3'))
+METADATA_TTL = env_int('YTDL_METADATA_TTL', 3600)
+
+# On-disk cache of finished downloads (set the budget to 0 to disable caching)
+DOWNLOAD_CACHE_DIR = env_str('YTDL_DOWNLOAD_CACHE_DIR', os.path.join(DATA_DIR, 'cache'))
+DOWNLOAD_CACHE_MB = env_int('YTDL_DOWNLOAD_CACHE_MB', 10240)
+# Partial downloads are kept this long (seconds) so a retry or restart can continue them
+RESUME_MAX_AGE = env_int('YTDL_RESUME_MAX_AGE', 86400)
+
+# On-disk cache of resized thumbnails (set the budget to 0 to show remote thumbnails instead)
+THUMBNAIL_DIR = env_str('YTDL_THUMBNAIL_DIR', os.path.join(DATA_DIR, 'thumbnails'))
+THUMBNAIL_CACHE_MB = env_int('YTDL_THUMBNAIL_CACHE_MB', 256)
+
+# Speculative downloads: fetching a video's info starts the download the current settings would make,
+# within a budget (MB) for all unclaimed prefetches together (0 disables prefetching); prefetches not
+# claimed by a download within the TTL (seconds) are dropped
+PREFETCH_MB = env_int('YTDL_PREFETCH_MB', 0)
+PREFETCH_TTL = env_int('YTDL_PREFETCH_TTL', 120)
+
+# Parallel downloading: connections per download (0 tunes the count automatically)
+DOWNLOAD_CONNECTIONS = env_int('YTDL_DOWNLOAD_CONNECTIONS', 0)
+DOWNLOAD_MAX_CONNECTIONS = env_int('YTDL_DOWNLOAD_MAX_CONNECTIONS', 16)
+DOWNLOAD_CHUNK_MB = env_int('YTDL_DOWNLOAD_CHUNK_MB', 8)  # Largest range requested at once
+
+# Size-aware quality selection: videos are downloaded in the highest quality whose estimated
+# size fits the limit, or that the measured throughput downloads within the target time
+# (0 = no limit; users can choose lower limits but not higher ones)
+MAX_DOWNLOAD_MB = env_int('YTDL_MAX_DOWNLOAD_MB', 0)
+TARGET_DOWNLOAD_SECONDS = env_int('YTDL_TARGET_DOWNLOAD_SECONDS', 0)
+
+# Video codec families to prefer at equal resolution, most preferred first (e.g. 'h264,vp9';
+# the others follow in yt-dlp's order: av1, vp9, h265, h264, vp8)
+VIDEO_CODECS = tuple(codec.strip().lower() for codec in env_str('YTDL_VIDEO_CODECS', '').split(',') if codec.strip())
+
+# Requests to one upstream host: token-bucket rate limit (requests per second, 0 for no limit) and
+# burst, the longest backoff after 429/403/503 responses, how often a 429/503 is retried after
+# backing off, and the download speed (KB/s) below which a host counts as throttling (0 disables it)
+HOST_RATE = env_int('YTDL_HOST_RATE', 20)
+HOST_BURST = env_int('YTDL_HOST_BURST', 40)
+BACKOFF_MAX_SECONDS = env_int('YTDL_BACKOFF_MAX_SECONDS', 60)
+THROTTLE_RETRIES = env_int('YTDL_THROTTLE_RETRIES', 5)
+THROTTLED_KBPS = env_int('YTDL_THROTTLED_KBPS', 64)
+
+# FFmpeg encodes (e.g. audio converted to MP3): how many run at once, one core each, and how much
+# their CPU priority is lowered (niceness added; 0 keeps the app's priority)
+FFMPEG_CORES = env_int('YTDL_FFMPEG_CORES', max(1, (os.cpu_count() or 2) // 2))
+FFMPEG_NICE = env_int('YTDL_FFMPEG_NICE', 10)
+
+# Prometheus metrics endpoint (http://<host>:<port>/metrics; port 0 disables it)
+METRICS_HOST = env_str('YTDL_METRICS_HOST', '127.0.0.1')
+METRICS_PORT = env_int('YTDL_METRICS_PORT', 8511)
+
+# Background download jobs
+JOB_WORKERS = env_int('YTDL_JOB_WORKERS', 4)  # Downloads running at once, across all users
+JOB_QUEUE_SIZE = env_int('YTDL_JOB_QUEUE_SIZE', 32)  # Jobs waiting for a worker before new ones are refused
+JOB_USER_RUNNING = env_int('YTDL_JOB_USER_RUNNING', 1)  # Downloads running at once for one user
+JOB_USER_PENDING = env_int('YTDL_JOB_USER_PENDING', 3)  # Downloads one user may have queued or running
+
+# Batch and playlist downloads
+BATCH_CONCURRENCY = env_int('YTDL_BATCH_CONCURRENCY', 3)  # Default items downloaded at once per batch
+BATCH_MAX_CONCURRENCY = env_int('YTDL_BATCH_MAX_CONCURRENCY', 8)
+BATCH_MAX_ITEMS = env_int('YTDL_BATCH_MAX_ITEMS', 200)
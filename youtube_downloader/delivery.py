@@ -0,0 +1,322 @@
+"""Serve finished downloads from disk through signed, expiring links
+
+st.download_button keeps the whole file in memory for as long as the session
+lives. Instead, finished files are moved into a delivery directory and a small
+HTTP server running next to the app streams them to the browser in chunks, so
+memory use per download stays constant no matter how big the file is.
+
+Links work on every replica of the app: they share the signing secret
+through the shared state, and a replica that doesn't have a file on disk
+streams it from the replica that does (the one at the origin URL recorded
+for the file). Files in another replica's download cache are linked
+directly, without copying them first.
+"""
+import base64
+import hashlib
+import hmac
+import mimetypes
+import os
+import re
+import secrets
+import shutil
+import threading
+import time
+from collections import namedtuple
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.error import HTTPError
+from urllib.parse import parse_qs, quote, unquote, urlencode, urlsplit
+from urllib.request import Request, urlopen
+
+from . import config
+from .download_cache import download_cache
+from .state import shared_state
+
+CHUNK_SIZE = 1024 * 1024
+# Set on requests one replica passes to another, which never pass them on again
+PROXIED_HEADER = 'X-Ytdl-Proxied'
+PROXY_TIMEOUT = 30
+# Response headers copied from the replica that has the file
+PROXIED_RESPONSE_HEADERS = ('Content-Type', 'Content-Length', 'Content-Range', 'Accept-Ranges', 'Content-Disposition')
+
+# A published file: the signed link, the delivered copy on disk and the link's expiry time
+Published = namedtuple('Published', ['url', 'path', 'expires'])
+
+
+_secret = None
+_secret_lock = threading.Lock()
+_server = None
+_server_lock = threading.Lock()
+
+
+def _shared_secret():
+    """Return the signing secret all replicas agreed on, generating it if this is the first one"""
+    shared_state.add('delivery:secret', secrets.token_hex(32))
+    return shared_state.get('delivery:secret')
+
+
+def _signing_key():
+    """Return the signing secret, resolving it on first use (importing the package touches no state)"""
+    global _secret
+    with _secret_lock:
+        if _secret is None:
+            _secret = (config.DELIVERY_SECRET or _shared_secret()).encode()
+        return _secret
+
+
+def _sign(file_id, name, mime_type, expires):
+    """Return the URL-safe HMAC signature for a delivery link"""
+    message = f'{file_id}/{name}|{mime_type}|{expires}'.encode()
+    digest = hmac.new(_signing_key(), message, hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b'=').decode()
+
+
+def safe_name(name):
+    """Make a download name usable as a single path component"""
+    name = re.sub(r'[\\/:*?"<>|\x00-\x1f]', '_', name).strip(' .')
+    return name or 'download'
+
+
+def link_or_copy(source, target):
+    """Hard-link source to target (replacing it), copying when linking isn't possible
+
+    Hard links cost nothing and keep the bytes alive even if the source is removed.
+    """
+    if os.path.exists(target):
+        os.remove(target)
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+
+
+def _store(file_path, name, move):
+    """Place a file in its own delivery directory and return (file ID, directory, path)"""
+    file_id = secrets.token_urlsafe(12)
+    target_dir = os.path.join(config.DELIVERY_DIR, file_id)
+    os.makedirs(target_dir)
+    target = os.path.join(target_dir, name)
+    if move:
+        shutil.move(str(file_path), target)
+    else:
+        link_or_copy(file_path, target)
+    return file_id, target_dir, target
+
+
+def purge_expired():
+    """Remove delivered files whose links have expired"""
+    if not os.path.isdir(config.DELIVERY_DIR):
+        return
+    now = time.time()
+    for entry in os.scandir(config.DELIVERY_DIR):
+        # publish() sets each directory's mtime to the link expiry time
+        try:
+            if entry.is_dir() and entry.stat().st_mtime < now:
+                shutil.rmtree(entry.path, ignore_errors=True)
+        except OSError:
+            pass
+
+
+def _link(kind, file_id, name, mime_type, expires):
+    """Return the signed public URL of a file"""
+    query = urlencode({
+        'type': mime_type,
+        'expires': expires,
+        'sig': _sign(_signed_id(kind, file_id), name, mime_type, expires),
+    })
+    return f"{config.DELIVERY_PUBLIC_URL.rstrip('/')}/{kind}/{file_id}/{quote(name)}?{query}"
+
+
+def _signed_id(kind, file_id):
+    # Cache links are signed in their own ID space, so a files link can't be turned into one
+    return file_id if kind == 'files' else f'{kind}:{file_id}'
+
+
+def publish(file_path, file_name=None, mime_type=None, move=True, ttl=None):
+    """Make a file downloadable and return it as Published (signed link, path, expiry)
+
+    By default the file is moved out of its current location, so it survives
+    the temporary directory it was downloaded into.
+    """
+    ensure_server()
+    purge_expired()
+
+    name = safe_name(file_name or os.path.basename(file_path))
+    mime_type = mime_type or mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    expires = int(time.time() + (ttl or config.DELIVERY_TTL))
+
+    file_id, target_dir, target = _store(file_path, name, move)
+    os.utime(target_dir, (expires, expires))
+    if config.REPLICA_URL:
+        # Tell the other replicas where to fetch the file from
+        shared_state.set(f'delivery:{file_id}', {'origin': config.REPLICA_URL}, ttl=expires - time.time())
+    return Published(_link('files', file_id, name, mime_type, expires), target, expires)
+
+
+def publish_cached(key, file_name, mime_type, ttl=None):
+    """Return a signed link to a download cache entry, served by whichever replica has it
+
+    Nothing is copied, so unlike publish() the link stops working if the
+    entry is evicted before the link expires.
+    """
+    ensure_server()
+    name = safe_name(file_name)
+    expires = int(time.time() + (ttl or config.DELIVERY_TTL))
+    return Published(_link('cache', key, name, mime_type, expires), None, expires)
+
+
+def _parse_range(header, size):
+    """Parse a single 'bytes=start-end' Range header into an inclusive (start, end) pair"""
+    match = re.fullmatch(r'bytes=(\d*)-(\d*)', (header or '').strip())
+    if not match or match.group(1) == match.group(2) == '':
+        return None
+    start, end = match.groups()
+    if start == '':
+        # Suffix range: the last N bytes
+        start, end = max(size - int(end), 0), size - 1
+    else:
+        start, end = int(start), min(int(end), size - 1) if end else size - 1
+    if start > end or start >= size:
+        return None
+    return start, end
+
+
+class _DeliveryHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self._serve(send_body=True)
+
+    def do_HEAD(self):
+        self._serve(send_body=False)
+
+    def log_message(self, format, *args):
+        # Keep the Streamlit console readable
+        pass
+
+    def _error(self, status, message):
+        body = message.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _local_path(self, kind, file_id, name):
+        """Return the path of a linked file on this replica's disk, or None"""
+        if kind == 'cache':
+            # Serving a link is no use of the cache entry: no stats, LRU touch or index write
+            entry = download_cache.peek(file_id) if re.fullmatch(r'[0-9a-f]{64}', file_id) else None
+            return str(entry[0]) if entry else None
+        path = os.path.join(config.DELIVERY_DIR, file_id, name)
+        if os.path.basename(path) != name or not os.path.isfile(path):
+            return None
+        return path
+
+    def _proxy(self, kind, file_id, send_body):
+        """Stream a file from the replica that has it; return False if no other replica has it"""
+        if self.headers.get(PROXIED_HEADER):
+            return False
+        record = shared_state.get(f"{'delivery' if kind == 'files' else kind}:{file_id}")
+        if not record or record['origin'] == config.REPLICA_URL:
+            return False
+        headers = {PROXIED_HEADER: config.REPLICA_ID}
+        if 'Range' in self.headers:
+            headers['Range'] = self.headers['Range']
+        request = Request(record['origin'].rstrip('/') + self.path, headers=headers,
+                          method='GET' if send_body else 'HEAD')
+        try:
+            response = urlopen(request, timeout=PROXY_TIMEOUT)
+        except HTTPError as e:
+            # Pass the other replica's 404, 410 or 416 on as it is
+            response = e
+        except OSError:
+            self._error(502, 'The server holding this file is unavailable')
+            return True
+        with response:
+            self.send_response(response.status)
+            for header in PROXIED_RESPONSE_HEADERS:
+                if response.headers.get(header) is not None:
+                    self.send_header(header, response.headers[header])
+            self.end_headers()
+            if not send_body:
+                return True
+            try:
+                while chunk := response.read(CHUNK_SIZE):
+                    self.wfile.write(chunk)
+            except (BrokenPipeError, ConnectionResetError):
+                # The browser cancelled the download
+                pass
+        return True
+
+    def _serve(self, send_body):
+        parts = urlsplit(self.path)
+        segments = parts.path.split('/')
+        if len(segments) != 4 or segments[1] not in ('files', 'cache'):
+            return self._error(404, 'Not found')
+        kind, file_id, name = segments[1], segments[2], unquote(segments[3])
+        query = {key: values[0] for key, values in parse_qs(parts.query).items()}
+
+        try:
+            expires = int(query.get('expires', ''))
+        except ValueError:
+            return self._error(403, 'Invalid link')
+        mime_type = query.get('type', 'application/octet-stream')
+        expected = _sign(_signed_id(kind, file_id), name, mime_type, expires)
+        if not hmac.compare_digest(query.get('sig', ''), expected):
+            return self._error(403, 'Invalid link')
+        if expires < time.time():
+            return self._error(410, 'This download link has expired')
+
+        path = self._local_path(kind, file_id, name)
+        if path is None:
+            if self._proxy(kind, file_id, send_body):
+                return
+            return self._error(404, 'File not found')
+
+        size = os.path.getsize(path)
+        byte_range = _parse_range(self.headers.get('Range'), size) if 'Range' in self.headers else None
+        if 'Range' in self.headers and byte_range is None:
+            self.send_response(416)
+            self.send_header('Content-Range', f'bytes */{size}')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        start, end = byte_range or (0, size - 1)
+
+        self.send_response(206 if byte_range else 200)
+        self.send_header('Content-Type', mime_type)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Disposition', f"attachment; filename*=UTF-8''{quote(name)}")
+        if byte_range:
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        self.end_headers()
+        if not send_body:
+            return
+
+        try:
+            with open(path, 'rb') as f:
+                f.seek(start)
+                remaining = end - start + 1
+                while remaining > 0:
+                    chunk = f.read(min(CHUNK_SIZE, remaining))
+                    if not chunk:
+                        break
+                    self.wfile.write(chunk)
+                    remaining -= len(chunk)
+        except (BrokenPipeError, ConnectionResetError):
+            # The browser cancelled the download
+            pass
+
+
+def ensure_server():
+    """Start the delivery HTTP server once per process"""
+    global _server
+    with _server_lock:
+        if _server is None:
+            os.makedirs(config.DELIVERY_DIR, exist_ok=True)
+            server = ThreadingHTTPServer((config.DELIVERY_HOST, config.DELIVERY_PORT), _DeliveryHandler)
+            server.daemon_threads = True
+            threading.Thread(target=server.serve_forever, name='delivery-server', daemon=True).start()
+            _server = server
+    return _server
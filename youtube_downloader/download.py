@@ -0,0 +1,728 @@
+"""The download pipeline: pick a format, run yt-dlp and publish the file
+
+This runs in job worker threads, so it must not touch Streamlit. Problems the
+user can act on are raised as DownloadError with a kind the UI knows how to
+explain; informational messages are attached to the job with job.note().
+"""
+import logging
+import os
+import shutil
+import threading
+import time
+from collections import namedtuple
+from dataclasses import replace
+from pathlib import Path
+
+from . import config, delivery, ffmpeg, journal, metrics, ratelimit
+from .delivery import link_or_copy
+from .download_cache import cache_key, download_cache
+from .formats import Policy, index_for
+from .info_cache import extract_info, video_key
+from .jobs import QueueFull, TooManyJobs, job_manager
+from .journal import Journal, output_files
+from .progress import ProgressReporter
+from .storage import storage
+from .transcode import AUDIO_FORMATS, DEFAULT_AUDIO_FORMAT, DEFAULT_AUDIO_QUALITY, audio_selector
+
+logger = logging.getLogger(__name__)
+
+MODES = ('video', 'audio')
+QUALITIES = ('best', '1080p', '720p', '480p', '360p', 'worst')
+
+# Only MP4 formats with both video and audio (strict format selector)
+# This format selector requires both vcodec and acodec to be present
+# (fallback for when the formats can't be inspected beforehand)
+PROGRESSIVE_QUALITY_MAP = {
+    "best": "best[ext=mp4][vcodec*=avc][acodec*=mp4a]/best[ext=mp4][vcodec][acodec]",
+    "1080p": "best[height<=1080][ext=mp4][vcodec*=avc][acodec*=mp4a]/best[height<=1080][ext=mp4][vcodec][acodec]",
+    "720p": "best[height<=720][ext=mp4][vcodec*=avc][acodec*=mp4a]/best[height<=720][ext=mp4][vcodec][acodec]",
+    "480p": "best[height<=480][ext=mp4][vcodec*=avc][acodec*=mp4a]/best[height<=480][ext=mp4][vcodec][acodec]",
+    "360p": "best[height<=360][ext=mp4][vcodec*=avc][acodec*=mp4a]/best[height<=360][ext=mp4][vcodec][acodec]",
+    "worst": "worst[ext=mp4][vcodec][acodec]",
+}
+
+# With ffmpeg, we can merge best video + best audio
+# (fallback selectors for when the formats can't be inspected beforehand)
+MERGE_QUALITY_MAP = {
+    "best": "bestvideo+bestaudio/best",
+    "1080p": "bestvideo[height<=1080]+bestaudio/best[height<=1080]",
+    "720p": "bestvideo[height<=720]+bestaudio/best[height<=720]",
+    "480p": "bestvideo[height<=480]+bestaudio/best[height<=480]",
+    "360p": "bestvideo[height<=360]+bestaudio/best[height<=360]",
+    "worst": "worstvideo+worstaudio/worst",
+}
+
+AUDIO_MIME_MAP = {
+    '.mp3': 'audio/mpeg',
+    '.m4a': 'audio/mp4',
+    '.webm': 'audio/webm',
+    '.opus': 'audio/ogg',
+    '.ogg': 'audio/ogg',
+    '.flac': 'audio/flac',
+}
+
+VIDEO_MIME_MAP = {
+    '.mp4': 'video/mp4',
+    '.webm': 'video/webm',
+    '.mkv': 'video/x-matroska',
+    '.flv': 'video/x-flv',
+}
+
+
+# Job owners of speculative downloads start with this (see prefetch)
+PREFETCH_OWNER = 'prefetch:'
+
+
+class DownloadError(Exception):
+    """A download failure the user can act on
+
+    kind is one of 'no_mp4', 'ffmpeg_required', 'section_ffmpeg',
+    'multiple_files', 'too_small' or 'not_found'.
+    """
+
+    def __init__(self, message, kind):
+        super().__init__(message)
+        self.kind = kind
+
+
+# A part of a video to download: start and end in seconds (end None for the rest of the video),
+# and whether to re-encode around the cuts so they land exactly on those times
+Section = namedtuple('Section', ['start', 'end', 'precise'])
+
+
+def parse_time(value):
+    """Return a time in seconds from a number or a '[[HH:]MM:]SS' string; None when empty"""
+    if value is None or value == '':
+        return None
+    # yt-dlp (and the modules built on it) is imported on first use, so the app starts without it
+    from yt_dlp.utils import parse_duration
+
+    seconds = float(value) if isinstance(value, (int, float)) else parse_duration(str(value).strip())
+    if seconds is None:
+        raise ValueError(f"Not a time: {value!r} (use seconds or [HH:]MM:SS)")
+    if seconds < 0:
+        raise ValueError("Times can't be negative")
+    return seconds
+
+
+def clip_section(start_time=None, end_time=None, precise_cuts=False):
+    """Return the Section for start and end times, or None for the whole video"""
+    start, end = parse_time(start_time) or 0.0, parse_time(end_time)
+    if not start and end is None:
+        return None
+    if end is not None and end <= start:
+        raise ValueError("The end time must be after the start time")
+    return Section(start, end, bool(precise_cuts))
+
+
+def section_share(section, duration):
+    """Return the share of a video's duration a section covers (1 for the whole video or an unknown duration)"""
+    if not section or not duration:
+        return 1.0
+    end = min(section.end or duration, duration)
+    return max(0.0, end - section.start) / duration or 1.0
+
+
+def _limit(requested, ceiling):
+    """Return the lower of two limits where 0 or None means no limit"""
+    limits = [limit for limit in (requested, ceiling) if limit]
+    return min(limits) if limits else None
+
+
+def size_budget(max_size_mb=None, target_seconds=None):
+    """Return the most bytes a download may take, or None for no limit
+
+    That is the smaller of max_size_mb and what the measured throughput
+    downloads in target_seconds. The configured limits are ceilings for both.
+    """
+    from .parallel import throughput
+
+    budgets = []
+    max_size_mb = _limit(max_size_mb, config.MAX_DOWNLOAD_MB)
+    if max_size_mb:
+        budgets.append(max_size_mb * 1024 * 1024)
+    target_seconds = _limit(target_seconds, config.TARGET_DOWNLOAD_SECONDS)
+    rate = throughput.estimate()
+    # Before the first measured download a target time can't be turned into a size
+    if target_seconds and rate:
+        budgets.append(int(rate * target_seconds))
+    return min(budgets) if budgets else None
+
+
+def video_policy(quality, max_size=None):
+    """Return the format selection Policy for a video quality and size budget in bytes"""
+    policy = Policy.for_quality(quality, max_size=max_size)
+    if config.VIDEO_CODECS:
+        policy = policy.prefer_video_codecs(*config.VIDEO_CODECS)
+    return policy
+
+
+def select_progressive_format(index, policy):
+    """Pick the best complete (video + audio) MP4 format for a policy"""
+    # Complete files only: DASH/manifest formats are adaptive and come as separate streams
+    if not index.progressive():
+        # No complete formats available - this video needs FFmpeg
+        raise DownloadError("This video only has separate video and audio streams.", 'ffmpeg_required')
+    # MP4 only (most compatible), and H.264 first among formats of the same resolution
+    selected = index.select_progressive(replace(policy.prefer_video_codecs('h264'), ext='mp4'))
+    if selected is None:
+        raise DownloadError("No complete MP4 format available for this video.", 'no_mp4')
+    return selected
+
+
+def select_formats(index, quality, has_ffmpeg, max_size=None):
+    """Return the Format rows to download for a video quality (two to merge with FFmpeg)
+
+    With max_size (bytes) the highest quality whose estimated size fits is
+    picked, or the smallest available when nothing fits.
+    """
+    policy = video_policy(quality, max_size)
+    if not has_ffmpeg:
+        return [select_progressive_format(index, policy)]
+    pair = index.select_merge(policy)
+    # A complete file is used when there are no separate streams (common outside YouTube),
+    # or when the streams are all above the requested resolution and it is not
+    selected = index.select_progressive(policy)
+    if pair and not (selected and policy.max_height and pair[0].height > policy.max_height >= selected.height):
+        return list(pair)
+    if selected is None:
+        raise DownloadError("No downloadable video format found.", 'not_found')
+    return [selected]
+
+
+def flight_key(url, mode, quality, has_ffmpeg, max_size_mb=None, target_seconds=None, section=None,
+               audio_format=DEFAULT_AUDIO_FORMAT):
+    """Return the key identical concurrent downloads are coalesced under
+
+    The format selector follows from the mode, quality, size limits and FFmpeg
+    availability, so together with the video ID, the section (see
+    clip_section) and the audio output format these identify the output file.
+    """
+    return (video_key(url), mode, quality, has_ffmpeg, max_size_mb or None, target_seconds or None, section,
+            audio_format if mode == 'audio' and has_ffmpeg else None)
+
+
+def request_key(request):
+    """Return the flight_key of a download given as run_download keyword arguments"""
+    return flight_key(request['url'], request['mode'], request['quality'], request['has_ffmpeg'],
+                      request.get('max_size_mb'), request.get('target_seconds'),
+                      clip_section(request.get('start_time'), request.get('end_time'),
+                                   request.get('precise_cuts', False)),
+                      request.get('audio_format', DEFAULT_AUDIO_FORMAT))
+
+
+def _note_budget(job, selected, unlimited, max_size, share=1.0):
+    """Tell the user when the size budget lowered the quality
+
+    share is the part of the formats that is downloaded (see section_share).
+    """
+    if selected == unlimited:
+        return
+    size = sum(row.filesize or 0 for row in selected) * share
+    max_size *= share
+    heights = [row.height for row in selected if row.vcodec]
+    job.note('info', f"📉 Picked {heights[0] if heights else '?'}p instead of "
+                     f"{max(row.height for row in unlimited)}p to stay within "
+                     f"{max_size / (1024 * 1024):.0f} MB (about {size / (1024 * 1024):.0f} MB)")
+
+
+def build_ydl_opts(job, url, mode, quality, has_ffmpeg, network_opts, connections=0, max_size=None, section=None,
+                   audio_format=DEFAULT_AUDIO_FORMAT):
+    """Assemble the yt-dlp options for a download (run_download adds the output template)
+
+    connections is the number of parallel connections per stream, 0 to tune it automatically.
+    max_size is the size budget of a video download in bytes (see size_budget).
+    section is the Section to download, None for the whole video.
+    audio_format is the output format of an audio download with FFmpeg (see transcode.AUDIO_FORMATS).
+    """
+    from yt_dlp.utils import download_range_func
+
+    from .parallel import fragment_connections
+
+    retry_count = network_opts['retries']
+    timeout_seconds = network_opts['socket_timeout']
+    ydl_opts = {
+        # Progress and results are reported through hooks; yt-dlp's console output isn't needed
+        'quiet': True,
+        # Network timeout settings
+        **network_opts,
+        'fragment_retries': retry_count,  # Retries for fragments
+        'file_access_retries': 3,  # Retries for file access
+        # Download settings
+        'external_downloader_args': {
+            'default': [f'--timeout={timeout_seconds}', f'--retries={retry_count}'],
+            # FFmpeg (which downloads sections) doesn't take these
+            'ffmpeg': [],
+        },
+        'noprogress': True,
+        # Continue .part files left by an interrupted attempt instead of starting over
+        'continuedl': True,
+        # Parallel downloading: DASH/HLS fragments and byte ranges of progressive files
+        'concurrent_fragment_downloads': fragment_connections(connections),
+        'range_connections': connections,
+        # Player code and signature functions yt-dlp worked out, kept across downloads and restarts
+        'cachedir': config.YTDLP_CACHE_DIR,
+    }
+    if has_ffmpeg:
+        # Use the binaries the probe found (they may not be in PATH on Windows)
+        location = ffmpeg.get_probe().location
+        if location:
+            ydl_opts['ffmpeg_location'] = location
+    if section:
+        # FFmpeg reads only the fragments or byte ranges covering the section and cuts them
+        # with stream copy (cuts snap to keyframes), or re-encodes around them for exact cuts
+        ydl_opts['download_ranges'] = download_range_func(None, [(section.start, section.end or float('inf'))])
+        ydl_opts['force_keyframes_at_cuts'] = section.precise
+
+    if mode == 'audio':
+        # Download best audio format available
+        if has_ffmpeg:
+            # With FFmpeg, we can convert to the requested format; sources already in its codec
+            # are preferred, since they only need copying (see transcode.plan_audio)
+            ydl_opts.update({
+                'format': audio_selector(audio_format),
+                'postprocessors': [{
+                    'key': 'FFmpegExtractAudio',
+                    'preferredcodec': audio_format,
+                    'preferredquality': DEFAULT_AUDIO_QUALITY,
+                }],
+            })
+        else:
+            # Without FFmpeg, download in native format
+            ydl_opts.update({
+                'format': 'bestaudio[ext=m4a]/bestaudio[ext=webm]/bestaudio/best',
+            })
+    else:
+        # Resolve the quality to format IDs from the index of the (usually cached) extraction
+        try:
+            info = extract_info(url, network_opts)
+            index = index_for(info)
+            # Only the section's share of each format is downloaded
+            share = section_share(section, info.get('duration'))
+            if max_size:
+                max_size = int(max_size / share)
+            selected = select_formats(index, quality, has_ffmpeg, max_size)
+            ydl_opts['format'] = '+'.join(row.format_id for row in selected)
+            if max_size:
+                _note_budget(job, selected, select_formats(index, quality, has_ffmpeg), max_size, share)
+
+            # Show selected format details for debugging
+            video = next((row for row in selected if row.vcodec), selected[0]).info
+            audio = next((row for row in selected if row.acodec), selected[-1]).info
+            job.note('info', f"📋 Selected format: {ydl_opts['format']} | "
+                             f"Resolution: {video.get('resolution', 'N/A')} | "
+                             f"Video: {(video.get('vcodec') or 'N/A')[:10]} | "
+                             f"Audio: {(audio.get('acodec') or 'N/A')[:10]}")
+        except DownloadError:
+            raise
+        except Exception as e:
+            job.note('error', f"❌ Error checking formats: {str(e)}")
+            if has_ffmpeg:
+                ydl_opts['format'] = MERGE_QUALITY_MAP.get(quality, "bestvideo+bestaudio/best")
+            else:
+                job.note('info', "Trying MP4-only format selection...")
+                ydl_opts['format'] = PROGRESSIVE_QUALITY_MAP.get(quality, "best[ext=mp4][vcodec][acodec]")
+
+        if has_ffmpeg:
+            ydl_opts['merge_output_format'] = 'mp4'
+        else:
+            ydl_opts['prefer_free_formats'] = False
+
+    return ydl_opts
+
+
+def _output_name(file_path, meta, mode):
+    """Return the MIME type, extension and download name of a finished file"""
+    # Determine MIME type and extension from actual file
+    file_ext = file_path.suffix.lower()
+    if mode == 'audio':
+        mime_type = AUDIO_MIME_MAP.get(file_ext, 'audio/mpeg')
+        extension = file_ext.lstrip('.') or 'mp3'
+    else:
+        mime_type = VIDEO_MIME_MAP.get(file_ext, 'video/mp4')
+        extension = file_ext.lstrip('.') or 'mp4'
+
+    stem = meta['title'][:50]
+    if meta.get('section'):
+        start, end = meta['section']
+        stem += f" [{start:g}s-{f'{end:g}s' if end is not None else 'end'}]"
+    return mime_type, extension, delivery.safe_name(f"{stem}.{extension}")
+
+
+def _deliver(file_path, meta, mode, output_dir, cached, key=None):
+    """Publish a finished file (or save it into output_dir) and return the result dict
+
+    key is the file's download cache key, under which the storage keeps it
+    for other replicas and sessions.
+    """
+    mime_type, extension, file_name = _output_name(file_path, meta, mode)
+    file_size = file_path.stat().st_size
+    if output_dir is None:
+        # Link the file out of the cache and serve it from disk in chunks
+        # (st.download_button would hold the whole file in memory)
+        published = storage.publish(file_path, file_name, mime_type, key=key, meta=meta, move=False)
+        download_url, file_path = published.url, published.path
+    else:
+        os.makedirs(output_dir, exist_ok=True)
+        target = os.path.join(output_dir, file_name)
+        link_or_copy(file_path, target)
+        download_url, file_path = None, target
+
+    return dict(
+        meta,
+        cached=cached,
+        file_size=file_size,
+        mime_type=mime_type,
+        extension=extension,
+        download_url=download_url,
+        # None when only the storage keeps the file
+        file_path=str(file_path) if file_path else None,
+    )
+
+
+def _deliver_stored(download_key, entry, mode):
+    """Link to a file the storage already has (see Storage.lookup) and return the result dict"""
+    mime_type, extension, file_name = _output_name(Path(entry['file']), entry['meta'], mode)
+    return dict(
+        entry['meta'],
+        cached=True,
+        file_size=entry['size'],
+        mime_type=mime_type,
+        extension=extension,
+        download_url=storage.link(download_key, entry, file_name, mime_type),
+        file_path=None,
+    )
+
+
+def _requested_format_id(info_dict):
+    """Return the format ID yt-dlp resolved for a download, e.g. '137+140' for a merge"""
+    requested = info_dict.get('requested_formats')
+    if requested:
+        return '+'.join(f['format_id'] for f in requested)
+    return info_dict.get('format_id')
+
+
+def _download(job, url, mode, ydl_opts, network_opts, work_dir, journal, span, section=None, lease=None):
+    """Run yt-dlp in a working directory and return (file path, meta)
+
+    Phase timings and the bytes downloaded are recorded in span as they happen.
+    Stops like a cancellation once the lease on the working directory is lost.
+    """
+    from .parallel import THROUGHPUT_MIN_BYTES, THROUGHPUT_MIN_SECONDS, ParallelYoutubeDL, throughput
+    from .streaming import AudioOutputPP, StreamingExtractAudioPP
+
+    # Reuse the cached info dict instead of extracting the page again
+    started = time.monotonic()
+    info = extract_info(url, network_opts)
+    span['timings']['extracting_info'] = time.monotonic() - started
+    job.check_cancelled()
+
+    # Partial bytes only fit the formats they were downloaded from, so pin those
+    available = {f.get('format_id') for f in info.get('formats') or []}
+    format_id = journal.get('format_id')
+    resumed_bytes = 0
+    if format_id and set(format_id.split('+')) <= available:
+        ydl_opts['format'] = format_id
+        resumed_bytes = journal.resumed_bytes
+        if resumed_bytes:
+            resumed_mb = resumed_bytes / (1024 * 1024)
+            job.note('info', f"♻️ Resuming interrupted download ({resumed_mb:.1f} MB already downloaded)")
+
+    def record_progress(d):
+        # Journal the resolved formats once, and the part files whenever a stream finishes
+        if journal.get('format_id') is None or d.get('status') == 'finished':
+            journal.update(format_id=journal.get('format_id') or _requested_format_id(d.get('info_dict') or {}))
+
+    def check(d):
+        job.check_cancelled()
+        # Another replica took over the working directory: stop writing to it
+        if lease is not None:
+            lease.check()
+
+    # Report structured progress to the job, and stop at the next update once it is cancelled
+    reporter = ProgressReporter(job.publish_progress, timings=span['timings'])
+    ydl_opts['progress_hooks'] = [check, record_progress, reporter.progress_hook]
+    ydl_opts['postprocessor_hooks'] = [check, reporter.postprocessor_hook]
+
+    # Audio is kept, remuxed or re-encoded as its codec requires (see transcode), and re-encoded while
+    # it downloads instead of in a second pass over the finished file (sections are written by FFmpeg
+    # itself, so they are converted afterwards)
+    extract_audio = [pp for pp in ydl_opts.get('postprocessors', []) if pp['key'] == 'FFmpegExtractAudio']
+    if extract_audio:
+        ydl_opts['postprocessors'] = [pp for pp in ydl_opts['postprocessors'] if pp not in extract_audio]
+
+    with ParallelYoutubeDL(ydl_opts) as ydl:
+        for options in extract_audio:
+            audio_pp = (AudioOutputPP if section else StreamingExtractAudioPP)(
+                ydl,
+                ffmpeg.get_probe().ffmpeg_path or 'ffmpeg',
+                audio_format=options['preferredcodec'],
+                quality=options['preferredquality'],
+            )
+            ydl.add_post_processor(audio_pp)
+            if not section:
+                ydl.live_postprocessors.append(audio_pp)
+        try:
+            info = ydl.process_ie_result(info, download=True)
+        finally:
+            # Encodes whose postprocessor never ran (an earlier one failed, or the job was cancelled)
+            # would otherwise keep FFmpeg running and their transcode pool slots taken
+            for pp in ydl.live_postprocessors:
+                pp.abort_all()
+    # Measure the link for size-aware quality selection (bytes of an earlier attempt weren't timed)
+    downloaded = reporter.downloaded_bytes - resumed_bytes
+    download_seconds = span['timings'].get('downloading', 0)
+    throughput.record(downloaded, download_seconds)
+    span['downloaded_bytes'] = downloaded
+    metrics.download_bytes.inc(downloaded)
+    if download_seconds:
+        metrics.download_throughput.observe(downloaded / download_seconds)
+    # A host that delivered at a crawl is throttling us; later requests to it back off
+    if downloaded >= THROUGHPUT_MIN_BYTES and download_seconds >= THROUGHPUT_MIN_SECONDS:
+        hosts = {ratelimit.host_of(fmt['url']): fmt['url']
+                 for fmt in info.get('requested_formats') or [info] if fmt.get('url')}
+        for format_url in hosts.values():
+            ratelimit.scheduler.report_speed(format_url, downloaded / download_seconds)
+
+    index = index_for(info)
+    formats = [index.get(format_id) for format_id in (_requested_format_id(info) or '').split('+')]
+    share = section_share(section, info.get('duration'))
+    duration = (info.get('duration') or 0) * share
+    if section and not info.get('duration') and section.end is not None:
+        duration = section.end - section.start
+    meta = {
+        'title': info.get('title', 'video'),
+        'duration': round(duration),
+        # Get the format that was actually used
+        'format_id': info.get('format_id', 'unknown'),
+        'ext': info.get('ext', 'unknown'),
+        'vcodec': info.get('vcodec', 'unknown'),
+        'acodec': info.get('acodec', 'unknown'),
+        'thumbnail': info.get('thumbnail'),
+        # What the info dict led us to expect, to spot truncated files
+        'estimated_size': (int(sum(row.filesize for row in formats) * share)
+                           if all(row and row.filesize for row in formats) else None),
+        'section': [section.start, section.end] if section else None,
+    }
+
+    # Find the downloaded file(s), leaving out .part files (incomplete downloads) and the journal
+    downloaded_files = output_files(work_dir)
+    if not downloaded_files:
+        raise DownloadError("File not found after download", 'not_found')
+    # Check if multiple files were downloaded (video + audio separate)
+    if len(downloaded_files) > 1:
+        raise DownloadError("Multiple files downloaded - video and audio are separate!", 'multiple_files')
+    file_path = downloaded_files[0]
+
+    # Check if a video file is likely incomplete
+    if mode == 'video' and file_path.stat().st_size < 1024:
+        raise DownloadError("Downloaded file is too small - download may have failed", 'too_small')
+    return file_path, meta
+
+
+def run_download(job, url, mode, quality, has_ffmpeg, retry_count=10, timeout_seconds=60, output_dir=None,
+                 connections=None, max_size_mb=None, target_seconds=None, priority=ratelimit.NORMAL,
+                 start_time=None, end_time=None, precise_cuts=False, audio_format=DEFAULT_AUDIO_FORMAT):
+    """Download a URL and return a dict describing the resulting file
+
+    mode is 'video' or 'audio' and quality one of QUALITIES (ignored for
+    audio). The file is published through the delivery server, or saved into
+    output_dir when one is given. connections sets the parallel connections
+    per stream (0 tunes them automatically, None uses the configured
+    default). A video is downloaded in the highest quality up to quality
+    that fits max_size_mb, or that the measured throughput downloads within
+    target_seconds (see size_budget). priority ranks its requests against
+    others to the same host (ratelimit.BULK for batch items). A download
+    that was interrupted earlier continues from its partial files.
+
+    start_time and end_time (seconds or '[HH:]MM:SS') download only that
+    section, which needs FFmpeg: only the fragments or byte ranges covering
+    it are fetched, and it is cut with stream copy at the nearest keyframes,
+    or re-encoded around the cuts with precise_cuts.
+
+    audio_format is the output of an audio download with FFmpeg: 'mp3',
+    'm4a', 'opus' or 'best' (the source's codec). Sources already in that
+    codec are only copied; the others are re-encoded on the shared transcode
+    pool.
+
+    The result's 'timings' holds the seconds spent in each phase, which are
+    also recorded as metrics and logged as a span.
+    """
+    if mode not in MODES:
+        raise ValueError(f"mode must be one of {', '.join(MODES)}")
+    if mode == 'video' and quality not in QUALITIES:
+        raise ValueError(f"quality must be one of {', '.join(QUALITIES)}")
+    if mode == 'audio' and audio_format not in AUDIO_FORMATS:
+        raise ValueError(f"audio_format must be one of {', '.join(AUDIO_FORMATS)}")
+    if connections is None:
+        connections = config.DOWNLOAD_CONNECTIONS
+    section = clip_section(start_time, end_time, precise_cuts)
+
+    span = {'timings': {}}
+    started = time.monotonic()
+    outcome = 'failed'
+    try:
+        result = _run_download(job, span, url, mode, quality, has_ffmpeg, retry_count, timeout_seconds,
+                               output_dir, connections, max_size_mb, target_seconds, priority, section,
+                               audio_format)
+        outcome = 'cached' if result['cached'] else 'done'
+        span['timings']['total'] = time.monotonic() - started
+        result['timings'] = span['timings']
+        return result
+    except Exception as e:
+        # yt-dlp may wrap the JobCancelled raised in its hooks
+        if job.cancelled:
+            outcome = 'cancelled'
+        else:
+            span['error'] = metrics.classify_error(str(e), getattr(e, 'kind', None))
+            metrics.errors.inc(category=span['error'])
+        raise
+    finally:
+        timings = span['timings']
+        timings.setdefault('total', time.monotonic() - started)
+        for phase, seconds in timings.items():
+            metrics.phase_seconds.observe(seconds, phase=phase)
+        metrics.downloads.inc(outcome=outcome)
+        metrics.log_span(
+            'download',
+            job_id=job.id,
+            url=url,
+            mode=mode,
+            quality=quality,
+            section=section,
+            audio_format=audio_format if mode == 'audio' else None,
+            outcome=outcome,
+            error=span.get('error'),
+            queue_wait=job.started - job.created if job.started else None,
+            downloaded_bytes=span.get('downloaded_bytes'),
+            timings=timings,
+        )
+
+
+def _run_download(job, span, url, mode, quality, has_ffmpeg, retry_count, timeout_seconds, output_dir,
+                  connections, max_size_mb, target_seconds, priority, section, audio_format):
+    """run_download without the instrumentation"""
+    if section and not has_ffmpeg:
+        raise DownloadError("Downloading part of a video needs FFmpeg.", 'section_ffmpeg')
+    # Users who joined the job may have asked for a more urgent priority than its own
+    job.raise_priority(priority)
+    # Network timeout, retry and scheduling settings, also used when extracting video info
+    network_opts = {
+        'socket_timeout': timeout_seconds,  # Socket timeout in seconds
+        'retries': retry_count,  # Number of retries for downloads
+        'request_priority': job.priority,  # Rank against other requests to the same host
+    }
+    ydl_opts = build_ydl_opts(job, url, mode, quality, has_ffmpeg, network_opts, connections,
+                              max_size=size_budget(max_size_mb, target_seconds) if mode == 'video' else None,
+                              section=section, audio_format=audio_format)
+    # ...and may still join while it downloads (e.g. the real download of a prefetch)
+    ydl_opts['request_priority'] = lambda: job.priority
+
+    # An identical earlier download (same video, section, format and postprocessing) skips yt-dlp entirely
+    download_key = cache_key(video_key(url), ydl_opts, section)
+    cached = download_cache.lookup(download_key)
+    if cached:
+        started = time.monotonic()
+        result = _deliver(*cached, mode=mode, output_dir=output_dir, cached=True, key=download_key)
+        span['timings']['delivering'] = time.monotonic() - started
+        return result
+    # The storage (or another replica) may have it; such files can only be linked to (and zipped from the link),
+    # not saved here
+    stored = storage.lookup(download_key) if output_dir is None else None
+    if stored:
+        return _deliver_stored(download_key, stored, mode)
+
+    # Download into the key's persistent working directory, where earlier attempts left their partial files
+    if download_cache.working(download_key):
+        job.note('info', "⏳ The same file is already downloading elsewhere; waiting for it to finish")
+    # Waiting for the directory stops when the job is cancelled
+    with download_cache.work_dir(download_key, check=job.check_cancelled) as (work_dir, lease):
+        # Another process may have finished the same download while we waited for the directory
+        # (the lookup above already counted this request)
+        cached = download_cache.peek(download_key)
+        if cached:
+            return _deliver(*cached, mode=mode, output_dir=output_dir, cached=True, key=download_key)
+        # Name files by video ID so a resumed attempt writes to the same .part files
+        ydl_opts['outtmpl'] = os.path.join(work_dir, '%(id)s.%(ext)s')
+        job_journal = Journal(work_dir)
+        job_journal.update(
+            status=journal.RUNNING,
+            job_id=job.id,
+            owner=job.owner,
+            pid=os.getpid(),
+            # Jobs on the shared queue are re-queued if the process stops while they run
+            # (prefetches are only guesses, nobody is waiting on them)
+            restart=(job.parent is None and job_manager.get(job.id) is job
+                     and not str(job.owner).startswith(PREFETCH_OWNER)),
+            request=dict(url=url, mode=mode, quality=quality, has_ffmpeg=has_ffmpeg,
+                         retry_count=retry_count, timeout_seconds=timeout_seconds, connections=connections,
+                         max_size_mb=max_size_mb, target_seconds=target_seconds, priority=priority,
+                         start_time=section.start if section else None, end_time=section.end if section else None,
+                         precise_cuts=section.precise if section else False, audio_format=audio_format),
+        )
+        try:
+            file_path, meta = _download(job, url, mode, ydl_opts, network_opts, work_dir, job_journal, span,
+                                        section, lease)
+        except DownloadError:
+            # Retrying can't fix these, so there is nothing worth resuming (unless the directory is someone else's now)
+            if not lease.lost:
+                shutil.rmtree(work_dir, ignore_errors=True)
+            raise
+        except Exception as e:
+            # yt-dlp may wrap the JobCancelled raised in its hooks
+            if lease.lost:
+                pass  # The journal is the new holder's
+            elif job.cancelled:
+                job_journal.update(status=journal.CANCELLED)
+            else:
+                job_journal.update(status=journal.FAILED, error=str(e))
+            raise
+
+        # Files written after the lease was lost may have been overwritten by its new holder
+        lease.check()
+        started = time.monotonic()
+        file_path = download_cache.store(download_key, file_path, meta)
+        # Delivered before the working directory goes (files over the cache budget are still in it)
+        result = _deliver(file_path, meta, mode, output_dir, cached=False, key=download_key)
+        span['timings']['delivering'] = time.monotonic() - started
+    return result
+
+
+_resumed = False
+_resume_lock = threading.Lock()
+
+
+def resume_interrupted():
+    """Re-queue the downloads that were running when the process last stopped
+
+    Only does something on its first call in a process; returns the re-queued jobs.
+    They keep their job IDs, so a page reloaded with ?job=... finds its download again.
+    """
+    global _resumed
+    with _resume_lock:
+        if _resumed:
+            return []
+        _resumed = True
+
+    jobs = []
+    for work_dir in download_cache.work_dirs():
+        job_journal = Journal(work_dir)
+        request = job_journal.get('request')
+        if job_journal.get('status') != journal.RUNNING or not job_journal.get('restart') or not request:
+            continue
+        if job_journal.owner_alive() or download_cache.working(os.path.basename(work_dir)):
+            # Still downloading in another process or replica sharing the data directory
+            continue
+        try:
+            job = job_manager.submit(
+                job_journal.get('owner'),
+                run_download,
+                key=request_key(request),
+                job_id=job_journal.get('job_id'),
+                **request,
+            )
+        except (QueueFull, TooManyJobs) as e:
+            logger.warning("Not resuming download of %s: %s", request['url'], e)
+            continue
+        jobs.append(job)
+    return jobs
@@ -0,0 +1,288 @@
+"""Content-addressed on-disk cache of finished downloads
+
+Entries are keyed by (video ID, format selector, postprocessor settings), so
+ten users asking for the same video at the same quality cost one download.
+Each entry is a directory holding the file and a meta.json; entries are
+published with an atomic rename and evicted least-recently-used first once
+the cache exceeds its byte budget.
+
+Downloads in progress live in a working directory per key under .work, which
+outlives failures and restarts so the next attempt continues the partial files.
+
+Only one process of all replicas works on a key at a time (a shared state
+lock). Replicas that don't share the data directory record their entries in
+the shared state, so the others can link to them instead of downloading the
+video again.
+"""
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from pathlib import Path
+
+from . import config, metrics
+from .state import shared_state
+
+# yt-dlp options that change the bytes of the output file
+OUTPUT_OPTS = ('format', 'postprocessors', 'merge_output_format', 'prefer_free_formats')
+
+# Staging directories untouched for this long belong to a crashed or killed run
+ORPHAN_AGE = 3600
+
+META_FILE = 'meta.json'
+
+# Entries unused for this long drop out of the shared index (each use renews them)
+INDEX_TTL = 86400
+
+
+def cache_key(video_key, ydl_opts, section=None):
+    """Return the cache key for downloading a video (or a section of it) with the given yt-dlp options"""
+    material = {'video': video_key}
+    material.update({opt: ydl_opts.get(opt) for opt in OUTPUT_OPTS})
+    if section:
+        material['section'] = section
+    return hashlib.sha256(json.dumps(material, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _newest_mtime(path):
+    """Return the most recent mtime of a directory tree"""
+    newest = os.path.getmtime(path)
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                newest = max(newest, os.path.getmtime(os.path.join(dirpath, name)))
+            except OSError:
+                pass
+    return newest
+
+
+class DownloadCache:
+    """Size-bounded LRU cache of downloaded files"""
+
+    def __init__(self, root, max_bytes, resume_max_age=None, state=None):
+        self.root = root
+        self.state = state
+        self.max_bytes = max_bytes
+        self.resume_max_age = resume_max_age or config.RESUME_MAX_AGE
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._ready = False
+
+    @property
+    def staging_root(self):
+        return os.path.join(self.root, '.staging')
+
+    @property
+    def work_root(self):
+        return os.path.join(self.root, '.work')
+
+    def _ensure_ready(self):
+        """Create the cache directories and clean up after crashed runs, once per process"""
+        with self._lock:
+            if not self._ready:
+                os.makedirs(self.staging_root, exist_ok=True)
+                os.makedirs(self.work_root, exist_ok=True)
+                self.cleanup_orphans()
+                self._ready = True
+
+    def cleanup_orphans(self, max_age=ORPHAN_AGE):
+        """Remove staging, working and half-published directories (and their .part files) left by dead runs"""
+        cutoff = time.time() - max_age
+        # Partial downloads are worth keeping longer, for a retry to continue
+        work_cutoff = time.time() - max(max_age, self.resume_max_age)
+        candidates = [(entry.path, cutoff) for entry in os.scandir(self.root) if entry.name.startswith('.tmp-')]
+        candidates += [(entry.path, cutoff) for entry in os.scandir(self.staging_root)]
+        candidates += [(entry.path, work_cutoff) for entry in os.scandir(self.work_root)]
+        for path, path_cutoff in candidates:
+            try:
+                # yt-dlp keeps writing to its .part files, so a live download always looks fresh
+                if _newest_mtime(path) < path_cutoff:
+                    shutil.rmtree(path, ignore_errors=True)
+            except OSError:
+                pass
+
+    @contextlib.contextmanager
+    def staging_dir(self):
+        """Yield a scratch directory on the cache's filesystem, removed on exit"""
+        self._ensure_ready()
+        path = os.path.join(self.staging_root, uuid.uuid4().hex)
+        os.makedirs(path)
+        try:
+            yield path
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
+
+    @contextlib.contextmanager
+    def work_dir(self, key, check=None):
+        """Yield (path, lease) of the persistent working directory for downloading a key
+
+        The directory is only removed when the block succeeds; after an error it
+        keeps the partial files for the next attempt. One download at a time
+        per key, in any process or replica: check is called while waiting for
+        another one to finish (see SharedState.lock), and the block should
+        call lease.check() before publishing what it wrote, since a lost lease
+        means someone else is now working in the directory.
+        """
+        self._ensure_ready()
+        with self.state.lock(f'work:{key}', check=check) as lease:
+            path = os.path.join(self.work_root, key)
+            os.makedirs(path, exist_ok=True)
+            yield path, lease
+            # The directory belongs to the new holder of a lost lease
+            lease.check()
+            shutil.rmtree(path, ignore_errors=True)
+
+    def working(self, key):
+        """Return True if some process is downloading a key right now"""
+        return self.state.locked(f'work:{key}')
+
+    def work_dirs(self):
+        """Return the paths of the working directories left by unfinished downloads"""
+        self._ensure_ready()
+        return [entry.path for entry in os.scandir(self.work_root) if entry.is_dir()]
+
+    def _entry_dir(self, key):
+        return os.path.join(self.root, key)
+
+    def peek(self, key):
+        """Return (file path, meta) for a cached download, or None
+
+        Unlike lookup(), this leaves the hit/miss counters, the LRU order and
+        the shared index alone.
+        """
+        entry_dir = self._entry_dir(key)
+        try:
+            with open(os.path.join(entry_dir, META_FILE), encoding='utf-8') as f:
+                meta = json.load(f)
+            file_path = Path(entry_dir) / meta['file']
+        except (OSError, ValueError, KeyError):
+            return None
+        return (file_path, meta) if file_path.is_file() else None
+
+    def lookup(self, key):
+        """Return (file path, meta) for a cached download, or None"""
+        self._ensure_ready()
+        entry = self.peek(key)
+        if entry is not None:
+            try:
+                # The meta file's mtime records the last use for LRU eviction
+                os.utime(os.path.join(self._entry_dir(key), META_FILE))
+            except OSError:
+                entry = None
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        self._index(key, *entry)
+        return entry
+
+    def _index(self, key, file_path, meta):
+        """Record an entry in the shared index, for replicas that don't share the data directory"""
+        if config.REPLICA_URL:
+            self.state.set(f'cache:{key}', {
+                'origin': config.REPLICA_URL,
+                'file': file_path.name,
+                'size': file_path.stat().st_size,
+                'meta': meta,
+            }, ttl=INDEX_TTL)
+
+    def lookup_remote(self, key):
+        """Return {'origin', 'file', 'size', 'meta'} for a key cached by another replica, or None"""
+        if not config.REPLICA_URL:
+            return None
+        entry = self.state.get(f'cache:{key}')
+        if entry is None or entry['origin'] == config.REPLICA_URL:
+            return None
+        return entry
+
+    def store(self, key, file_path, meta):
+        """Move a finished download into the cache and return its new path
+
+        Files larger than the whole budget are not cached and are returned as-is.
+        """
+        self._ensure_ready()
+        file_path = Path(file_path)
+        if file_path.stat().st_size > self.max_bytes:
+            return file_path
+
+        # Publish atomically: build the entry under a temp name, then rename it into place
+        tmp_dir = os.path.join(self.root, f'.tmp-{uuid.uuid4().hex}')
+        os.makedirs(tmp_dir)
+        shutil.move(str(file_path), os.path.join(tmp_dir, file_path.name))
+        with open(os.path.join(tmp_dir, META_FILE), 'w', encoding='utf-8') as f:
+            json.dump(dict(meta, file=file_path.name), f)
+        try:
+            os.rename(tmp_dir, self._entry_dir(key))
+        except OSError:
+            # Another download of the same key was published first; keep that one
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            existing = self.peek(key)
+            if existing is None:
+                raise
+            return existing[0]
+
+        self.evict(keep=key)
+        stored = Path(self._entry_dir(key)) / file_path.name
+        self._index(key, stored, meta)
+        return stored
+
+    def _entries(self):
+        """Return (last used, size, path, key) for every published entry"""
+        entries = []
+        for entry in os.scandir(self.root):
+            if not entry.is_dir() or entry.name.startswith('.'):
+                continue
+            try:
+                last_used = os.path.getmtime(os.path.join(entry.path, META_FILE))
+                size = sum(f.stat().st_size for f in os.scandir(entry.path) if f.is_file())
+            except OSError:
+                continue
+            entries.append((last_used, size, entry.path, entry.name))
+        return entries
+
+    def evict(self, keep=None):
+        """Delete least-recently-used entries until the cache fits its byte budget"""
+        with self._lock:
+            entries = sorted(self._entries())
+            total = sum(size for _, size, _, _ in entries)
+            for _, size, path, key in entries:
+                if total <= self.max_bytes:
+                    break
+                if key == keep:
+                    continue
+                shutil.rmtree(path, ignore_errors=True)
+                total -= size
+                self.evictions += 1
+                self._unindex(key)
+
+    def _unindex(self, key):
+        """Remove an evicted entry from the shared index, unless another replica has indexed its own copy"""
+        if not config.REPLICA_URL:
+            return
+        entry = self.state.get(f'cache:{key}')
+        if entry is not None and entry['origin'] == config.REPLICA_URL:
+            self.state.delete(f'cache:{key}', entry)
+
+    def stats(self):
+        """Return hit/miss counters and current size"""
+        entries = self._entries() if os.path.isdir(self.root) else []
+        with self._lock:
+            return {
+                'entries': len(entries),
+                'bytes': sum(size for _, size, _, _ in entries),
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+download_cache = DownloadCache(config.DOWNLOAD_CACHE_DIR, config.DOWNLOAD_CACHE_MB * 1024 * 1024, state=shared_state)
+metrics.register_cache('download', download_cache)
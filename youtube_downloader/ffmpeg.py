@@ -0,0 +1,149 @@
+"""Locate FFmpeg on this machine and probe what it can do
+
+Probing runs `ffmpeg -version`, `ffprobe -version` and `ffmpeg -encoders`,
+and on Windows scans a few install directories, so the result is computed
+once per process and shared by the UI and the download pipeline. Call
+invalidate() after installing or upgrading FFmpeg to probe again.
+"""
+import glob
+import os
+import platform
+import re
+import shutil
+import subprocess
+import threading
+from dataclasses import dataclass, field
+
+# Common fixed install locations on Windows
+WINDOWS_FFMPEG_PATHS = [
+    r'C:\ffmpeg\bin\ffmpeg.exe',
+    r'C:\Program Files\ffmpeg\bin\ffmpeg.exe',
+    r'C:\Program Files (x86)\ffmpeg\bin\ffmpeg.exe',
+]
+
+# Any ffmpeg* directory in C:\ and Program Files
+WINDOWS_FFMPEG_PATTERNS = [
+    r'C:\ffmpeg*\bin\ffmpeg.exe',
+    r'C:\ffmpeg*\ffmpeg.exe',
+    r'C:\Program Files\ffmpeg*\bin\ffmpeg.exe',
+    r'C:\Program Files (x86)\ffmpeg*\bin\ffmpeg.exe',
+]
+
+# Encoder name suffixes of hardware-accelerated encoders (h264_vaapi, hevc_nvenc, ...)
+HARDWARE_ENCODER_SUFFIXES = ('_vaapi', '_qsv', '_nvenc', '_amf', '_videotoolbox', '_v4l2m2m', '_mf')
+
+PROBE_TIMEOUT = 5
+
+_probe = None
+_probe_lock = threading.Lock()
+
+
+@dataclass(frozen=True)
+class FFmpegProbe:
+    """What was found on this machine"""
+    ffmpeg_path: str = None
+    ffprobe_path: str = None
+    ffmpeg_version: str = None
+    ffprobe_version: str = None
+    in_path: bool = False  # False when only found by the Windows install-location scan
+    encoders: frozenset = field(default_factory=frozenset)
+    error: str = None  # why ffmpeg was found but couldn't be run
+    os: str = field(default_factory=platform.system)
+    python: str = field(default_factory=platform.python_version)
+
+    @property
+    def available(self):
+        return self.ffmpeg_version is not None
+
+    @property
+    def location(self):
+        """Directory holding the binaries, for yt-dlp's ffmpeg_location option"""
+        return os.path.dirname(self.ffmpeg_path) if self.ffmpeg_path else None
+
+    @property
+    def hardware_encoders(self):
+        """Hardware encoders compiled into this FFmpeg build (the device may still be missing)"""
+        return sorted(name for name in self.encoders if name.endswith(HARDWARE_ENCODER_SUFFIXES))
+
+
+def find_windows_ffmpeg():
+    """Return the ffmpeg.exe paths found in common Windows install locations"""
+    found = [path for path in WINDOWS_FFMPEG_PATHS if os.path.exists(path)]
+    for pattern in WINDOWS_FFMPEG_PATTERNS:
+        for path in glob.glob(pattern):
+            if os.path.exists(path) and path not in found:
+                found.append(path)
+    return found
+
+
+def _run(args):
+    """Return the stdout of a short-lived command"""
+    return subprocess.run(args, capture_output=True, text=True, timeout=PROBE_TIMEOUT, check=True).stdout
+
+
+def _version(binary):
+    """Return the version string from `<binary> -version`, e.g. '6.1.1-3ubuntu5'"""
+    first_line = _run([binary, '-version']).split('\n', 1)[0]
+    match = re.search(r'version\s+(\S+)', first_line)
+    return match.group(1) if match else first_line.strip()
+
+
+def _encoders(ffmpeg_path):
+    """Return the names of the encoders listed by `ffmpeg -encoders`"""
+    output = _run([ffmpeg_path, '-hide_banner', '-encoders'])
+    # The list follows a ' ------' separator; each line is ' <flags> <name> <description>'
+    _, _, listing = output.partition('------')
+    return frozenset(line.split()[1] for line in listing.splitlines() if len(line.split()) >= 2)
+
+
+def probe_system():
+    """Locate ffmpeg/ffprobe and return an FFmpegProbe (uncached, spawns processes)"""
+    ffmpeg_path = shutil.which('ffmpeg')
+    in_path = ffmpeg_path is not None
+    if ffmpeg_path is None and platform.system() == 'Windows':
+        # Also check common installation paths
+        found = find_windows_ffmpeg()
+        ffmpeg_path = found[0] if found else None
+    if ffmpeg_path is None:
+        return FFmpegProbe()
+
+    # ffprobe ships next to ffmpeg
+    ffprobe_path = shutil.which('ffprobe', path=os.path.dirname(ffmpeg_path)) or shutil.which('ffprobe')
+    try:
+        ffmpeg_version = _version(ffmpeg_path)
+        encoders = _encoders(ffmpeg_path)
+    except (OSError, subprocess.SubprocessError) as e:
+        return FFmpegProbe(ffmpeg_path=ffmpeg_path, in_path=in_path, error=str(e))
+    try:
+        ffprobe_version = _version(ffprobe_path) if ffprobe_path else None
+    except (OSError, subprocess.SubprocessError):
+        ffprobe_version = None
+    return FFmpegProbe(
+        ffmpeg_path=ffmpeg_path,
+        ffprobe_path=ffprobe_path,
+        ffmpeg_version=ffmpeg_version,
+        ffprobe_version=ffprobe_version,
+        in_path=in_path,
+        encoders=encoders,
+    )
+
+
+def get_probe():
+    """Return the FFmpegProbe for this process, probing on first use"""
+    global _probe
+    with _probe_lock:
+        if _probe is None:
+            _probe = probe_system()
+        return _probe
+
+
+def invalidate():
+    """Forget the cached probe so the next get_probe() looks again"""
+    global _probe
+    with _probe_lock:
+        _probe = None
+
+
+def check_ffmpeg():
+    """Check if a working ffmpeg is available (cached, see get_probe)"""
+    return get_probe().available
@@ -0,0 +1,261 @@
+"""Format selection from an index of a video's formats
+
+yt-dlp describes formats as loosely typed dicts: codecs are strings like
+'avc1.64001F' or 'none', heights may be missing or '720p', sizes are often
+only implied by the bitrate. FormatIndex normalizes them once per info dict
+into a table of Format rows (codec family, height, bitrate, size, protocol,
+container) and answers the selection queries of the download pipeline from
+it. What to pick is described by a Policy, so new rules ("best under 500 MB",
+"prefer AV1") are a field rather than another round of string checks.
+"""
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, replace
+from typing import NamedTuple
+
+# Codec string prefixes and the family they belong to
+VIDEO_CODEC_FAMILIES = (
+    ('avc', 'h264'), ('h264', 'h264'),
+    ('hev', 'h265'), ('hvc', 'h265'), ('h265', 'h265'),
+    ('vp09', 'vp9'), ('vp9', 'vp9'), ('vp8', 'vp8'),
+    ('av01', 'av1'), ('av1', 'av1'),
+)
+AUDIO_CODEC_FAMILIES = (
+    ('mp4a', 'aac'), ('aac', 'aac'), ('opus', 'opus'), ('vorbis', 'vorbis'), ('mp3', 'mp3'),
+    ('ec-3', 'eac3'), ('ac-3', 'ac3'), ('flac', 'flac'),
+)
+
+# Most preferred first, the same order yt-dlp ranks codecs of equal resolution in
+VIDEO_CODEC_ORDER = ('av1', 'vp9', 'h265', 'h264', 'vp8')
+AUDIO_CODEC_ORDER = ('flac', 'opus', 'vorbis', 'aac', 'mp3', 'eac3', 'ac3')
+
+UNKNOWN_CODEC = 'unknown'
+
+# Protocols that deliver a stream in pieces through a manifest
+ADAPTIVE_PROTOCOLS = ('dash', 'ism', 'f4m')
+
+# Indexes kept for the most recently seen info dicts
+INDEX_CACHE_SIZE = 64
+
+_indexes = OrderedDict()
+_indexes_lock = threading.Lock()
+
+
+def codec_family(codec, families):
+    """Return the family of a codec string ('avc1.4d401f' -> 'h264'), or None for no codec
+
+    A missing codec is 'unknown': direct media links don't say what they
+    contain, and yt-dlp treats them as holding both video and audio.
+    """
+    if codec is None:
+        return UNKNOWN_CODEC
+    if not codec or codec == 'none':
+        return None
+    codec = codec.lower()
+    for prefix, family in families:
+        if codec.startswith(prefix):
+            return family
+    return codec.split('.')[0]
+
+
+def protocol_family(protocol):
+    """Return 'http', 'hls', 'dash' or the protocol itself"""
+    protocol = (protocol or 'https').lower()
+    if protocol in ('http', 'https'):
+        return 'http'
+    if 'm3u8' in protocol:
+        return 'hls'
+    if 'dash' in protocol:
+        return 'dash'
+    return protocol
+
+
+def _number(value):
+    """Parse a numeric format field (heights can be '720p'); None when missing or malformed"""
+    if value is None:
+        return None
+    try:
+        return float(str(value).rstrip('p'))
+    except ValueError:
+        return None
+
+
+class Format(NamedTuple):
+    """One row of a FormatIndex"""
+    format_id: str
+    vcodec: str  # codec family ('unknown' when not given), None for audio-only formats
+    acodec: str  # codec family ('unknown' when not given), None for video-only formats
+    height: int  # 0 when unknown
+    fps: float  # 0 when unknown
+    tbr: float  # total bitrate in kbit/s, 0 when unknown
+    filesize: int  # bytes, estimated from the bitrate when not given; None when unknown
+    protocol: str  # protocol family, see protocol_family()
+    ext: str
+    info: dict  # the format dict from yt-dlp
+
+    @property
+    def progressive(self):
+        """True for a single file holding both video and audio"""
+        return bool(self.vcodec and self.acodec) and self.protocol not in ADAPTIVE_PROTOCOLS
+
+
+def _row(fmt, duration):
+    """Build the Format row of a format dict"""
+    vcodec = codec_family(fmt.get('vcodec'), VIDEO_CODEC_FAMILIES)
+    acodec = codec_family(fmt.get('acodec'), AUDIO_CODEC_FAMILIES)
+    tbr = _number(fmt.get('tbr')) or (_number(fmt.get('vbr')) or 0) + (_number(fmt.get('abr')) or 0)
+    filesize = fmt.get('filesize') or fmt.get('filesize_approx')
+    if not filesize and tbr and duration:
+        filesize = int(tbr * 125 * duration)  # kbit/s -> bytes
+    return Format(
+        format_id=str(fmt.get('format_id')),
+        vcodec=vcodec,
+        acodec=acodec,
+        height=int(_number(fmt.get('height')) or 0),
+        fps=_number(fmt.get('fps')) or 0,
+        tbr=tbr,
+        filesize=filesize or None,
+        protocol=protocol_family(fmt.get('protocol')),
+        ext=(fmt.get('ext') or '').lower(),
+        info=fmt,
+    )
+
+
+@dataclass(frozen=True)
+class Policy:
+    """What to select from a FormatIndex"""
+    max_height: int = None  # None for no limit
+    worst: bool = False  # the lowest quality instead of the highest
+    video_codecs: tuple = VIDEO_CODEC_ORDER  # preferred among formats of the same resolution
+    audio_codecs: tuple = AUDIO_CODEC_ORDER
+    ext: str = None  # only formats in this container
+    max_size: int = None  # bytes for the whole download, None for no limit
+
+    @classmethod
+    def for_quality(cls, quality, **fields):
+        """Return the policy for one of the quality names ('best', '720p', 'worst', ...)"""
+        if quality == 'worst':
+            return cls(worst=True, **fields)
+        if quality != 'best':
+            return cls(max_height=int(quality.rstrip('p')), **fields)
+        return cls(**fields)
+
+    def prefer_video_codecs(self, *codecs):
+        """Return a copy preferring these video codec families, in this order, over the others"""
+        rest = tuple(codec for codec in self.video_codecs if codec not in codecs)
+        return replace(self, video_codecs=codecs + rest)
+
+
+def _codec_rank(codec, order):
+    return order.index(codec) if codec in order else len(order)
+
+
+class FormatIndex:
+    """The formats of one info dict, normalized for selection queries"""
+
+    def __init__(self, info):
+        duration = _number(info.get('duration'))
+        # Storyboards and other formats without video or audio can't be downloaded as media
+        self.formats = [row for row in (_row(fmt, duration) for fmt in info.get('formats') or [])
+                        if row.vcodec or row.acodec]
+        self._by_id = {row.format_id: row for row in self.formats}
+
+    def __len__(self):
+        return len(self.formats)
+
+    def get(self, format_id):
+        return self._by_id.get(format_id)
+
+    def progressive(self):
+        """Formats holding both video and audio in one file"""
+        return [row for row in self.formats if row.progressive]
+
+    def video_only(self):
+        return [row for row in self.formats if row.vcodec and not row.acodec]
+
+    def audio_only(self):
+        return [row for row in self.formats if row.acodec and not row.vcodec]
+
+    @staticmethod
+    def rank_video(rows, policy):
+        """Order formats best first for the policy (worst first with policy.worst)
+
+        Formats above policy.max_height are left out unless nothing is at or
+        below it; then only the lowest resolution available is kept.
+        """
+        if policy.ext:
+            rows = [row for row in rows if row.ext == policy.ext]
+        if policy.max_height:
+            fitting = [row for row in rows if row.height <= policy.max_height]
+            if not fitting and rows:
+                lowest = min(row.height for row in rows)
+                fitting = [row for row in rows if row.height == lowest]
+            rows = fitting
+        ranked = sorted(rows, key=lambda row: (
+            -row.height, -row.fps, _codec_rank(row.vcodec, policy.video_codecs), -row.tbr,
+        ))
+        if policy.worst:
+            ranked.reverse()
+        return ranked
+
+    @staticmethod
+    def rank_audio(rows, policy):
+        """Order audio formats best first for the policy (worst first with policy.worst)"""
+        if policy.ext:
+            rows = [row for row in rows if row.ext == policy.ext]
+        ranked = sorted(rows, key=lambda row: (_codec_rank(row.acodec, policy.audio_codecs), -row.tbr))
+        if policy.worst:
+            ranked.reverse()
+        return ranked
+
+    @staticmethod
+    def _fits(rows, budget):
+        """True if the known sizes of rows add up to no more than budget"""
+        return budget is None or sum(row.filesize or 0 for row in rows) <= budget
+
+    def select_progressive(self, policy):
+        """Return the best single-file format for the policy, or None"""
+        ranked = self.rank_video(self.progressive(), policy)
+        for row in ranked:
+            if self._fits([row], policy.max_size):
+                return row
+        # Nothing fits the size budget: the smallest one comes closest
+        return min(ranked, key=lambda row: row.filesize or 0, default=None)
+
+    def select_merge(self, policy):
+        """Return the best (video, audio) pair to merge for the policy, or None
+
+        Video takes priority over audio: the size budget is spent on the best
+        video that still leaves room for some audio track.
+        """
+        videos = self.rank_video(self.video_only(), replace(policy, ext=None))
+        audios = self.rank_audio(self.audio_only(), replace(policy, ext=None))
+        if not videos or not audios:
+            return None
+        for video in videos:
+            for audio in audios:
+                if self._fits([video, audio], policy.max_size):
+                    return video, audio
+        return (min(videos, key=lambda row: row.filesize or 0),
+                min(audios, key=lambda row: row.filesize or 0))
+
+
+def index_for(info):
+    """Return the FormatIndex of an info dict, built once per extraction
+
+    Copies of the same cached extraction share their index.
+    """
+    key = (info.get('extractor_key'), info.get('id'), info.get('epoch'))
+    if None in key:
+        return FormatIndex(info)
+    with _indexes_lock:
+        index = _indexes.get(key)
+        if index is not None:
+            _indexes.move_to_end(key)
+            return index
+    index = FormatIndex(info)
+    with _indexes_lock:
+        _indexes[key] = index
+        while len(_indexes) > INDEX_CACHE_SIZE:
+            _indexes.popitem(last=False)
+    return index
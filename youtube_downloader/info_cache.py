@@ -0,0 +1,193 @@
+"""Process-wide cache of yt-dlp info dicts
+
+"Get Video Info", the format check and the download itself all need the same
+info dict. Extracting it costs a page fetch and player JS parsing, so results
+are kept per video ID until shortly before their signed format URLs expire:
+in memory, and behind that in the persistent metadata store, which other
+processes and later runs share. Extractions borrow warm YoutubeDL instances
+from the pool in youtubedl.
+"""
+import copy
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from . import config, metrics
+from .metadata import metadata_store
+from .ratelimit import INTERACTIVE
+
+# Signed googlevideo URLs carry their expiry as 'expire=<ts>' or '/expire/<ts>/'
+_EXPIRE_RE = re.compile(r'[?&/]expire[=/](\d+)')
+
+# Stop serving an entry this many seconds before its format URLs expire
+EXPIRY_MARGIN = 300
+
+
+def video_key(url):
+    """Return a canonical cache key for a URL (the video ID for YouTube links)"""
+    # Deferred like every yt-dlp import, so the app starts without it (see warm_up)
+    from yt_dlp.extractor.youtube import YoutubeIE
+
+    url = url.strip()
+    if YoutubeIE.suitable(url):
+        video_id = YoutubeIE.get_temp_id(url)
+        if video_id:
+            return f'youtube:{video_id}'
+    return url
+
+
+def _url_expiry(info):
+    """Return the earliest expiry timestamp of the info dict's format URLs, if any"""
+    expiries = []
+    for fmt in info.get('formats') or []:
+        for field in ('url', 'manifest_url', 'fragment_base_url'):
+            match = _EXPIRE_RE.search(fmt.get(field) or '')
+            if match:
+                expiries.append(int(match.group(1)))
+    return min(expiries) if expiries else None
+
+
+def info_expiry(info, ttl):
+    """Return until when an info dict extracted now may be served (TTL, or shortly before its URLs expire)"""
+    expires = time.time() + ttl
+    url_expiry = _url_expiry(info)
+    if url_expiry is not None:
+        expires = min(expires, url_expiry - EXPIRY_MARGIN)
+    return expires
+
+
+class InfoCache:
+    """Thread-safe LRU cache of info dicts with per-entry expiry"""
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Return a private copy of the cached info dict, or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= time.time():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            info = entry[1]
+        # yt-dlp mutates the dicts it processes, so callers always get their own copy
+        return copy.deepcopy(info)
+
+    def put(self, key, info, expires=None):
+        """Cache an info dict until expires, by default its TTL or the expiry of its format URLs"""
+        if expires is None:
+            expires = info_expiry(info, self.ttl)
+        if expires <= time.time():
+            return
+        with self._lock:
+            self._entries[key] = (expires, info)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key=None):
+        """Drop one entry, or the whole cache when no key is given"""
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def stats(self):
+        """Return hit/miss counters for monitoring"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+
+info_cache = InfoCache(config.INFO_CACHE_SIZE, config.INFO_CACHE_TTL)
+metrics.register_cache('info', info_cache)
+
+
+def _extract_opts(ydl_opts=None):
+    """Return the YoutubeDL options of an extraction with the given extra options"""
+    opts = {'quiet': True, 'no_warnings': True, 'cachedir': config.YTDLP_CACHE_DIR}
+    opts.update(ydl_opts or {})
+    return opts
+
+
+_warming = False
+_warm_lock = threading.Lock()
+
+
+def warm_up():
+    """Load yt-dlp, an instance for "Get Video Info" and the extractors' URL patterns in the background, once per process"""
+    global _warming
+    with _warm_lock:
+        if _warming:
+            return
+        _warming = True
+
+    def warm():
+        from .youtubedl import compile_url_patterns, ydl_pool
+
+        ydl_pool.warm(_extract_opts({'request_priority': INTERACTIVE}))
+        video_key('')
+        compile_url_patterns()
+
+    threading.Thread(target=warm, name='youtubedl-warm-up', daemon=True).start()
+
+
+def extract_info(url, ydl_opts=None, fresh=False):
+    """Return the info dict for a URL, extracting it only on a cache miss (or always, if fresh)"""
+    key = video_key(url)
+    info = None if fresh else info_cache.get(key)
+    if info is None:
+        # Another process or an earlier run may have extracted it while its URLs are still valid
+        stored = None if fresh else metadata_store.get_info(key)
+        if stored is not None:
+            info, expires = stored
+        else:
+            from .youtubedl import ScheduledYoutubeDL, ydl_pool
+
+            started = time.monotonic()
+            with ydl_pool.get(_extract_opts(ydl_opts)) as ydl:
+                info = ydl.extract_info(url, download=False)
+            metrics.extract_seconds.observe(time.monotonic() - started)
+            # Same cleanup yt-dlp applies to --load-info-json, so the dict can be fed to process_ie_result
+            info = ScheduledYoutubeDL.sanitize_info(info, remove_private_keys=True)
+            expires = info_expiry(info, info_cache.ttl)
+            metadata_store.put(key, info, expires)
+        info_cache.put(key, info, expires)
+        info = copy.deepcopy(info)
+    return info
+
+
+def video_metadata(url, ydl_opts=None):
+    """Return the stored fields of a video (title, duration, uploader, view count, ...)
+
+    Known videos are answered from the metadata store; unknown ones, and
+    known ones whose volatile fields are past their TTL, are extracted (or
+    taken from a cached extraction) first.
+    """
+    key = video_key(url)
+    fields = metadata_store.get(key)
+    if fields is None or fields['stale']:
+        # A cached extraction is no newer than the stale fields, so those are refreshed by a new one
+        extract_info(url, ydl_opts, fresh=fields is not None)
+        fields = metadata_store.get(key) or fields
+    return fields
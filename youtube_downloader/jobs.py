@@ -0,0 +1,613 @@
+"""Background job queue for downloads
+
+Downloads run on a fixed pool of worker threads instead of the Streamlit
+script thread, so the page can poll a job's status across reruns. The pool
+size caps how many downloads run at once on the box, each user can only have
+a few jobs running or waiting, and the queue refuses new jobs when it is full.
+
+Jobs submitted with a key are single-flight: while one is queued or running,
+identical submissions join it instead of starting another download. Every
+waiter sees the same progress, result or failure, and the job is only
+cancelled once all of its waiters have cancelled.
+
+A running job can also run sub-tasks (the items of a batch) in its own
+threads with run_child(). They take the workers' slots like queued jobs
+and are single-flight too.
+
+Jobs are also published to the shared state (see state), so with several
+replicas of the app a submission joins an identical job running on another
+replica, and any replica can show or cancel any job. A job of a replica
+that stopped sending heartbeats counts as failed.
+"""
+import contextlib
+import dataclasses
+import hashlib
+import json
+import logging
+import threading
+import time
+import uuid
+from collections import Counter, deque
+
+from . import config, metrics, ratelimit
+from .progress import ProgressEvent
+from .state import shared_state
+
+logger = logging.getLogger(__name__)
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+ACTIVE_STATES = (QUEUED, RUNNING)
+
+# Running jobs publish their progress to the shared state at most this often (seconds)
+PUBLISH_INTERVAL = 1.0
+# Replicas renew their heartbeat this often; one silent for REPLICA_TTL seconds is considered gone
+HEARTBEAT_INTERVAL = 10
+REPLICA_TTL = 30
+
+# Job fields copied into the shared state
+SNAPSHOT_FIELDS = ('owner', 'kwargs', 'status', 'created', 'started', 'finished', 'result', 'error', 'error_kind')
+
+
+class QueueFull(Exception):
+    """The job queue is at capacity"""
+
+
+class TooManyJobs(Exception):
+    """The user already has the maximum number of pending jobs"""
+
+
+class JobCancelled(Exception):
+    """Raised inside a running job once it has been cancelled"""
+
+
+class Job:
+    """A unit of work and its status, shared between a worker and the UI"""
+
+    def __init__(self, owner, target=None, args=(), kwargs=None, key=None, job_id=None):
+        self.id = job_id or uuid.uuid4().hex
+        self.owner = owner
+        self.key = key
+        # The batch (or other job) this one is a sub-task of
+        self.parent = None
+        # Users waiting on this job; it is cancelled once this set is empty
+        self.waiters = {owner}
+        self.target = target
+        self.args = args
+        self.kwargs = kwargs or {}
+        # Rank of the job's upstream requests (see ratelimit): the most urgent of its users'
+        self.priority = self.kwargs.get('priority')
+        self.status = QUEUED
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.result = None
+        self.error = None
+        self.error_kind = None
+        self.messages = []
+        # Latest ProgressEvent, and callbacks that receive every event
+        self.progress = None
+        # The replica running the job, for jobs shown from the shared state
+        self.remote = None
+        self._listeners = []
+        self._cancel_event = threading.Event()
+        self._published = 0.0
+        # Whether the job holds one of its JobManager's worker slots
+        self._slot = False
+
+    def snapshot(self):
+        """Return the job as a JSON-serializable dict for the shared state"""
+        record = {name: getattr(self, name) for name in SNAPSHOT_FIELDS}
+        record.update(
+            id=self.id,
+            replica=config.REPLICA_ID,
+            waiters=sorted(str(waiter) for waiter in self.waiters),
+            messages=list(self.messages),
+            progress=dataclasses.asdict(self.progress) if self.progress else None,
+            updated=time.time(),
+        )
+        return record
+
+    @classmethod
+    def from_snapshot(cls, record):
+        """Rebuild a read-only copy of a job published by another replica"""
+        job = cls(record['owner'], job_id=record['id'])
+        for name in SNAPSHOT_FIELDS:
+            setattr(job, name, record[name])
+        job.remote = record['replica']
+        job.waiters = set(record['waiters'])
+        job.messages = [tuple(message) for message in record['messages']]
+        job.progress = ProgressEvent(**record['progress']) if record['progress'] else None
+        return job
+
+    def raise_priority(self, priority):
+        """Rank the job's requests at priority if that is more urgent than their current rank"""
+        self.priority = priority if self.priority is None else min(self.priority, priority)
+
+    def note(self, level, text):
+        """Attach a message for the UI ('info', 'warning' or 'error')"""
+        self.messages.append((level, text))
+
+    def subscribe(self, callback):
+        """Call callback(event) with every ProgressEvent this job reports from now on"""
+        self._listeners.append(callback)
+
+    def publish_progress(self, event):
+        """Record a ProgressEvent and pass it to the subscribers"""
+        self.progress = event
+        for callback in list(self._listeners):
+            try:
+                callback(event)
+            except Exception:
+                # A broken listener must not abort the download
+                logger.exception("Progress listener failed")
+
+    @property
+    def cancelled(self):
+        return self._cancel_event.is_set()
+
+    def check_cancelled(self):
+        """Raise JobCancelled if the job has been cancelled"""
+        if self._cancel_event.is_set():
+            raise JobCancelled()
+
+    @property
+    def active(self):
+        return self.status in ACTIVE_STATES
+
+    def has_waiter(self, owner):
+        """Return True if the user submitted or joined this job"""
+        return owner in self.waiters
+
+    def run(self):
+        """Run the job's target in the current thread, recording the outcome"""
+        self.status = RUNNING
+        self.started = time.time()
+        try:
+            self.check_cancelled()
+            self.result = self.target(self, *self.args, **self.kwargs)
+            self.status = DONE
+        except JobCancelled:
+            self.status = CANCELLED
+        except Exception as e:
+            if self.cancelled:
+                self.status = CANCELLED
+            else:
+                self.error = str(e)
+                self.error_kind = getattr(e, 'kind', None)
+                self.status = FAILED
+        finally:
+            self.finished = time.time()
+
+
+class JobManager:
+    """Bounded worker pool with per-user limits
+
+    workers caps concurrent jobs globally, user_running caps concurrent jobs
+    per user, queue_size bounds the number of waiting jobs and user_pending
+    bounds how many jobs one user may have queued or running. Jobs are
+    published to state, a SharedState, for the other replicas.
+
+    The worker slots are shared by the jobs the worker threads run and the
+    sub-tasks of run_child(), so at most `workers` of them run at once.
+    """
+
+    def __init__(self, workers, queue_size, user_running, user_pending, retention, state):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.user_running = user_running
+        self.user_pending = user_pending
+        self.retention = retention
+        self.state = state
+        self._jobs = {}
+        self._queue = deque()
+        self._running = Counter()
+        # Worker slots taken by running jobs and sub-tasks
+        self._busy = 0
+        self._inflight = {}
+        self._cond = threading.Condition()
+        self._threads = []
+        self._heartbeat = None
+
+    def _start_workers(self):
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._work, name=f'download-worker-{len(self._threads)}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _next_job(self):
+        """Pop the oldest queued job whose owner is below the per-user running limit"""
+        if self._busy >= self.workers:
+            return None
+        for job in self._queue:
+            if self._running[job.owner] < self.user_running:
+                self._queue.remove(job)
+                return job
+        return None
+
+    def _start_heartbeat(self):
+        with self._cond:
+            if self._heartbeat is not None:
+                return
+            self._heartbeat = threading.Thread(target=self._beat, name='replica-heartbeat', daemon=True)
+        # The first beat goes out before any job is published, so no replica takes the job for orphaned
+        self._beat_once()
+        self._heartbeat.start()
+
+    def _beat_once(self):
+        """Tell the other replicas this one is alive (its jobs are still running)"""
+        try:
+            self.state.set(f'replica:{config.REPLICA_ID}', time.time(), ttl=REPLICA_TTL)
+        except Exception:
+            logger.exception("Replica heartbeat failed")
+
+    def _beat(self):
+        while True:
+            time.sleep(HEARTBEAT_INTERVAL)
+            self._beat_once()
+
+    def _work(self):
+        while True:
+            with self._cond:
+                job = self._next_job()
+                while job is None:
+                    self._cond.wait()
+                    job = self._next_job()
+                self._running[job.owner] += 1
+                self._busy += 1
+                job._slot = True
+                job.status = RUNNING
+            metrics.queue_wait_seconds.observe(time.time() - job.created)
+            self._apply_cancels(job)
+            self._publish(job)
+            try:
+                job.run()
+            finally:
+                with self._cond:
+                    self._running[job.owner] -= 1
+                    self._release_slot(job)
+                    self._finish(job)
+                    self._cond.notify_all()
+                self._unpublish_flight(job)
+                self._publish(job)
+
+    def _release_slot(self, job):
+        """Give back the worker slot a job holds (with the lock held)"""
+        if job._slot:
+            job._slot = False
+            self._busy -= 1
+            self._cond.notify_all()
+
+    def _finish(self, job):
+        """Stop routing new submissions of the job's key to it"""
+        if job.key is not None and self._inflight.get(job.key) is job:
+            del self._inflight[job.key]
+
+    @staticmethod
+    def _flight(key):
+        """Return the shared state key a flight key is published under"""
+        digest = hashlib.sha256(json.dumps(key, default=str).encode()).hexdigest()[:32]
+        return f'flight:{digest}'
+
+    def _unpublish_flight(self, job):
+        """Stop routing other replicas' submissions of the job's key to it"""
+        if job.key is None:
+            return
+        try:
+            self.state.delete(self._flight(job.key), job.id)
+        except Exception:
+            logger.exception("Unpublishing job %s failed", job.id)
+
+    def _publish(self, job):
+        """Write the job's current state to the shared state"""
+        job._published = time.monotonic()
+        try:
+            self.state.set(f'job:{job.id}', job.snapshot(), ttl=self.retention)
+        except Exception:
+            logger.exception("Publishing job %s failed", job.id)
+
+    def _progress(self, job):
+        """Publish a running job's progress now and then, and act on cancellations from other replicas"""
+        if time.monotonic() - job._published < PUBLISH_INTERVAL:
+            return
+        self._apply_cancels(job)
+        self._publish(job)
+
+    def _apply_cancels(self, job):
+        """Withdraw the users who cancelled the job on another replica"""
+        prefix = f'cancel:{job.id}:'
+        try:
+            for key in self.state.scan(prefix):
+                self.state.delete(key)
+                self.cancel(job.id, key[len(prefix):])
+        except Exception:
+            logger.exception("Reading cancellations of job %s failed", job.id)
+
+    def _remote_waiters(self, job_id):
+        """Return the users who joined a job from other replicas"""
+        prefix = f'waiter:{job_id}:'
+        return {key[len(prefix):] for key in self.state.scan(prefix)}
+
+    def _remote(self, job_id):
+        """Return a copy of a job published by another replica, or None"""
+        record = self.state.get(f'job:{job_id}')
+        if record is None:
+            return None
+        job = Job.from_snapshot(record)
+        job.waiters |= self._remote_waiters(job_id)
+        if job.active and self.state.get(f'replica:{job.remote}') is None:
+            # Its replica stopped without finishing it
+            job.status = FAILED
+            job.error = "The server running this download stopped"
+            job.finished = record['updated']
+        return job
+
+    def _join_remote(self, key, owner):
+        """Join an identical job running on another replica; return it, or None if there is none"""
+        job_id = self.state.get(self._flight(key))
+        with self._cond:
+            if job_id is None or job_id in self._jobs:
+                return None
+        job = self._remote(job_id)
+        if job is None or not job.active:
+            return None
+        self.state.set(f'waiter:{job_id}:{owner}', True, ttl=self.retention)
+        job.waiters.add(owner)
+        return job
+
+    def _purge(self):
+        """Forget finished jobs older than the retention period"""
+        cutoff = time.time() - self.retention
+        for job_id, job in list(self._jobs.items()):
+            if not job.active and job.finished < cutoff:
+                del self._jobs[job_id]
+
+    def submit(self, owner, target, *args, key=None, job_id=None, **kwargs):
+        """Queue target(job, *args, **kwargs) and return the new Job
+
+        If a job with the same key is already queued or running, the user
+        joins that job instead and it is returned, even when they are at
+        their limit of jobs. Raises QueueFull or TooManyJobs instead of
+        queueing a new job without bound. job_id is only given
+        when re-queueing a job from before a restart, so pages that remember
+        the ID find it again. Identical jobs of other replicas are joined
+        too, and returned as read-only copies (see Job.from_snapshot).
+        """
+        with self._cond:
+            self._purge()
+            job = self._inflight.get(key) if key is not None else None
+
+        if job is None and key is not None:
+            try:
+                remote = self._join_remote(key, owner)
+            except Exception:
+                logger.exception("Looking up other replicas' jobs failed")
+                remote = None
+            if remote is not None:
+                return remote
+
+        with self._cond:
+            job = self._inflight.get(key) if key is not None else None
+            if job is not None:
+                job.waiters.add(owner)
+                # A download joining a speculative (bulk) one shouldn't wait behind batch traffic
+                job.raise_priority(kwargs.get('priority', ratelimit.NORMAL))
+                return job
+
+            # Joining a running job takes no worker, so only new jobs count against the limit
+            pending = sum(1 for other in self._jobs.values() if other.has_waiter(owner) and other.active)
+            if pending >= self.user_pending:
+                raise TooManyJobs(f"You already have {pending} downloads in progress")
+            if len(self._queue) >= self.queue_size:
+                raise QueueFull("The download queue is full")
+            job = Job(owner, target, args, kwargs, key=key, job_id=job_id)
+            job.subscribe(lambda event: self._progress(job))
+            self._jobs[job.id] = job
+            self._queue.append(job)
+            if key is not None:
+                self._inflight[key] = job
+        self._start_heartbeat()
+        if key is not None:
+            try:
+                self.state.set(self._flight(key), job.id, ttl=self.retention)
+            except Exception:
+                logger.exception("Publishing job %s failed", job.id)
+        self._publish(job)
+        with self._cond:
+            self._start_workers()
+            self._cond.notify_all()
+        return job
+
+    def get(self, job_id):
+        """Return a job by ID, or None if it is unknown or expired
+
+        Jobs of other replicas are returned as read-only copies.
+        """
+        with self._cond:
+            job = self._jobs.get(job_id)
+        if job is not None:
+            return job
+        try:
+            return self._remote(job_id)
+        except Exception:
+            logger.exception("Looking up job %s failed", job_id)
+            return None
+
+    def position(self, job):
+        """Return the 1-based queue position of a queued job, or 0"""
+        with self._cond:
+            try:
+                return self._queue.index(job) + 1
+            except ValueError:
+                return 0
+
+    def cancel(self, job_id, owner):
+        """Withdraw a user from a job, cancelling it once nobody is waiting on it
+
+        Queued jobs are dropped, running ones stop at their next check.
+        Returns True if the job itself was cancelled. The replica running a
+        job of another replica withdraws the user the next time it
+        publishes the job's progress.
+        """
+        with self._cond:
+            job = self._jobs.get(job_id)
+        if job is None:
+            if self.state.get(f'job:{job_id}') is not None:
+                self.state.set(f'cancel:{job_id}:{owner}', True, ttl=self.retention)
+            return False
+        remote_waiters = self._remote_waiters(job_id)
+        if owner in remote_waiters:
+            # Joined from another replica
+            self.state.delete(f'waiter:{job_id}:{owner}')
+            remote_waiters.discard(owner)
+        elif not job.has_waiter(owner):
+            return False
+        with self._cond:
+            if not job.active:
+                return False
+            job.waiters.discard(owner)
+            if job.waiters or remote_waiters:
+                # Other submissions still want the result
+                return False
+            job._cancel_event.set()
+            self._finish(job)
+            if job in self._queue:
+                self._queue.remove(job)
+                job.status = CANCELLED
+                job.finished = time.time()
+        self._unpublish_flight(job)
+        self._publish(job)
+        return True
+
+    @contextlib.contextmanager
+    def lend_slot(self, job):
+        """Give a running job's worker slot to its sub-tasks while it waits for them
+
+        A job that holds no slot (one run outside the manager) has none to lend.
+        """
+        with self._cond:
+            held = job._slot
+            self._release_slot(job)
+        try:
+            yield
+        finally:
+            if held:
+                with self._cond:
+                    while self._busy >= self.workers:
+                        self._cond.wait()
+                    self._busy += 1
+                    job._slot = True
+
+    def run_child(self, parent, target, *args, key=None, **kwargs):
+        """Run target(job, *args, **kwargs) as a sub-task of a running job and return its Job
+
+        The sub-task runs in the calling thread once it gets a worker slot.
+        Like submit(), a key makes it join an identical job queued or running
+        here or on another replica, and later submissions join it. The
+        per-user limits don't apply: the parent counts as its owner's job.
+        The sub-task is cancelled with its parent, unless others still wait
+        on it. The returned job has finished, unless the parent was
+        cancelled first.
+        """
+        waiter = f'{parent.owner}:{parent.id}'
+        with self._cond:
+            self._purge()
+            job = self._inflight.get(key) if key is not None else None
+
+        if job is None and key is not None:
+            try:
+                job = self._join_remote(key, waiter)
+            except Exception:
+                logger.exception("Looking up other replicas' jobs failed")
+            if job is not None:
+                return self._wait_joined(job, parent, waiter)
+
+        with self._cond:
+            joined = self._inflight.get(key) if key is not None else None
+            if joined is not None:
+                joined.waiters.add(waiter)
+                joined.raise_priority(kwargs.get('priority', ratelimit.NORMAL))
+            else:
+                job = Job(parent.owner, target, args, kwargs, key=key)
+                job.parent = parent
+                job.waiters = {waiter}
+                job.subscribe(lambda event: self._progress(job))
+                self._jobs[job.id] = job
+                if key is not None:
+                    self._inflight[key] = job
+        if joined is not None:
+            return self._wait_joined(joined, parent, waiter)
+
+        self._start_heartbeat()
+        if key is not None:
+            try:
+                self.state.set(self._flight(key), job.id, ttl=self.retention)
+            except Exception:
+                logger.exception("Publishing job %s failed", job.id)
+        self._publish(job)
+
+        def follow_parent(event=None):
+            if parent.cancelled:
+                self.cancel(job.id, waiter)
+
+        job.subscribe(follow_parent)
+        with self._cond:
+            while self._busy >= self.workers and not parent.cancelled:
+                self._cond.wait(PUBLISH_INTERVAL)
+            if not parent.cancelled:
+                self._busy += 1
+                job._slot = True
+        follow_parent()
+        try:
+            job.run()
+        finally:
+            with self._cond:
+                self._release_slot(job)
+                self._finish(job)
+                self._cond.notify_all()
+            self._unpublish_flight(job)
+            self._publish(job)
+        return job
+
+    def _wait_joined(self, job, parent, waiter):
+        """Wait for a job a sub-task joined to finish, withdrawing from it if the parent is cancelled"""
+        while job.active:
+            if parent.cancelled:
+                self.cancel(job.id, waiter)
+                break
+            if job.remote is None:
+                with self._cond:
+                    if job.active:
+                        self._cond.wait(PUBLISH_INTERVAL)
+            else:
+                # Jobs of other replicas are followed through the shared state
+                time.sleep(PUBLISH_INTERVAL)
+                job = self.get(job.id) or job
+        return job
+
+    def stats(self):
+        """Return queue depth and running job counts"""
+        with self._cond:
+            return {
+                'workers': self.workers,
+                'queued': len(self._queue),
+                'running': sum(self._running.values()),
+                'jobs': len(self._jobs),
+            }
+
+
+job_manager = JobManager(
+    workers=config.JOB_WORKERS,
+    queue_size=config.JOB_QUEUE_SIZE,
+    user_running=config.JOB_USER_RUNNING,
+    user_pending=config.JOB_USER_PENDING,
+    retention=config.DELIVERY_TTL,
+    state=shared_state,
+)
+metrics.Gauge('ytdl_jobs', 'Jobs queued or running', ['state'], collect=lambda: {
+    (state,): job_manager.stats()[state] for state in ('queued', 'running')
+})
@@ -0,0 +1,95 @@
+"""Journal of a download's progress, kept next to its partial files
+
+Downloads run in a persistent working directory per cache key (see
+DownloadCache.work_dir), so after a failure, a cancellation or a restart of
+the whole process yt-dlp finds its .part and fragment files and continues
+from there. The journal records what is needed to pick the download up
+again: the request, the format IDs that were resolved for it (the partial
+bytes only fit those formats) and how far each part file got.
+"""
+import json
+import os
+import time
+from pathlib import Path
+
+JOURNAL_FILE = 'journal.json'
+
+# Journal statuses; finished downloads remove their working directory instead
+RUNNING = 'running'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+
+def _is_partial(name):
+    """Return True for yt-dlp's .part, .part-FragN and fragment .ytdl files"""
+    return '.part' in name or name.endswith('.ytdl')
+
+
+def partial_files(work_dir):
+    """Return {file name: size} of the partial download files in a working directory"""
+    parts = {}
+    for entry in os.scandir(work_dir):
+        if not entry.is_file() or not _is_partial(entry.name) or entry.name.endswith('.json'):
+            continue
+        if entry.name.endswith('.part-ranges'):
+            # Parallel downloads preallocate the whole file; count the finished segments
+            from .parallel import ranges_downloaded
+
+            parts[entry.name] = ranges_downloaded(entry.path)
+        else:
+            parts[entry.name] = entry.stat().st_size
+    return parts
+
+
+def output_files(work_dir):
+    """Return the finished files in a working directory"""
+    return [Path(entry.path) for entry in os.scandir(work_dir)
+            if entry.is_file() and not _is_partial(entry.name) and not entry.name.startswith(JOURNAL_FILE)]
+
+
+class Journal:
+    """The journal.json of one working directory"""
+
+    def __init__(self, work_dir):
+        self.work_dir = work_dir
+        self.path = os.path.join(work_dir, JOURNAL_FILE)
+        self.data = self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def get(self, name, default=None):
+        return self.data.get(name, default)
+
+    def update(self, **fields):
+        """Merge fields into the journal and write it atomically"""
+        self.data.update(fields, parts=partial_files(self.work_dir), updated=time.time())
+        self.data.setdefault('created', self.data['updated'])
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.data, f)
+        os.replace(tmp_path, self.path)
+
+    def owner_alive(self):
+        """Return True if another process that is still running wrote this journal"""
+        pid = self.data.get('pid')
+        # Signal 0 only probes for the process on POSIX (on Windows os.kill terminates it)
+        if not pid or pid == os.getpid() or os.name != 'posix':
+            return False
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except OSError:
+            # The process exists but belongs to another user
+            return True
+        return True
+
+    @property
+    def resumed_bytes(self):
+        """Bytes already on disk from an earlier attempt"""
+        return sum(partial_files(self.work_dir).values())
@@ -0,0 +1,207 @@
+"""Persistent store of video metadata, shared by all sessions and processes
+
+The info cache only lives as long as the process. This SQLite database keeps
+what extractions found per video key (see info_cache.video_key): the stable
+fields (title, duration, uploader, thumbnail, upload date) in columns that
+can be queried, e.g. to plan a batch, and the whole info dict with its
+format URLs for as long as those stay valid.
+
+Fields age differently. Stable fields are served for as long as the video is
+known. The view count is refreshed after METADATA_TTL seconds, and the info
+dict once its format URLs expire. A refresh overwrites the volatile fields
+and keeps the stable ones it didn't get.
+
+Being a cache, the database is not part of the shared state (see state):
+replicas on several machines each keep their own.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+from . import config, metrics
+
+# Fields kept as columns; the volatile ones are overwritten by every refresh
+STABLE_FIELDS = ('video_id', 'extractor', 'title', 'duration', 'uploader', 'channel_id', 'thumbnail',
+                 'upload_date', 'webpage_url')
+VOLATILE_FIELDS = ('view_count', 'format_count', 'max_height')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS videos (
+    key TEXT PRIMARY KEY,
+    video_id TEXT,
+    extractor TEXT,
+    title TEXT,
+    duration REAL,
+    uploader TEXT,
+    channel_id TEXT,
+    thumbnail TEXT,
+    upload_date TEXT,
+    webpage_url TEXT,
+    view_count INTEGER,
+    format_count INTEGER,
+    max_height INTEGER,
+    info BLOB,
+    info_expires REAL,
+    fetched REAL NOT NULL,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS videos_uploader ON videos (uploader);
+CREATE INDEX IF NOT EXISTS videos_fetched ON videos (fetched);
+CREATE INDEX IF NOT EXISTS videos_info_expires ON videos (info_expires);
+"""
+
+
+def _columns(info):
+    """Return the column values of an info dict"""
+    formats = info.get('formats') or []
+    heights = [fmt.get('height') for fmt in formats if isinstance(fmt.get('height'), int)]
+    return {
+        'video_id': info.get('id'),
+        'extractor': info.get('extractor_key'),
+        'title': info.get('title'),
+        'duration': info.get('duration'),
+        'uploader': info.get('uploader') or info.get('channel'),
+        'channel_id': info.get('channel_id'),
+        'thumbnail': info.get('thumbnail'),
+        'upload_date': info.get('upload_date'),
+        'webpage_url': info.get('webpage_url'),
+        'view_count': info.get('view_count'),
+        'format_count': len(formats),
+        'max_height': max(heights) if heights else None,
+    }
+
+
+class MetadataStore:
+    """SQLite-backed store of video metadata, keyed by video key
+
+    ttl is how long (seconds) the view count and other volatile fields are
+    served before a lookup asks for a refresh.
+    """
+
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        # The database is created on first use, so importing the package leaves no files behind
+        self._created = False
+
+    def _connect(self):
+        """Return this thread's connection (sqlite3 connections can't be shared between threads)"""
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            db = sqlite3.connect(self.path, timeout=30)
+            db.row_factory = sqlite3.Row
+            # Readers don't block the writer (and vice versa) across processes
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            with self._lock:
+                if not self._created:
+                    db.executescript(SCHEMA)
+                    self._created = True
+            self._local.db = db
+        return db
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def put(self, key, info, info_expires=None):
+        """Store what an extraction found; the info dict is served until info_expires"""
+        columns = _columns(info)
+        now = time.time()
+        blob = None
+        if info_expires is not None and info_expires > now:
+            blob = zlib.compress(json.dumps(info, separators=(',', ':')).encode(), 1)
+        names = (*STABLE_FIELDS, *VOLATILE_FIELDS)
+        updates = [f'{name} = COALESCE(excluded.{name}, {name})' for name in STABLE_FIELDS]
+        updates += [f'{name} = excluded.{name}' for name in (*VOLATILE_FIELDS, 'info', 'info_expires', 'fetched')]
+        with self._connect() as db:
+            db.execute(
+                f"INSERT INTO videos (key, {', '.join(names)}, info, info_expires, fetched, created) "
+                f"VALUES (?, {', '.join('?' * len(names))}, ?, ?, ?, ?) "
+                f"ON CONFLICT (key) DO UPDATE SET {', '.join(updates)}",
+                (key, *(columns[name] for name in names), blob, info_expires if blob else None, now, now),
+            )
+            # Info dicts past their URLs' expiry are never served again; the metadata stays
+            db.execute('UPDATE videos SET info = NULL, info_expires = NULL WHERE info_expires <= ?', (now,))
+
+    def get(self, key):
+        """Return the stored fields of a video as a dict, or None if it is unknown
+
+        'stale' is True once the volatile fields are older than the TTL.
+        """
+        row = self._connect().execute(
+            f"SELECT {', '.join((*STABLE_FIELDS, *VOLATILE_FIELDS))}, fetched FROM videos WHERE key = ?", (key,),
+        ).fetchone()
+        self._count(row is not None)
+        if row is None:
+            return None
+        fields = dict(row)
+        fields['stale'] = fields['fetched'] < time.time() - self.ttl
+        return fields
+
+    def get_info(self, key):
+        """Return (info dict, expiry timestamp) while its format URLs are valid, or None"""
+        row = self._connect().execute(
+            'SELECT info, info_expires FROM videos WHERE key = ? AND info IS NOT NULL AND info_expires > ?',
+            (key, time.time()),
+        ).fetchone()
+        self._count(row is not None)
+        return (json.loads(zlib.decompress(row['info'])), row['info_expires']) if row else None
+
+    def rows(self, keys):
+        """Return {key: stored fields} for the known videos among keys (in one query per 500 keys)"""
+        keys = list(dict.fromkeys(keys))
+        found = {}
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            for row in self._connect().execute(
+                f"SELECT key, {', '.join((*STABLE_FIELDS, *VOLATILE_FIELDS))}, fetched FROM videos "
+                f"WHERE key IN ({', '.join('?' * len(chunk))})", chunk,
+            ):
+                found[row['key']] = {name: row[name] for name in row.keys() if name != 'key'}
+        return found
+
+    def search(self, uploader=None, max_duration=None, min_height=None, limit=100):
+        """Return the stored fields of videos matching all given criteria, most recently fetched first"""
+        clauses, params = [], []
+        if uploader is not None:
+            clauses.append('uploader = ?')
+            params.append(uploader)
+        if max_duration is not None:
+            clauses.append('duration <= ?')
+            params.append(max_duration)
+        if min_height is not None:
+            clauses.append('max_height >= ?')
+            params.append(min_height)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+        return [dict(row) for row in self._connect().execute(
+            f"SELECT key, {', '.join((*STABLE_FIELDS, *VOLATILE_FIELDS))}, fetched FROM videos {where} "
+            f"ORDER BY fetched DESC LIMIT ?", (*params, limit),
+        )]
+
+    def stats(self):
+        """Return the number of known videos and lookup counters"""
+        count = self._connect().execute('SELECT COUNT(*) FROM videos').fetchone()[0]
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': count,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+
+metadata_store = MetadataStore(config.METADATA_DB, config.METADATA_TTL)
+metrics.register_cache('metadata', metadata_store)
@@ -0,0 +1,259 @@
+"""Prometheus metrics and per-job timing spans
+
+The pipeline records counters, gauges and histograms in process memory, and
+a small HTTP server (started by the app, see ensure_server) serves them in
+the Prometheus text format at /metrics. Values that other modules already
+count (cache hits, queue depth) are read through callbacks when scraped.
+
+Every download also logs one JSON line on the 'youtube_downloader.spans'
+logger with its phase timings, so slow downloads can be traced to
+extraction, the network or FFmpeg.
+"""
+import bisect
+import json
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from . import config
+
+span_logger = logging.getLogger('youtube_downloader.spans')
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Histogram buckets for durations in seconds and throughput in bytes per second
+SECONDS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+THROUGHPUT_BUCKETS = tuple(2 ** n * 256 * 1024 for n in range(10))  # 256 KB/s to 128 MB/s
+
+_metrics = []
+_metrics_lock = threading.Lock()
+_server = None
+_server_lock = threading.Lock()
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """A named metric with optional labels, registered for /metrics on creation"""
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), collect=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        # collect() returns {label values tuple: value} at scrape time, instead of recorded values
+        self.collect = collect
+        self._values = {}
+        self._lock = threading.Lock()
+        with _metrics_lock:
+            _metrics.append(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} takes the labels {', '.join(self.labelnames) or '(none)'}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def get(self, **labels):
+        """Return the current value for a label combination"""
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        """Yield (name suffix, label values, extra labels, value) for the exposition format"""
+        if self.collect is not None:
+            values = self.collect()
+        else:
+            with self._lock:
+                values = dict(self._values)
+        for key, value in values.items():
+            yield '', key, (), value
+
+
+class Counter(_Metric):
+    """A value that only goes up"""
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """A value that goes up and down"""
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    """Observations counted into cumulative buckets, with their sum and count"""
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=SECONDS_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    def get(self, **labels):
+        """Return (count, sum) for a label combination"""
+        with self._lock:
+            counts, total = self._values.get(self._key(labels), ([0], 0.0))
+            return sum(counts), total
+
+    def samples(self):
+        with self._lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self._values.items()}
+        for key, (counts, total) in values.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float('inf')), counts):
+                cumulative += count
+                yield '_bucket', key, (('le', _format_value(bound)),), cumulative
+            yield '_sum', key, (), total
+            yield '_count', key, (), cumulative
+
+
+def render():
+    """Return all metrics in the Prometheus text exposition format"""
+    with _metrics_lock:
+        metrics = list(_metrics)
+    lines = []
+    for metric in metrics:
+        lines.append(f'# HELP {metric.name} {metric.documentation}')
+        lines.append(f'# TYPE {metric.name} {metric.type}')
+        try:
+            samples = list(metric.samples())
+        except Exception:
+            # A failing callback must not take the whole scrape down
+            logging.getLogger(__name__).exception("Collecting %s failed", metric.name)
+            continue
+        for suffix, key, extra, value in samples:
+            lines.append(f'{metric.name}{suffix}{_format_labels(metric.labelnames, key, extra)} {_format_value(value)}')
+    return '\n'.join(lines) + '\n'
+
+
+# Metrics of the download pipeline (the job gauge is defined next to the job manager)
+extract_seconds = Histogram('ytdl_extract_seconds', 'Time spent extracting video info (cache misses only)')
+queue_wait_seconds = Histogram('ytdl_queue_wait_seconds', 'Time jobs waited in the queue for a worker')
+phase_seconds = Histogram('ytdl_phase_seconds', 'Duration of download phases', ['phase'])
+download_bytes = Counter('ytdl_download_bytes_total', 'Bytes downloaded from video hosts')
+download_throughput = Histogram('ytdl_download_throughput_bytes_per_second', 'Throughput of finished downloads',
+                                buckets=THROUGHPUT_BUCKETS)
+downloads = Counter('ytdl_downloads_total', 'Finished downloads by outcome', ['outcome'])
+errors = Counter('ytdl_errors_total', 'Failed downloads by error category', ['category'])
+
+
+def register_cache(name, cache):
+    """Export the hits and misses of a cache's stats() as ytdl_cache_requests_total and ytdl_cache_hit_ratio"""
+    _caches[name] = cache
+
+
+def _cache_requests():
+    values = {}
+    for name, cache in list(_caches.items()):
+        stats = cache.stats()
+        values[(name, 'hit')] = stats['hits']
+        values[(name, 'miss')] = stats['misses']
+    return values
+
+
+def _cache_hit_ratio():
+    values = {}
+    for name, cache in list(_caches.items()):
+        stats = cache.stats()
+        lookups = stats['hits'] + stats['misses']
+        values[(name,)] = stats['hits'] / lookups if lookups else 0.0
+    return values
+
+
+_caches = {}
+cache_requests = Counter('ytdl_cache_requests_total', 'Cache lookups by result', ['cache', 'result'],
+                         collect=_cache_requests)
+cache_hit_ratio = Gauge('ytdl_cache_hit_ratio', 'Share of cache lookups that were hits', ['cache'],
+                        collect=_cache_hit_ratio)
+
+
+def classify_error(message, kind=None):
+    """Return the category of a download failure
+
+    DownloadError kinds are categories of their own; other errors are
+    sorted by their message into 'timeout', 'ffmpeg', 'format', 'network'
+    or 'other'.
+    """
+    if kind:
+        return kind
+    message = (message or '').lower()
+    if 'timeout' in message or 'timed out' in message:
+        return 'timeout'
+    if 'ffmpeg' in message or 'ffprobe' in message:
+        return 'ffmpeg'
+    if 'format' in message or 'no video' in message or 'mp4' in message:
+        return 'format'
+    if 'connection' in message or 'network' in message or 'httperror' in message:
+        return 'network'
+    return 'other'
+
+
+def log_span(name, **fields):
+    """Log one structured timing span as a JSON line"""
+    if span_logger.isEnabledFor(logging.INFO):
+        span_logger.info(json.dumps(dict(fields, span=name), default=str))
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Keep the Streamlit console readable
+        pass
+
+
+def ensure_server():
+    """Start the metrics HTTP server once per process (unless YTDL_METRICS_PORT is 0)"""
+    global _server
+    with _server_lock:
+        if _server is None and config.METRICS_PORT:
+            try:
+                server = ThreadingHTTPServer((config.METRICS_HOST, config.METRICS_PORT), _MetricsHandler)
+            except OSError as e:
+                # Another process (e.g. a second app instance) already serves the port; don't retry
+                logging.getLogger(__name__).warning("Metrics server not started: %s", e)
+                _server = False
+                return None
+            server.daemon_threads = True
+            threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+            _server = server
+    return _server or None
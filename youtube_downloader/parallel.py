@@ -0,0 +1,500 @@
+"""Parallel downloading: concurrent fragments and chunked HTTP range requests
+
+yt-dlp's native HTTP downloader fetches a progressive file over one
+connection, and on high-latency links one TCP stream stays far below the
+uplink. ParallelYoutubeDL hands plain HTTP(S) downloads to ParallelHttpFD,
+which splits the file into segments and fetches them over several
+connections with range requests, writing each segment at its offset. DASH
+and HLS downloads use yt-dlp's own concurrent_fragment_downloads instead.
+The video and audio formats of a merge are downloaded at the same time.
+
+The connection count is auto-tuned unless fixed: a download starts with the
+count that worked best for the host last time and adds connections while
+each one still raises the measured throughput. The throughput downloads
+end up with is averaged for size-aware quality selection.
+"""
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from urllib.parse import urlsplit
+
+from yt_dlp.downloader import get_suitable_downloader
+from yt_dlp.downloader.http import HttpFD
+from yt_dlp.networking import Request
+from yt_dlp.networking.exceptions import HTTPError, RequestError, TransportError
+
+from . import config
+from .youtubedl import ScheduledYoutubeDL
+
+logger = logging.getLogger(__name__)
+
+# Segments smaller than this aren't worth an extra request
+MIN_SEGMENT_SIZE = 256 * 1024
+READ_SIZE = 256 * 1024
+
+# Auto-tuning: connections a host starts with, how often throughput is
+# measured, and the gain an added connection has to bring to be kept
+AUTO_START_CONNECTIONS = 2
+TUNE_INTERVAL = 1.0
+TUNE_MIN_GAIN = 1.1
+
+PROGRESS_INTERVAL = 0.25
+
+# Throughput measurement: downloads too small or short to show the link's
+# speed are ignored, and each new sample gets this weight in the average
+THROUGHPUT_MIN_BYTES = 1024 * 1024
+THROUGHPUT_MIN_SECONDS = 0.5
+THROUGHPUT_WEIGHT = 0.3
+
+
+class ConnectionTuner:
+    """Remembers the best connection count per host, measured from throughput"""
+
+    def __init__(self, max_connections, start=AUTO_START_CONNECTIONS):
+        self.max_connections = max_connections
+        self.start = start
+        self._best = {}
+        self._lock = threading.Lock()
+
+    def initial(self, host=None):
+        """Return the connection count to start a download from host with"""
+        with self._lock:
+            if host in self._best:
+                return self._best[host]
+            # Unknown host (or fragments of any host): go with the most recent result
+            return next(reversed(self._best.values()), self.start) if self._best else self.start
+
+    def record(self, host, connections):
+        """Remember the connection count a finished download settled on"""
+        with self._lock:
+            self._best.pop(host, None)
+            self._best[host] = max(1, min(connections, self.max_connections))
+
+    def stats(self):
+        """Return the tuned connection count per host"""
+        with self._lock:
+            return dict(self._best)
+
+
+tuner = ConnectionTuner(config.DOWNLOAD_MAX_CONNECTIONS)
+
+
+class ThroughputMeter:
+    """Moving average of the throughput downloads achieved, in bytes per second"""
+
+    def __init__(self, weight=THROUGHPUT_WEIGHT):
+        self.weight = weight
+        self._rate = None
+        self._lock = threading.Lock()
+
+    def record(self, nbytes, seconds):
+        """Add a finished download's bytes and download time to the average"""
+        if nbytes < THROUGHPUT_MIN_BYTES or seconds < THROUGHPUT_MIN_SECONDS:
+            return
+        rate = nbytes / seconds
+        with self._lock:
+            self._rate = rate if self._rate is None else self.weight * rate + (1 - self.weight) * self._rate
+
+    def estimate(self):
+        """Return the average throughput, or None before the first measurement"""
+        with self._lock:
+            return self._rate
+
+
+throughput = ThroughputMeter()
+
+
+def fragment_connections(connections):
+    """Return concurrent_fragment_downloads for a connections setting (0 means auto)"""
+    return connections or tuner.initial()
+
+
+class _Climb:
+    """Hill-climbing on the connection count within one download
+
+    The count doubles every TUNE_INTERVAL while that still raises throughput
+    by TUNE_MIN_GAIN; best is the count that last paid off.
+    """
+
+    def __init__(self, connections, limit):
+        self.connections = self.best = min(connections, limit)
+        self.limit = limit
+        self.settled = self.connections >= limit
+        # True once adding connections stopped paying off
+        self.plateaued = False
+        self._last_rate = None
+        self._mark = (time.monotonic(), 0)
+
+    def update(self, downloaded):
+        """Feed the bytes downloaded so far; return how many connections to add"""
+        now = time.monotonic()
+        since, base = self._mark
+        if self.settled or now - since < TUNE_INTERVAL:
+            return 0
+        rate = (downloaded - base) / (now - since)
+        self._mark = (now, downloaded)
+        if self._last_rate is not None and rate < self._last_rate * TUNE_MIN_GAIN:
+            # The last step didn't pay off; stay where we are
+            self.settled = self.plateaued = True
+            return 0
+        self._last_rate = rate
+        self.best = self.connections
+        added = min(self.connections * 2, self.limit) - self.connections
+        self.connections += added
+        self.settled = self.connections >= self.limit
+        return added
+
+
+class _RangesUnsupported(Exception):
+    """The server ignored the range request"""
+
+
+def ranges_downloaded(tmpfilename):
+    """Return the bytes finished in a .part-ranges file (it is preallocated to full size)"""
+    try:
+        with open(f'{tmpfilename}.json', encoding='utf-8') as f:
+            state = json.load(f)
+        total, segment_size = state['total'], state['segment_size']
+        return sum(min(segment_size, total - index * segment_size) for index in state['done'])
+    except (OSError, ValueError, KeyError, TypeError):
+        return 0
+
+
+class ParallelHttpFD(HttpFD):
+    """HTTP downloader fetching segments of a file over several connections
+
+    Falls back to the sequential HttpFD when the server doesn't honour range
+    requests or the file is too small to split. Progress of an interrupted
+    download is kept in a <file>.part-ranges file plus a JSON list of the
+    finished segments, so continuedl resumes it segment by segment.
+    """
+
+    FD_NAME = 'parallel-http'
+
+    @staticmethod
+    def can_download(info_dict, params):
+        """Return True for plain HTTP(S) downloads that may be split into ranges"""
+        if params.get('range_connections') == 1 or params.get('test'):
+            return False
+        if info_dict.get('is_live') or info_dict.get('request_data'):
+            return False
+        if 'Range' in (info_dict.get('http_headers') or {}):
+            return False
+        return get_suitable_downloader(info_dict, params) is HttpFD
+
+    def real_download(self, filename, info_dict):
+        try:
+            return self._parallel_download(filename, info_dict)
+        except _RangesUnsupported:
+            return super().real_download(filename, info_dict)
+
+    def _open_range(self, info_dict, start, end):
+        """Open a range request and return the response"""
+        headers = {**(info_dict.get('http_headers') or {}), 'Accept-Encoding': 'identity',
+                   'Range': f'bytes={start}-{end}'}
+        return self.ydl.urlopen(Request(info_dict['url'], headers=headers))
+
+    def _probe(self, info_dict):
+        """Return the file size, or raise _RangesUnsupported"""
+        try:
+            response = self._open_range(info_dict, 0, 0)
+        except HTTPError as e:
+            if e.status == 416:
+                raise _RangesUnsupported()
+            raise
+        with response:
+            content_range = response.headers.get('Content-Range') or ''
+            if response.status != 206 or '/' not in content_range:
+                raise _RangesUnsupported()
+            total = content_range.rsplit('/', 1)[1]
+        if not total.isdigit():
+            raise _RangesUnsupported()
+        return int(total)
+
+    def _fetch(self, info_dict, path, start, end, stop, counter):
+        """Download one segment into its place in the file, with retries"""
+        retries = self.params.get('retries', 10) or 0
+        for attempt in range(retries + 1):
+            offset, written = start, 0
+            try:
+                response = self._open_range(info_dict, start, end)
+                with response, open(path, 'r+b') as f:
+                    if response.status != 206:
+                        raise TransportError(f'Expected a partial response, got HTTP {response.status}')
+                    f.seek(start)
+                    while offset <= end:
+                        if stop.is_set():
+                            return
+                        data = response.read(min(READ_SIZE, end - offset + 1))
+                        if not data:
+                            raise TransportError('Connection closed before the segment was complete')
+                        f.write(data)
+                        offset += len(data)
+                        written += len(data)
+                        counter.add(len(data))
+                return
+            except (RequestError, OSError):
+                # Bytes of a failed attempt are downloaded again
+                counter.add(-written)
+                if attempt == retries or stop.is_set():
+                    raise
+                time.sleep(min(2 ** attempt, 10))
+
+    def _parallel_download(self, filename, info_dict):
+        total = self._probe(info_dict)
+        fixed = self.params.get('range_connections') or 0
+        limit = fixed or config.DOWNLOAD_MAX_CONNECTIONS
+        host = urlsplit(info_dict['url']).hostname
+        segment_size = max(MIN_SEGMENT_SIZE, min(config.DOWNLOAD_CHUNK_MB * 1024 * 1024, total // (limit * 2) or 1))
+        segments = [(start, min(start + segment_size, total) - 1) for start in range(0, total, segment_size)]
+        if len(segments) < 2:
+            raise _RangesUnsupported()
+
+        tmpfilename = f'{filename}.part-ranges'
+        state_path = f'{tmpfilename}.json'
+        done = set()
+        if self.params.get('continuedl', True) and os.path.isfile(tmpfilename):
+            done = self._load_state(state_path, total, segment_size)
+        resumed_bytes = sum(segments[i][1] - segments[i][0] + 1 for i in done)
+        if done:
+            self.report_resuming_byte(resumed_bytes)
+        else:
+            with open(tmpfilename, 'wb') as f:
+                f.truncate(total)
+
+        pending = queue.Queue()
+        for index in range(len(segments)):
+            if index not in done:
+                pending.put(index)
+        finished = queue.Queue()
+        errors = []
+        stop = threading.Event()
+        counter = _Counter(resumed_bytes)
+
+        def worker():
+            while not stop.is_set():
+                try:
+                    index = pending.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    start, end = segments[index]
+                    self._fetch(info_dict, tmpfilename, start, end, stop, counter)
+                except Exception as e:
+                    errors.append(e)
+                    stop.set()
+                    return
+                if not stop.is_set():
+                    finished.put(index)
+
+        climb = _Climb(fixed or tuner.initial(host), limit)
+        if fixed:
+            climb.settled = True
+        threads = []
+
+        def add_workers(count):
+            for _ in range(count):
+                thread = threading.Thread(target=worker, name=f'range-{len(threads)}', daemon=True)
+                thread.start()
+                threads.append(thread)
+
+        add_workers(climb.connections)
+        start_time = time.time()
+        last_state = time.monotonic()
+        # Segments 0..prefix-1 are complete, so readers may stream the file up to there
+        prefix = 0
+        try:
+            while len(done) < len(segments) and not errors:
+                try:
+                    done.add(finished.get(timeout=PROGRESS_INTERVAL))
+                    while True:
+                        done.add(finished.get_nowait())
+                except queue.Empty:
+                    pass
+                while prefix in done:
+                    prefix += 1
+                downloaded = counter.value
+                add_workers(climb.update(downloaded - resumed_bytes))
+                if time.monotonic() - last_state > 1:
+                    self._save_state(state_path, total, segment_size, done)
+                    last_state = time.monotonic()
+                elapsed = time.time() - start_time
+                speed = (downloaded - resumed_bytes) / elapsed if elapsed > 0 else None
+                self._hook_progress({
+                    'status': 'downloading',
+                    'downloaded_bytes': downloaded,
+                    'total_bytes': total,
+                    'tmpfilename': tmpfilename,
+                    'filename': filename,
+                    'elapsed': elapsed,
+                    'speed': speed,
+                    'eta': (total - downloaded) / speed if speed else None,
+                    'contiguous_bytes': segments[prefix - 1][1] + 1 if prefix else 0,
+                }, info_dict)
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+            self._save_state(state_path, total, segment_size, done)
+        if errors:
+            raise errors[0]
+
+        elapsed = time.time() - start_time
+        if not fixed:
+            # After a plateau, the count that last raised throughput; otherwise every step helped
+            tuner.record(host, climb.best if climb.plateaued else climb.connections)
+        logger.debug("Downloaded %s over %d connections in %.1fs", filename, climb.connections, elapsed)
+        self.try_rename(tmpfilename, filename)
+        os.remove(state_path)
+        self._hook_progress({
+            'status': 'finished',
+            'downloaded_bytes': total,
+            'total_bytes': total,
+            'filename': filename,
+            'elapsed': elapsed,
+        }, info_dict)
+        return True
+
+    @staticmethod
+    def _load_state(state_path, total, segment_size):
+        """Return the finished segments of an earlier attempt with the same layout"""
+        try:
+            with open(state_path, encoding='utf-8') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return set()
+        if state.get('total') != total or state.get('segment_size') != segment_size:
+            return set()
+        return set(state.get('done', []))
+
+    @staticmethod
+    def _save_state(state_path, total, segment_size, done):
+        with open(state_path, 'w', encoding='utf-8') as f:
+            json.dump({'total': total, 'segment_size': segment_size, 'done': sorted(done)}, f)
+
+
+class _Counter:
+    """Thread-safe byte counter"""
+
+    def __init__(self, value=0):
+        self.value = value
+        self._lock = threading.Lock()
+
+    def add(self, amount):
+        with self._lock:
+            self.value += amount
+
+
+class _StreamGroup:
+    """The formats of one merge, downloaded side by side"""
+
+    def __init__(self, count):
+        self.remaining = count
+        self.results = []
+        self.errors = []
+        self._threads = []
+
+    def start(self, func, *args):
+        """Run func(*args) in the background, collecting its result or exception"""
+        def run():
+            try:
+                self.results.append(func(*args))
+            except BaseException as e:
+                self.errors.append(e)
+        thread = threading.Thread(target=run, name=f'stream-{len(self._threads)}', daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def join(self):
+        for thread in self._threads:
+            thread.join()
+
+
+class ParallelYoutubeDL(ScheduledYoutubeDL):
+    """YoutubeDL that downloads faster by running things side by side
+
+    Plain HTTP(S) formats are fetched over parallel range requests, the video
+    and audio formats of a merge are downloaded at the same time instead of
+    one after the other, and postprocessors added to live_postprocessors get
+    to process each file while it is still downloading.
+    """
+
+    def __init__(self, params=None, auto_init=True):
+        super().__init__(params, auto_init)
+        # Objects with attach(filename, info) -> progress hook or None, detach(filename, success) and
+        # abort_all(), which stops what is still attached once the postprocessors are done
+        self.live_postprocessors = []
+        self._stream_group = None
+
+    def process_info(self, info_dict):
+        # yt-dlp calls dl() once per format of a merge and merges after the last one;
+        # with a stream group, dl() starts all but the last in the background
+        formats = info_dict.get('requested_formats') or []
+        # A section of a merge is cut from all formats by one FFmpeg run, not downloaded per format
+        sectioned = info_dict.get('section_start') or info_dict.get('section_end')
+        parallel = len(formats) > 1 and self.params.get('parallel_streams', True) and not sectioned
+        self._stream_group = _StreamGroup(len(formats)) if parallel else None
+        try:
+            return super().process_info(info_dict)
+        finally:
+            self._stream_group = None
+
+    def dl(self, name, info, subtitle=False, test=False):
+        group = self._stream_group
+        if subtitle or test or name == '-' or group is None:
+            return self._live_dl(name, info, subtitle, test)
+        group.remaining -= 1
+        if group.remaining > 0:
+            group.start(self._live_dl, name, info)
+            # The real outcome is reported by the last format's call
+            return True, True
+        try:
+            success, real_download = self._live_dl(name, info)
+        finally:
+            group.join()
+        if group.errors:
+            raise group.errors[0]
+        success = success and all(result[0] for result in group.results)
+        real_download = real_download or any(result[1] for result in group.results)
+        return success, real_download
+
+    def _live_dl(self, name, info, subtitle=False, test=False):
+        """Download one file, attaching the live postprocessors while it runs"""
+        attached = []
+        hooks = []
+        if not (subtitle or test or name == '-'):
+            for pp in self.live_postprocessors:
+                hook = pp.attach(name, info)
+                if hook is not None:
+                    attached.append(pp)
+                    hooks.append(hook)
+        success = False
+        try:
+            success, real_download = self._dl(name, info, subtitle, test, hooks)
+        finally:
+            for pp in attached:
+                pp.detach(name, success)
+        return success, real_download
+
+    def _dl(self, name, info, subtitle=False, test=False, hooks=()):
+        """Download one file, through ParallelHttpFD where possible
+
+        hooks are progress hooks of this file only, called after the instance's own.
+        """
+        if test or subtitle or name == '-' or not info.get('url'):
+            return super().dl(name, info, subtitle=subtitle, test=test)
+        if ParallelHttpFD.can_download(info, self.params):
+            fd = ParallelHttpFD(self, self.params)
+        else:
+            fd = get_suitable_downloader(info, self.params)(self, self.params)
+        # Streams of a merge download side by side, so this file's hooks go to its own downloader
+        # rather than into the instance's shared hook list
+        for hook in (*self._progress_hooks, *hooks):
+            fd.add_progress_hook(hook)
+        new_info = self._copy_infodict(info)
+        if new_info.get('http_headers') is None:
+            new_info['http_headers'] = self._calc_headers(new_info)
+        return fd.download(name, new_info, subtitle)
@@ -0,0 +1,209 @@
+"""Speculative downloads between "Get Video Info" and "Download"
+
+Users nearly always fetch a video's info first and press Download a few
+seconds later, so the download used to start only after that idle gap. With
+a prefetch budget set, fetching the info also starts the download the
+session's current settings would make, as a background job whose requests
+have batch priority. The Download click then joins the running job (it has
+the same flight key), or finds the finished file in the download cache.
+
+A prefetch only starts while a worker is idle. It is dropped when the
+session's URL or settings change, when nobody claims it within PREFETCH_TTL
+seconds (the user left), and when the unclaimed prefetches together would
+download more than the byte budget. Claimed and wasted prefetches are
+counted, so the hit rate shows whether the bandwidth pays off.
+"""
+import logging
+import threading
+import time
+
+from . import config, metrics, ratelimit
+from .download import PREFETCH_OWNER, request_key, run_download
+from .jobs import ACTIVE_STATES, DONE, QueueFull, TooManyJobs, job_manager
+
+logger = logging.getLogger(__name__)
+
+prefetches = metrics.Counter('ytdl_prefetch_total', 'Speculative downloads by outcome', ['outcome'])
+prefetch_bytes = metrics.Counter('ytdl_prefetch_bytes_total',
+                                 'Bytes downloaded speculatively, by whether a download used them', ['result'])
+head_start_seconds = metrics.Histogram('ytdl_prefetch_head_start_seconds',
+                                       'How long a prefetch had been running when its download was requested')
+
+
+class _Prefetch:
+    """A session's speculative download and what it has fetched so far"""
+
+    def __init__(self, key, job):
+        self.key = key
+        self.job = job
+        self.started = time.monotonic()
+        # Bytes per stream (streams downloaded one after another each count from 0), and the largest expected total
+        self.streams = {}
+        self.expected = 0
+
+    @property
+    def bytes(self):
+        return sum(self.streams.values())
+
+    @property
+    def reserved(self):
+        """Bytes this prefetch counts against the budget"""
+        return max(self.bytes, self.expected)
+
+
+class Prefetcher:
+    """Starts, tracks and claims one speculative download per session
+
+    max_bytes is the budget of all unclaimed prefetches together (0 disables
+    prefetching), ttl how long (seconds) a prefetch waits to be claimed.
+    """
+
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _owner(session):
+        return f'{PREFETCH_OWNER}{session}'
+
+    def start(self, session, request):
+        """Start the download of request (run_download keyword arguments) for a session
+
+        Returns the prefetch job, or None when prefetching is off, no worker
+        is idle or the budget is used up.
+        """
+        if not self.max_bytes:
+            return None
+        key = request_key(request)
+        self._sweep()
+        with self._lock:
+            current = self._sessions.get(session)
+            if current is not None and current.key == key:
+                return current.job
+        self.discard(session)
+
+        stats = job_manager.stats()
+        if stats['running'] + stats['queued'] >= stats['workers']:
+            # Guesses never keep real downloads waiting for a worker
+            prefetches.inc(outcome='busy')
+            return None
+        with self._lock:
+            reserved = sum(entry.reserved for entry in self._sessions.values())
+        if reserved >= self.max_bytes:
+            prefetches.inc(outcome='over_budget')
+            return None
+
+        owner = self._owner(session)
+        try:
+            job = job_manager.submit(owner, run_download, key=key, **dict(request, priority=ratelimit.BULK))
+        except (QueueFull, TooManyJobs):
+            prefetches.inc(outcome='busy')
+            return None
+        if job.owner != owner:
+            # Someone is already downloading it; nothing to guess
+            job_manager.cancel(job.id, owner)
+            return None
+        entry = _Prefetch(key, job)
+        job.subscribe(lambda event: self._progress(session, entry, event))
+        with self._lock:
+            self._sessions[session] = entry
+        prefetches.inc(outcome='started')
+        return job
+
+    def keep(self, session, key):
+        """Drop the session's prefetch unless it is for key (the download its current settings would make)"""
+        self._sweep()
+        with self._lock:
+            entry = self._sessions.get(session)
+        if entry is not None and entry.key != key:
+            self._drop(session, entry, 'discarded')
+
+    def discard(self, session):
+        """Drop the session's prefetch, if any"""
+        with self._lock:
+            entry = self._sessions.get(session)
+        if entry is not None:
+            self._drop(session, entry, 'discarded')
+
+    def claim(self, session, key):
+        """Hand the session's prefetch for key over to its real download; return True if there was one
+
+        Call this after submitting the download, which joins the prefetch
+        job while it runs (or finds its file in the download cache).
+        """
+        with self._lock:
+            entry = self._sessions.get(session)
+            if entry is None or entry.key != key:
+                return False
+            del self._sessions[session]
+            claimed = entry.job.status in ACTIVE_STATES or entry.job.status == DONE
+            if claimed:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if not claimed:
+            prefetches.inc(outcome='failed')
+            prefetch_bytes.inc(entry.bytes, result='wasted')
+            return False
+        prefetches.inc(outcome='hit')
+        prefetch_bytes.inc(entry.bytes, result='used')
+        head_start_seconds.observe(time.monotonic() - entry.started)
+        # The real download's waiter keeps the job running
+        job_manager.cancel(entry.job.id, self._owner(session))
+        return True
+
+    def _progress(self, session, entry, event):
+        """Count a prefetch's bytes and drop it once it outlives its TTL or the budget"""
+        if event.phase == 'downloading':
+            entry.streams[event.stream_index] = event.downloaded_bytes
+            entry.expected = max(entry.expected, event.total_bytes or 0)
+        with self._lock:
+            if self._sessions.get(session) is not entry:
+                return
+            reserved = sum(other.reserved for other in self._sessions.values())
+        if time.monotonic() - entry.started > self.ttl:
+            self._drop(session, entry, 'expired')
+        elif reserved > self.max_bytes:
+            self._drop(session, entry, 'over_budget')
+
+    def _sweep(self):
+        """Drop prefetches that failed or weren't claimed in time"""
+        now = time.monotonic()
+        with self._lock:
+            entries = list(self._sessions.items())
+        for session, entry in entries:
+            if entry.job.status not in ACTIVE_STATES and entry.job.status != DONE:
+                self._drop(session, entry, 'failed')
+            elif now - entry.started > self.ttl:
+                self._drop(session, entry, 'expired')
+
+    def _drop(self, session, entry, outcome):
+        """Forget a prefetch and cancel its job unless a real download joined it"""
+        with self._lock:
+            if self._sessions.get(session) is not entry:
+                return
+            del self._sessions[session]
+            self.misses += 1
+        prefetches.inc(outcome=outcome)
+        prefetch_bytes.inc(entry.bytes, result='wasted')
+        job_manager.cancel(entry.job.id, self._owner(session))
+        logger.debug("Dropped prefetch %s (%s)", entry.job.id, outcome)
+
+    def stats(self):
+        """Return claimed and wasted prefetch counts and the bytes reserved by unclaimed ones"""
+        with self._lock:
+            return {
+                'entries': len(self._sessions),
+                'bytes': sum(entry.reserved for entry in self._sessions.values()),
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+prefetcher = Prefetcher(config.PREFETCH_MB * 1024 * 1024, config.PREFETCH_TTL)
+metrics.register_cache('prefetch', prefetcher)
@@ -0,0 +1,180 @@
+"""Structured progress events built from yt-dlp's progress and postprocessor hooks
+
+yt-dlp calls its hooks from the download thread for every chunk it writes, so
+ProgressReporter turns each call into a ProgressEvent but only passes one on
+every `interval` seconds (and always on phase changes). Listeners therefore
+never slow the transfer down. Streams downloaded side by side (the video and
+audio of a merge) are reported as one combined download, and the reporter
+times each phase.
+"""
+import threading
+import time
+from dataclasses import dataclass, field
+
+# Phase reported while a postprocessor runs, by yt-dlp postprocessor name
+POSTPROCESSOR_PHASES = {
+    'Merger': 'merging',
+    'ExtractAudio': 'extracting_audio',
+}
+
+PHASE_LABELS = {
+    'downloading': 'Downloading',
+    'merging': 'Merging video and audio',
+    'extracting_audio': 'Extracting audio',
+    'postprocessing': 'Post-processing',
+    'batch': 'Batch',
+    'extracting_info': 'Extracting info',
+    'delivering': 'Delivering',
+    'total': 'Total',
+}
+
+
+@dataclass
+class ProgressEvent:
+    """A snapshot of a download's progress"""
+    phase: str  # 'downloading', 'merging', 'extracting_audio', 'postprocessing' or 'batch'
+    status: str  # yt-dlp's hook status: 'downloading', 'finished', 'started', 'processing', 'error'
+    downloaded_bytes: int = 0
+    total_bytes: int = None
+    speed: float = None  # bytes per second
+    eta: float = None  # seconds
+    fragment_index: int = None
+    fragment_count: int = None
+    stream_index: int = 1  # streams finished so far plus one
+    stream_count: int = 1  # streams downloading side by side (e.g. video and audio)
+    postprocessor: str = None
+    items_done: int = 0  # batch jobs only
+    items_total: int = None
+    time: float = field(default_factory=time.time)
+
+    @property
+    def fraction(self):
+        """Return the completed fraction of the current phase between 0 and 1, if known"""
+        if self.phase == 'batch':
+            return self.items_done / self.items_total if self.items_total else None
+        if self.phase != 'downloading':
+            return 1.0 if self.status == 'finished' else None
+        if self.total_bytes:
+            return min(self.downloaded_bytes / self.total_bytes, 1.0)
+        if self.fragment_index and self.fragment_count:
+            return min(self.fragment_index / self.fragment_count, 1.0)
+        return None
+
+    def describe(self):
+        """Return a one-line human readable summary"""
+        label = PHASE_LABELS.get(self.phase, self.phase)
+        if self.phase == 'batch':
+            if self.items_total is None:
+                return "Expanding playlist..."
+            return f"{label}: {self.items_done} of {self.items_total} items finished"
+        if self.phase != 'downloading':
+            return f"{label}..."
+        if self.stream_count > 1:
+            label += f" {self.stream_count} streams"
+        parts = [f"{self.downloaded_bytes / (1024 * 1024):.1f} MB"]
+        if self.total_bytes:
+            parts[0] += f" of {self.total_bytes / (1024 * 1024):.1f} MB"
+        if self.speed:
+            parts.append(f"{self.speed / (1024 * 1024):.2f} MB/s")
+        if self.eta is not None:
+            parts.append(f"ETA {int(self.eta) // 60}:{int(self.eta) % 60:02d}")
+        return f"{label}: {', '.join(parts)}"
+
+
+def format_timings(timings):
+    """Return phase timings as a short human readable string"""
+    return ', '.join(f"{PHASE_LABELS.get(phase, phase.capitalize())} {seconds:.1f}s"
+                     for phase, seconds in timings.items())
+
+
+class ProgressReporter:
+    """Adapter from yt-dlp hooks to throttled ProgressEvent callbacks
+
+    timings collects the wall-clock seconds of each phase: 'downloading'
+    from the first to the last byte of all streams, and one entry per
+    postprocessing phase. Pass a dict to have them recorded into it.
+    """
+
+    def __init__(self, callback, interval=0.5, timings=None):
+        self.callback = callback
+        self.interval = interval
+        self.timings = {} if timings is None else timings
+        self._last_emit = 0.0
+        self._last_key = None
+        # Per stream: [downloaded bytes, total bytes, speed, finished]
+        self._streams = {}
+        self._started = {}
+        self._lock = threading.Lock()
+
+    @property
+    def downloaded_bytes(self):
+        """Bytes of all streams downloaded so far (including those of a resumed attempt)"""
+        with self._lock:
+            return sum(stream[0] for stream in self._streams.values())
+
+    def _emit(self, event):
+        # Always pass on phase/status changes, throttle everything else
+        key = (event.phase, event.status, event.stream_index)
+        now = time.monotonic()
+        if key == self._last_key and now - self._last_emit < self.interval:
+            return
+        self._last_key = key
+        self._last_emit = now
+        self.callback(event)
+
+    def _time(self, phase, status):
+        """Accumulate the time between a phase's start and its finish"""
+        now = time.monotonic()
+        if status == 'finished' and phase in self._started:
+            self.timings[phase] = self.timings.get(phase, 0.0) + now - self._started.pop(phase)
+        elif status != 'finished':
+            self._started.setdefault(phase, now)
+
+    def progress_hook(self, d):
+        """yt-dlp progress_hooks entry"""
+        info_dict = d.get('info_dict') or {}
+        status = d.get('status')
+        with self._lock:
+            stream = self._streams.setdefault(info_dict.get('format_id') or d.get('filename'), [0, None, None, False])
+            stream[:] = [
+                d.get('downloaded_bytes') or d.get('total_bytes') or 0,
+                d.get('total_bytes') or d.get('total_bytes_estimate'),
+                d.get('speed'),
+                status == 'finished',
+            ]
+            streams = list(self._streams.values())
+            finished = sum(1 for s in streams if s[3])
+            all_finished = finished == len(streams)
+            # The download phase lasts until every stream has finished
+            self._time('downloading', 'finished' if all_finished else 'downloading')
+            downloaded = sum(s[0] for s in streams)
+            total = sum(s[1] for s in streams) if all(s[1] for s in streams) else None
+            speed = sum(s[2] or 0 for s in streams if not s[3]) or None
+            if len(streams) == 1:
+                eta = d.get('eta')
+            else:
+                eta = (total - downloaded) / speed if total and speed else None
+            self._emit(ProgressEvent(
+                phase='downloading',
+                status='finished' if all_finished else 'downloading',
+                downloaded_bytes=downloaded,
+                total_bytes=total,
+                speed=speed,
+                eta=eta,
+                fragment_index=d.get('fragment_index') if len(streams) == 1 else None,
+                fragment_count=d.get('fragment_count') if len(streams) == 1 else None,
+                stream_index=min(finished + 1, len(streams)),
+                stream_count=len(streams),
+            ))
+
+    def postprocessor_hook(self, d):
+        """yt-dlp postprocessor_hooks entry"""
+        postprocessor = d.get('postprocessor')
+        phase = POSTPROCESSOR_PHASES.get(postprocessor, 'postprocessing')
+        with self._lock:
+            self._time(phase, d.get('status'))
+            self._emit(ProgressEvent(
+                phase=phase,
+                status=d.get('status'),
+                postprocessor=postprocessor,
+            ))
@@ -0,0 +1,197 @@
+"""Per-host request scheduling: rate limits, adaptive backoff and priorities
+
+Every session used to hit the upstream on its own, with a fixed retry count,
+so under load the hosts answered with 429s and throttled speeds and
+throughput collapsed. All requests of the process (extraction and media
+fetches alike) now go through one HostScheduler: each host gets a token
+bucket of HOST_RATE requests per second, and a host that answers 429, 403
+or 503, or delivers at a throttled speed, is backed off exponentially with
+jitter (at least as long as its Retry-After) while its rate is halved. The
+rate recovers step by step with every successful request.
+
+Requests waiting for the same host are served by priority: interactive
+requests ("Get Video Info") before single downloads before batch items.
+"""
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlsplit
+
+from . import config, metrics
+
+logger = logging.getLogger(__name__)
+
+# Request priorities, most urgent first
+INTERACTIVE = 0
+NORMAL = 1
+BULK = 2
+
+# Responses meaning the host wants us to slow down, and those worth retrying after the backoff
+# (a 403 is usually an expired or forbidden URL, which asking again won't fix)
+THROTTLE_STATUSES = (403, 429, 503)
+RETRY_STATUSES = (429, 503)
+
+# Backoff: the first one lasts BACKOFF_BASE seconds and each further one in a row doubles it
+BACKOFF_BASE = 1.0
+# Lowest rate a host is slowed down to, and how much each success gives back (requests per second)
+MIN_RATE = 0.5
+RECOVERY_STEP = 0.5
+
+# Hosts remembered at most; idle ones are forgotten first
+MAX_HOSTS = 1024
+
+throttle_events = metrics.Counter('ytdl_throttle_events_total', 'Responses and speeds that made a host back off',
+                                  ['reason'])
+rate_limit_wait_seconds = metrics.Histogram('ytdl_rate_limit_wait_seconds',
+                                            'Time requests waited for their host\'s rate limit or backoff')
+
+
+def host_of(url):
+    """Return the host name of a URL ('' when it has none)"""
+    return (urlsplit(url).hostname or '').lower()
+
+
+def parse_retry_after(value):
+    """Parse a Retry-After header in seconds; None when missing or given as a date"""
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+class _Host:
+    """Token bucket and backoff state of one host"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.failures = 0
+        self.waiting = []  # heap of (priority, sequence) tickets
+
+    def refill(self, now, burst):
+        self.tokens = min(burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    @property
+    def idle(self):
+        return not self.waiting and not self.failures and self.blocked_until <= time.monotonic()
+
+
+class HostScheduler:
+    """Token-bucket rate limits and adaptive backoff per upstream host
+
+    rate is in requests per second (0 disables the rate limit, backoff still
+    applies), burst the number of requests a rested host may take at once.
+    """
+
+    def __init__(self, rate, burst, backoff_max, max_hosts=MAX_HOSTS):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.backoff_max = backoff_max
+        self.max_hosts = max_hosts
+        self._hosts = OrderedDict()
+        self._sequence = itertools.count()
+        self._cond = threading.Condition()
+
+    def _host(self, name):
+        host = self._hosts.get(name)
+        if host is None:
+            host = self._hosts[name] = _Host(self.rate, self.burst)
+            if len(self._hosts) > self.max_hosts:
+                for other in [key for key, value in self._hosts.items() if value.idle][:len(self._hosts) - self.max_hosts]:
+                    del self._hosts[other]
+        else:
+            self._hosts.move_to_end(name)
+        return host
+
+    def acquire(self, url, priority=NORMAL):
+        """Wait until a request to url may be sent; return the seconds waited
+
+        A host's waiting requests go out by priority, then in arrival order.
+        """
+        name = host_of(url)
+        started = time.monotonic()
+        with self._cond:
+            host = self._host(name)
+            ticket = (priority, next(self._sequence))
+            heapq.heappush(host.waiting, ticket)
+            try:
+                while True:
+                    now = time.monotonic()
+                    timeout = host.blocked_until - now
+                    if timeout <= 0:
+                        if host.waiting[0] != ticket:
+                            # A more urgent or earlier request goes first
+                            timeout = None
+                        elif not self.rate:
+                            break
+                        else:
+                            host.refill(now, self.burst)
+                            if host.tokens >= 1:
+                                host.tokens -= 1
+                                break
+                            timeout = (1 - host.tokens) / host.rate
+                    self._cond.wait(timeout)
+            finally:
+                host.waiting.remove(ticket)
+                heapq.heapify(host.waiting)
+                self._cond.notify_all()
+        waited = time.monotonic() - started
+        rate_limit_wait_seconds.observe(waited)
+        return waited
+
+    def success(self, url):
+        """Record a successful request: the host's rate recovers a step"""
+        with self._cond:
+            host = self._hosts.get(host_of(url))
+            if host is None:
+                return
+            host.failures = 0
+            if self.rate:
+                host.rate = min(self.rate, host.rate + RECOVERY_STEP)
+
+    def backoff(self, url, reason, retry_after=None):
+        """Slow a host down after a throttling signal; return the backoff in seconds
+
+        The backoff doubles with every signal in a row (up to backoff_max),
+        is jittered so waiting requests don't return in lockstep, and lasts
+        at least as long as the server's Retry-After.
+        """
+        throttle_events.inc(reason=reason)
+        with self._cond:
+            host = self._host(host_of(url))
+            host.failures += 1
+            delay = min(self.backoff_max, BACKOFF_BASE * 2 ** (host.failures - 1))
+            delay = random.uniform(delay / 2, delay)
+            if retry_after is not None:
+                delay = max(delay, min(retry_after, self.backoff_max))
+            host.blocked_until = max(host.blocked_until, time.monotonic() + delay)
+            if self.rate:
+                host.rate = max(MIN_RATE, host.rate / 2)
+            self._cond.notify_all()
+        logger.info("Backing off %s for %.1fs (%s)", host_of(url), delay, reason)
+        return delay
+
+    def report_speed(self, url, bytes_per_second):
+        """Back off a host whose download speed fell below the throttling threshold"""
+        if config.THROTTLED_KBPS and bytes_per_second < config.THROTTLED_KBPS * 1024:
+            self.backoff(url, 'speed')
+
+    def stats(self):
+        """Return the current rate and remaining backoff per host that is being slowed down"""
+        now = time.monotonic()
+        with self._cond:
+            return {
+                name: {'rate': host.rate, 'backoff': max(0.0, host.blocked_until - now), 'waiting': len(host.waiting)}
+                for name, host in self._hosts.items()
+                if host.rate < self.rate or host.blocked_until > now or host.waiting
+            }
+
+
+scheduler = HostScheduler(config.HOST_RATE, config.HOST_BURST, config.BACKOFF_MAX_SECONDS)
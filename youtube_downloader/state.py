@@ -0,0 +1,323 @@
+"""State shared by every app process and replica
+
+One process used to keep its jobs, locks and download links to itself, so
+replicas behind a load balancer downloaded the same videos side by side and
+could not serve each other's links. Everything they need to agree on now
+goes through a SharedState: a key/value store with expiring keys and
+atomic "set if absent", on which cross-replica locks (leases that are
+renewed while held) are built.
+
+The default backend is a SQLite database in the data directory, which is
+enough for several processes on one machine. Replicas on more than one
+machine need Redis: SQLite's locking can't be relied on over network file
+systems. Set YTDL_STATE_URL to a redis:// URL (needs the redis package);
+RedisState takes any Redis-compatible client, so tests can pass a local
+stand-in such as fakeredis.
+"""
+import contextlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from urllib.parse import urlsplit
+
+from . import config, metrics
+
+logger = logging.getLogger(__name__)
+
+# Locks expire this many seconds after their holder stops renewing them (e.g. it crashed)
+LOCK_TTL = 30
+LOCK_POLL = 0.5
+
+# Expired SQLite rows are deleted every this many writes
+PURGE_EVERY = 200
+
+lock_wait_seconds = metrics.Histogram('ytdl_state_lock_wait_seconds', 'Time spent waiting for cross-replica locks')
+
+
+class LockLost(Exception):
+    """Raised by Lease.check() once the lock has passed to someone else"""
+
+
+def _dump(value):
+    return json.dumps(value, sort_keys=True, separators=(',', ':'), default=str)
+
+
+class Lease:
+    """A held lock, renewed in the background until it is released
+
+    The lock is lost when a renewal finds another holder, or when renewals
+    have failed for longer than ttl (others may have taken it since). Work
+    done under the lock should call check() before anything it must not
+    do without it.
+    """
+
+    def __init__(self, state, key, token, ttl):
+        self.state = state
+        self.key = key
+        self.token = token
+        self.ttl = ttl
+        self.lost = False
+        self._renewed = time.monotonic()
+        self._stop = threading.Event()
+        self._renewer = threading.Thread(target=self._renew, name='lease-renewer', daemon=True)
+        self._renewer.start()
+
+    def _renew(self):
+        while not self._stop.wait(self.ttl / 3):
+            try:
+                if not self.state.expire(self.key, self.token, self.ttl):
+                    self._lose("another holder took it")
+                    return
+                self._renewed = time.monotonic()
+            except Exception:
+                logger.exception("Renewing lock %s failed", self.key)
+                if time.monotonic() - self._renewed > self.ttl:
+                    self._lose("it expired while it couldn't be renewed")
+                    return
+
+    def _lose(self, reason):
+        self.lost = True
+        logger.warning("Lost lock %s: %s", self.key, reason)
+
+    def check(self):
+        """Raise LockLost if the lock has been lost"""
+        if self.lost:
+            raise LockLost(f"Lost lock {self.key[len('lock:'):]} to another process")
+
+    def release(self):
+        self._stop.set()
+        self._renewer.join()
+        self.state.delete(self.key, self.token)
+
+
+class SharedState:
+    """Key/value store shared between replicas; values are JSON, ttl is in seconds (None keeps the key)
+
+    Backends implement get, set, add, delete, expire and scan.
+    """
+
+    def get(self, key):
+        """Return the value of a key, or None if it is missing or expired"""
+        raise NotImplementedError
+
+    def set(self, key, value, ttl=None):
+        """Store a value"""
+        raise NotImplementedError
+
+    def add(self, key, value, ttl=None):
+        """Store a value unless the key exists; return True if it was stored"""
+        raise NotImplementedError
+
+    def delete(self, key, value=None):
+        """Delete a key (only while it holds value, if given); return True if it was deleted"""
+        raise NotImplementedError
+
+    def expire(self, key, value, ttl):
+        """Give a key that still holds value a new ttl; return False if it doesn't hold it any more"""
+        raise NotImplementedError
+
+    def scan(self, prefix):
+        """Return {key: value} of the keys starting with prefix"""
+        raise NotImplementedError
+
+    @contextlib.contextmanager
+    def lock(self, name, ttl=LOCK_TTL, timeout=None, check=None):
+        """Hold the lock called name across all replicas for the duration of the block
+
+        Yields the Lease. Raises TimeoutError after waiting timeout seconds.
+        check is called between attempts while waiting (e.g. to stop waiting
+        for a cancelled job by raising). A holder that dies without releasing
+        it loses the lock after ttl.
+        """
+        key = f'lock:{name}'
+        token = f'{config.REPLICA_ID}:{uuid.uuid4().hex}'
+        started = time.monotonic()
+        while not self.add(key, token, ttl):
+            if timeout is not None and time.monotonic() - started >= timeout:
+                raise TimeoutError(f"Lock {name} is held elsewhere")
+            if check is not None:
+                check()
+            time.sleep(LOCK_POLL)
+        lock_wait_seconds.observe(time.monotonic() - started)
+        lease = Lease(self, key, token, ttl)
+        try:
+            yield lease
+        finally:
+            lease.release()
+
+    def locked(self, name):
+        """Return True if someone holds the lock called name"""
+        return self.get(f'lock:{name}') is not None
+
+
+class SQLiteState(SharedState):
+    """SharedState in a SQLite database, for processes sharing a file system"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._writes = 0
+        # The database is created on first use, so importing the package leaves no files behind
+        self._created = False
+        self._create_lock = threading.Lock()
+
+    def _connect(self):
+        """Return this thread's connection (sqlite3 connections can't be shared between threads)"""
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            with self._create_lock:
+                if not self._created:
+                    db.execute('CREATE TABLE IF NOT EXISTS state '
+                               '(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL)')
+                    self._created = True
+            self._local.db = db
+        return db
+
+    @staticmethod
+    def _expires(ttl):
+        return time.time() + ttl if ttl is not None else None
+
+    def _wrote(self, db):
+        self._writes += 1
+        if self._writes % PURGE_EVERY == 0:
+            db.execute('DELETE FROM state WHERE expires <= ?', (time.time(),))
+
+    def get(self, key):
+        row = self._connect().execute(
+            'SELECT value FROM state WHERE key = ? AND (expires IS NULL OR expires > ?)', (key, time.time()),
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key, value, ttl=None):
+        db = self._connect()
+        db.execute('INSERT OR REPLACE INTO state (key, value, expires) VALUES (?, ?, ?)',
+                   (key, _dump(value), self._expires(ttl)))
+        self._wrote(db)
+
+    def add(self, key, value, ttl=None):
+        db = self._connect()
+        # IMMEDIATE takes the write lock up front, so no other process slips in between the statements
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.execute('DELETE FROM state WHERE key = ? AND expires <= ?', (key, time.time()))
+            added = db.execute('INSERT OR IGNORE INTO state (key, value, expires) VALUES (?, ?, ?)',
+                               (key, _dump(value), self._expires(ttl))).rowcount == 1
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        self._wrote(db)
+        return added
+
+    def delete(self, key, value=None):
+        if value is None:
+            return self._connect().execute('DELETE FROM state WHERE key = ?', (key,)).rowcount == 1
+        return self._connect().execute('DELETE FROM state WHERE key = ? AND value = ?',
+                                       (key, _dump(value))).rowcount == 1
+
+    def expire(self, key, value, ttl):
+        return self._connect().execute(
+            'UPDATE state SET expires = ? WHERE key = ? AND value = ? AND (expires IS NULL OR expires > ?)',
+            (self._expires(ttl), key, _dump(value), time.time()),
+        ).rowcount == 1
+
+    def scan(self, prefix):
+        rows = self._connect().execute(
+            'SELECT key, value FROM state WHERE key >= ? AND key < ? AND (expires IS NULL OR expires > ?)',
+            (prefix, prefix + '\uffff', time.time()),
+        )
+        return {key: json.loads(value) for key, value in rows}
+
+
+class RedisState(SharedState):
+    """SharedState in Redis (or anything speaking its protocol), for replicas on different machines
+
+    client is a redis.Redis; all keys are stored under prefix.
+    """
+
+    def __init__(self, client, prefix='ytdl:'):
+        self.client = client
+        self.prefix = prefix
+
+    def _ms(self, ttl):
+        return max(1, int(ttl * 1000)) if ttl is not None else None
+
+    def get(self, key):
+        raw = self.client.get(self.prefix + key)
+        return json.loads(raw) if raw is not None else None
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self.prefix + key, _dump(value), px=self._ms(ttl))
+
+    def add(self, key, value, ttl=None):
+        return bool(self.client.set(self.prefix + key, _dump(value), px=self._ms(ttl), nx=True))
+
+    def _if_holds(self, key, value, operation):
+        """Run operation(pipeline, key) in a transaction if key holds value; return True if it ran"""
+        from redis.exceptions import WatchError
+
+        key = self.prefix + key
+        expected = _dump(value).encode()
+        with self.client.pipeline() as pipe:
+            try:
+                pipe.watch(key)
+                current = pipe.get(key)
+                if (current.encode() if isinstance(current, str) else current) != expected:
+                    pipe.unwatch()
+                    return False
+                pipe.multi()
+                operation(pipe, key)
+                pipe.execute()
+                return True
+            except WatchError:
+                # Changed while we looked, so it no longer holds value
+                return False
+
+    def delete(self, key, value=None):
+        if value is None:
+            return self.client.delete(self.prefix + key) == 1
+        return self._if_holds(key, value, lambda pipe, name: pipe.delete(name))
+
+    def expire(self, key, value, ttl):
+        return self._if_holds(key, value, lambda pipe, name: pipe.pexpire(name, self._ms(ttl)))
+
+    def scan(self, prefix):
+        found = {}
+        for name in self.client.scan_iter(match=_glob_escape(self.prefix + prefix) + '*'):
+            name = name.decode() if isinstance(name, bytes) else name
+            value = self.client.get(name)
+            if value is not None:
+                found[name[len(self.prefix):]] = json.loads(value)
+        return found
+
+
+def _glob_escape(text):
+    """Escape the glob characters of Redis' MATCH patterns"""
+    return ''.join(f'\\{char}' if char in '*?[]\\' else char for char in text)
+
+
+def open_state(url=None):
+    """Return the SharedState for a URL: empty or sqlite:///path for SQLite, redis://... for Redis"""
+    url = url or f'sqlite:///{os.path.join(config.DATA_DIR, "state.sqlite3")}'
+    scheme = urlsplit(url).scheme
+    if scheme == 'sqlite':
+        return SQLiteState(url[len('sqlite:///'):] or os.path.join(config.DATA_DIR, 'state.sqlite3'))
+    if scheme in ('redis', 'rediss', 'unix'):
+        try:
+            import redis
+        except ImportError as e:
+            raise ImportError("YTDL_STATE_URL points to Redis, which needs the redis package "
+                              "(pip install redis)") from e
+        return RedisState(redis.Redis.from_url(url))
+    raise ValueError(f"Unsupported YTDL_STATE_URL: {url}")
+
+
+shared_state = open_state(config.STATE_URL)
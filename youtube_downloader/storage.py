@@ -0,0 +1,277 @@
+"""Where finished files are kept and how browsers get them
+
+Delivered files used to live only on the app's disk and always reached the
+browser through the app's own delivery server. Downloads are now handed to
+a Storage:
+
+- LocalStorage (the default) keeps them on disk and serves them through the
+  delivery server (see delivery), linking to other replicas' caches through
+  the shared index.
+- S3Storage uploads them to an S3-compatible bucket (AWS S3, MinIO, ...)
+  and hands out presigned URLs, so browsers download straight from the
+  bucket, bypassing the app's memory and bandwidth. Downloads are stored
+  under their download cache key next to a meta.json, so every replica and
+  session reuses a file once any of them has uploaded it.
+
+Uploads go through MultipartWriter, which sends parts as the bytes come in,
+a few at a time, and never holds more than that many parts in memory. Set
+YTDL_STORAGE_URL to s3://bucket/prefix to use S3 (needs the boto3 package);
+objects are never deleted by the app, so give the bucket a lifecycle rule.
+"""
+import json
+import logging
+import math
+import os
+import secrets
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote, urlsplit
+
+from . import config, delivery, metrics
+from .delivery import Published
+from .download_cache import download_cache
+
+logger = logging.getLogger(__name__)
+
+# S3 takes at most this many parts per upload, each at least MIN_PART_SIZE (except the last)
+MAX_PARTS = 10000
+MIN_PART_SIZE = 5 * 1024 * 1024
+READ_CHUNK_SIZE = 1024 * 1024
+
+META_FILE = 'meta.json'
+
+uploaded_bytes = metrics.Counter('ytdl_storage_uploaded_bytes_total', 'Bytes uploaded to object storage')
+upload_seconds = metrics.Histogram('ytdl_storage_upload_seconds', 'Duration of uploads to object storage')
+storage_lookups = metrics.Counter('ytdl_storage_lookups_total', 'Lookups of downloads in object storage', ['result'])
+
+
+class LocalStorage:
+    """Files on this replica's disk, served by its delivery server"""
+
+    def publish(self, file_path, file_name, mime_type, key=None, meta=None, move=True, ttl=None):
+        """Make a file downloadable and return it as Published (link, local path, expiry)
+
+        key and meta identify a download cache entry; they let other
+        replicas and sessions find the file with lookup().
+        """
+        return delivery.publish(file_path, file_name=file_name, mime_type=mime_type, move=move, ttl=ttl)
+
+    def lookup(self, key):
+        """Return {'file', 'size', 'meta'} for a download stored elsewhere (another replica), or None"""
+        return download_cache.lookup_remote(key)
+
+    def link(self, key, entry, file_name, mime_type, ttl=None):
+        """Return a link to a download found with lookup() (entry is what it returned)"""
+        return delivery.publish_cached(key, file_name, mime_type, ttl=ttl).url
+
+
+class MultipartWriter:
+    """A writable file that uploads to S3 in parts while it is written
+
+    Full parts are uploaded in the background, at most concurrency at a
+    time; write() blocks while that many are in flight. close() completes
+    the upload, abort() (or an error) discards it.
+    """
+
+    def __init__(self, client, bucket, key, mime_type, part_size, concurrency):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.mime_type = mime_type
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.size = 0
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._parts = []
+        self._pool = None
+        self._slots = threading.BoundedSemaphore(concurrency)
+        self._concurrency = concurrency
+
+    def write(self, data):
+        self._buffer += data
+        self.size += len(data)
+        while len(self._buffer) >= self.part_size:
+            self._send(bytes(self._buffer[:self.part_size]))
+            del self._buffer[:self.part_size]
+        return len(data)
+
+    def _send(self, data):
+        """Upload one part in the background"""
+        if self._upload_id is None:
+            self._upload_id = self.client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key, ContentType=self.mime_type,
+            )['UploadId']
+            self._pool = ThreadPoolExecutor(max_workers=self._concurrency, thread_name_prefix='s3-upload')
+        part_number = len(self._parts) + 1
+        if part_number > MAX_PARTS:
+            raise ValueError(f"Upload of {self.key} needs more than {MAX_PARTS} parts; raise the part size")
+        self._slots.acquire()
+        # A failed part surfaces in close()
+        future = self._pool.submit(self._upload_part, part_number, data)
+        future.add_done_callback(lambda _: self._slots.release())
+        self._parts.append(future)
+
+    def _upload_part(self, part_number, data):
+        response = self.client.upload_part(
+            Bucket=self.bucket, Key=self.key, UploadId=self._upload_id, PartNumber=part_number, Body=data,
+        )
+        uploaded_bytes.inc(len(data))
+        return {'PartNumber': part_number, 'ETag': response['ETag']}
+
+    def close(self):
+        """Finish the upload; raises (after discarding the upload) if a part failed"""
+        try:
+            if self._upload_id is None:
+                # Small enough for a single request
+                self.client.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self._buffer),
+                                       ContentType=self.mime_type)
+                uploaded_bytes.inc(len(self._buffer))
+                return
+            if self._buffer:
+                self._send(bytes(self._buffer))
+            parts = [future.result() for future in self._parts]
+            self.client.complete_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self._upload_id, MultipartUpload={'Parts': parts},
+            )
+        except BaseException:
+            self.abort()
+            raise
+        finally:
+            self._buffer.clear()
+            if self._pool is not None:
+                self._pool.shutdown()
+
+    def abort(self):
+        """Discard the parts uploaded so far"""
+        if self._upload_id is None:
+            return
+        for future in self._parts:
+            future.cancel()
+        try:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id)
+        except Exception:
+            logger.exception("Aborting upload of %s failed", self.key)
+        self._upload_id = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+            if self._pool is not None:
+                self._pool.shutdown()
+
+
+class S3Storage:
+    """Files in an S3-compatible bucket, downloaded by browsers through presigned URLs
+
+    client is a boto3 S3 client; objects are stored under prefix.
+    part_size and concurrency bound the memory an upload uses.
+    """
+
+    def __init__(self, client, bucket, prefix='', part_size=16 * 1024 * 1024, concurrency=4):
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix.strip('/') + '/' if prefix.strip('/') else ''
+        self.part_size = part_size
+        self.concurrency = concurrency
+
+    def writer(self, object_key, mime_type, size=None):
+        """Return a MultipartWriter for an object (size, if known, raises the part size to fit S3's part limit)"""
+        part_size = max(self.part_size, math.ceil(size / MAX_PARTS)) if size else self.part_size
+        return MultipartWriter(self.client, self.bucket, self.prefix + object_key, mime_type, part_size,
+                               self.concurrency)
+
+    def upload(self, file_path, object_key, mime_type):
+        """Upload a file, streaming it from disk in parts"""
+        started = time.monotonic()
+        with open(file_path, 'rb') as f, self.writer(object_key, mime_type, os.fstat(f.fileno()).st_size) as writer:
+            while chunk := f.read(READ_CHUNK_SIZE):
+                writer.write(chunk)
+        upload_seconds.observe(time.monotonic() - started)
+
+    def _exists(self, object_key):
+        from botocore.exceptions import ClientError
+
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.prefix + object_key)
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+        return True
+
+    def _url(self, object_key, file_name, mime_type, ttl):
+        """Return a presigned download link that saves the object as file_name"""
+        return self.client.generate_presigned_url('get_object', Params={
+            'Bucket': self.bucket,
+            'Key': self.prefix + object_key,
+            'ResponseContentType': mime_type,
+            'ResponseContentDisposition': f"attachment; filename*=UTF-8''{quote(file_name)}",
+        }, ExpiresIn=ttl or config.DELIVERY_TTL)
+
+    def publish(self, file_path, file_name, mime_type, key=None, meta=None, move=True, ttl=None):
+        name = delivery.safe_name(file_name)
+        if key is None:
+            object_key = f'files/{secrets.token_urlsafe(12)}/{name}'
+            self.upload(file_path, object_key, mime_type)
+        else:
+            object_key = f'cache/{key}/{os.path.basename(file_path)}'
+            if not self._exists(object_key):
+                self.upload(file_path, object_key, mime_type)
+                # Written last: lookup() only finds complete uploads
+                entry = {'file': os.path.basename(file_path), 'size': os.path.getsize(file_path), 'meta': meta}
+                self.client.put_object(Bucket=self.bucket, Key=f'{self.prefix}cache/{key}/{META_FILE}',
+                                       Body=json.dumps(entry, default=str).encode(),
+                                       ContentType='application/json')
+        expires = int(time.time() + (ttl or config.DELIVERY_TTL))
+        url = self._url(object_key, name, mime_type, ttl)
+        if move:
+            os.remove(file_path)
+        # The bucket has the file; a copy left behind (move=False) is the caller's and may be gone any time,
+        # so there is no local path to hand out
+        return Published(url, None, expires)
+
+    def lookup(self, key):
+        from botocore.exceptions import BotoCoreError, ClientError
+
+        try:
+            body = self.client.get_object(Bucket=self.bucket, Key=f'{self.prefix}cache/{key}/{META_FILE}')['Body']
+            entry = json.loads(body.read())
+        except self.client.exceptions.NoSuchKey:
+            storage_lookups.inc(result='miss')
+            return None
+        except (BotoCoreError, ClientError):
+            # Denied, throttled or unreachable: download the file again rather than fail the job
+            logger.warning("Looking up %s in the bucket failed", key, exc_info=True)
+            storage_lookups.inc(result='error')
+            return None
+        storage_lookups.inc(result='hit')
+        return entry
+
+    def link(self, key, entry, file_name, mime_type, ttl=None):
+        return self._url(f"cache/{key}/{entry['file']}", delivery.safe_name(file_name), mime_type, ttl)
+
+
+def open_storage(url=None):
+    """Return the Storage for a URL: empty for local disk, s3://bucket/prefix for S3"""
+    if not url:
+        return LocalStorage()
+    parts = urlsplit(url)
+    if parts.scheme != 's3':
+        raise ValueError(f"Unsupported YTDL_STORAGE_URL: {url}")
+    try:
+        import boto3
+    except ImportError as e:
+        raise ImportError("YTDL_STORAGE_URL points to S3, which needs the boto3 package (pip install boto3)") from e
+    # Credentials come from boto3's usual sources (AWS_ACCESS_KEY_ID etc.)
+    client = boto3.client('s3', endpoint_url=config.S3_ENDPOINT_URL or None, region_name=config.S3_REGION or None)
+    return S3Storage(client, parts.netloc, parts.path, part_size=config.S3_PART_MB * 1024 * 1024,
+                     concurrency=config.S3_UPLOAD_CONCURRENCY)
+
+
+storage = open_storage(config.STORAGE_URL)
@@ -0,0 +1,248 @@
+"""The yt-dlp postprocessors of audio downloads, and audio extraction that runs while downloading
+
+AudioOutputPP carries out the transcode.plan_audio plan of a finished
+download, which means reading the whole file a second time to convert it.
+StreamingExtractAudioPP starts FFmpeg as soon as the download starts and
+feeds it the bytes as they land on disk, so the MP3 is ready moments after
+the last byte arrives. When FFmpeg can't read
+the input as a stream (e.g. an MP4 whose index is at the end of the file),
+the postprocessor falls back to the regular conversion of the finished file.
+
+Only downloads that need re-encoding (see transcode.plan_audio) are streamed,
+and only while the transcode pool has a free slot; otherwise the finished
+file waits in line for one.
+"""
+import contextlib
+import logging
+import os
+import subprocess
+import threading
+import time
+
+from yt_dlp.postprocessor import PostProcessor
+from yt_dlp.utils import PostProcessingError
+
+from .formats import AUDIO_CODEC_FAMILIES, UNKNOWN_CODEC, codec_family
+from .transcode import (
+    DEFAULT_AUDIO_FORMAT, DEFAULT_AUDIO_QUALITY, KEEP, TRANSCODE, audio_outputs, plan_audio, probe_codec, transcode_pool,
+)
+
+logger = logging.getLogger(__name__)
+
+FEED_CHUNK_SIZE = 1024 * 1024
+# How long to wait for bytes reported as downloaded to be flushed to disk
+FLUSH_WAIT = 0.05
+
+
+def _read(path, offset, size):
+    """Read up to size bytes of a file from offset (opened briefly so the downloader can rename it)"""
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        return f.read(size)
+
+
+class AudioOutputPP(PostProcessor):
+    """Turn a downloaded audio file into the requested format with as little FFmpeg work as possible"""
+
+    @classmethod
+    def pp_key(cls):
+        # Report progress and timings under the name of the postprocessor this replaces
+        return 'ExtractAudio'
+
+    def __init__(self, downloader, ffmpeg_path, audio_format=DEFAULT_AUDIO_FORMAT, quality=DEFAULT_AUDIO_QUALITY):
+        super().__init__(downloader)
+        self.ffmpeg_path = ffmpeg_path
+        self.audio_format = audio_format
+        self.quality = quality
+
+    def plan(self, information, path=None):
+        """Return the Plan for a download; an unknown codec is looked up with ffprobe once the file exists"""
+        acodec = information.get('acodec')
+        if codec_family(acodec, AUDIO_CODEC_FAMILIES) in (None, UNKNOWN_CODEC) and path:
+            acodec = probe_codec(path) or acodec
+        return plan_audio(acodec, information.get('ext'), self.audio_format, self.quality)
+
+    def run(self, information):
+        path = information['filepath']
+        plan = self.plan(information, path)
+        audio_outputs.inc(action=plan.action)
+        if plan.action == KEEP:
+            self.to_screen(f'Not converting audio {path}; it already is {plan.ext}')
+            return [], information
+
+        output_path = f'{os.path.splitext(path)[0]}.{plan.ext}'
+        tmp_path = f'{output_path}.part'
+        self.to_screen(f'Destination: {output_path} ({plan.action})')
+        try:
+            transcode_pool.run([self.ffmpeg_path, '-y', '-loglevel', 'error', '-i', path, '-vn', *plan.args,
+                                tmp_path], plan.action)
+        except subprocess.CalledProcessError as e:
+            with contextlib.suppress(OSError):
+                os.remove(tmp_path)
+            raise PostProcessingError(f'FFmpeg failed: {e.stderr.strip() or e.returncode}') from e
+        os.replace(tmp_path, output_path)
+        information['filepath'] = output_path
+        information['ext'] = plan.ext
+        # The downloaded original is deleted like FFmpegExtractAudio does
+        return ([path] if output_path != path else []), information
+
+
+class StreamingAudioEncoder:
+    """An FFmpeg process encoding a file that is still being written
+
+    It runs in a transcode pool slot the caller has taken, which is released
+    once the encode finishes or is aborted.
+    """
+
+    def __init__(self, ffmpeg_path, output_path, codec_args):
+        self.output_path = output_path
+        self.tmp_path = f'{output_path}.part'
+        self.error = None
+        self._cond = threading.Condition()
+        self._source = None
+        self._available = 0
+        self._finished = False
+        self._aborted = False
+        self._released = False
+        self.process = transcode_pool.popen(
+            [ffmpeg_path, '-y', '-loglevel', 'error', '-i', 'pipe:0', '-vn', *codec_args, self.tmp_path],
+            stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        )
+        self._feeder = threading.Thread(target=self._feed, name='audio-stream-feeder', daemon=True)
+        self._feeder.start()
+
+    def progress_hook(self, d):
+        """yt-dlp progress hook for the download being encoded"""
+        with self._cond:
+            if d.get('status') == 'downloading':
+                self._source = d.get('tmpfilename') or d.get('filename')
+                # Parallel downloads report how much of the file is complete from the start
+                self._available = d.get('contiguous_bytes', d.get('downloaded_bytes') or 0)
+            elif d.get('status') == 'finished':
+                self._source = d.get('filename')
+                self._finished = True
+            self._cond.notify_all()
+
+    def _feed(self):
+        offset = 0
+        try:
+            while True:
+                with self._cond:
+                    while not (self._aborted or self._finished or self._available > offset):
+                        self._cond.wait()
+                    if self._aborted:
+                        return
+                    source, available, finished = self._source, self._available, self._finished
+                # Until the download finishes, never read past the bytes known to be written
+                size = FEED_CHUNK_SIZE if finished else min(FEED_CHUNK_SIZE, available - offset)
+                data = _read(source, offset, size)
+                if data:
+                    self.process.stdin.write(data)
+                    offset += len(data)
+                elif finished:
+                    break
+                else:
+                    time.sleep(FLUSH_WAIT)
+            self.process.stdin.close()
+        except (OSError, ValueError) as e:
+            # FFmpeg gave up on the input (its stdin closed) or the file went away; either
+            # way the encode is over, so FFmpeg must not keep waiting for more input
+            self.error = str(e)
+            with contextlib.suppress(OSError, ValueError):
+                self.process.stdin.close()
+            self.process.kill()
+
+    def finish(self):
+        """Wait for the encode to complete; return True if output_path was written"""
+        self._feeder.join()
+        # (communicate() would try to flush the stdin the feeder already closed)
+        stderr = self.process.stderr.read()
+        self.process.wait()
+        self._release()
+        if self.process.returncode == 0 and self.error is None:
+            os.replace(self.tmp_path, self.output_path)
+            return True
+        self.error = self.error or stderr.decode(errors='replace').strip()
+        self._cleanup()
+        return False
+
+    def abort(self):
+        """Stop encoding and remove the partial output"""
+        with self._cond:
+            self._aborted = True
+            self._cond.notify_all()
+        self.process.kill()
+        self.process.wait()
+        self._feeder.join()
+        self._release()
+        self._cleanup()
+
+    def _release(self):
+        """Give the transcode pool slot back (once)"""
+        if not self._released:
+            self._released = True
+            transcode_pool.release()
+
+    def _cleanup(self):
+        try:
+            os.remove(self.tmp_path)
+        except OSError:
+            pass
+
+
+class StreamingExtractAudioPP(AudioOutputPP):
+    """AudioOutputPP that encodes while downloading (add it to ParallelYoutubeDL.live_postprocessors too)"""
+
+    def __init__(self, downloader, ffmpeg_path, audio_format='mp3', quality='192'):
+        super().__init__(downloader, ffmpeg_path, audio_format, quality)
+        self._encoders = {}
+
+    def attach(self, filename, info_dict):
+        """Start encoding a download; return its progress hook, or None if it isn't worth it"""
+        if codec_family(info_dict.get('acodec'), AUDIO_CODEC_FAMILIES) in (None, UNKNOWN_CODEC):
+            # Whether it needs encoding at all is only known once ffprobe can look at the file
+            return None
+        plan = plan_audio(info_dict.get('acodec'), info_dict.get('ext'), self.audio_format, self.quality)
+        output_path = f'{os.path.splitext(filename)[0]}.{plan.ext}'
+        if plan.action != TRANSCODE or output_path == filename:
+            return None
+        # With every core busy, the finished file waits in line instead
+        if not transcode_pool.try_acquire():
+            return None
+        try:
+            encoder = StreamingAudioEncoder(self.ffmpeg_path, output_path, plan.args)
+        except OSError as e:
+            transcode_pool.release()
+            logger.warning("Can't start streaming audio extraction: %s", e)
+            return None
+        self._encoders[os.path.abspath(filename)] = encoder
+        return encoder.progress_hook
+
+    def detach(self, filename, success):
+        """The download ended; a failed one stops its encoder"""
+        if not success:
+            encoder = self._encoders.pop(os.path.abspath(filename), None)
+            if encoder is not None:
+                encoder.abort()
+
+    def abort_all(self):
+        """Stop the encodes run() didn't pick up, giving their transcode pool slots back"""
+        while self._encoders:
+            _, encoder = self._encoders.popitem()
+            encoder.abort()
+
+    def run(self, information):
+        path = information['filepath']
+        encoder = self._encoders.pop(os.path.abspath(path), None)
+        if encoder is None:
+            return super().run(information)
+        if not encoder.finish():
+            # Not streamable: convert the finished file the usual way
+            self.report_warning(f'Streaming audio extraction failed ({encoder.error}); converting the file instead')
+            return super().run(information)
+        audio_outputs.inc(action=TRANSCODE)
+        self.to_screen(f'Destination: {encoder.output_path}')
+        information['filepath'] = encoder.output_path
+        information['ext'] = os.path.splitext(encoder.output_path)[1][1:]
+        # The downloaded original is deleted like FFmpegExtractAudio does
+        return [path], information
@@ -0,0 +1,205 @@
+"""On-disk cache of resized video thumbnails
+
+st.image(url) has the browser fetch the full-size thumbnail (often a
+1280x720 JPEG) from the video host on every rerun, which also rules out
+thumbnails in batch lists with hundreds of entries. ThumbnailCache fetches
+each thumbnail once, stores it as WebP in every size of WIDTHS and serves it
+from disk; files are evicted least-recently-used first once the cache
+exceeds its byte budget.
+"""
+import base64
+import hashlib
+import io
+import logging
+import os
+import threading
+import urllib.error
+import urllib.request
+import uuid
+
+from PIL import Image
+
+from . import config, metrics, ratelimit
+
+logger = logging.getLogger(__name__)
+
+# Stored widths in pixels: list views and the video info panel
+WIDTHS = (160, 320)
+WEBP_QUALITY = 80
+FETCH_TIMEOUT = 15
+# Thumbnails larger than this aren't images we want to decode
+MAX_SOURCE_BYTES = 10 * 1024 * 1024
+# Fetches of URLs whose hashes share a stripe wait for each other
+FETCH_LOCK_STRIPES = 64
+
+
+def _fit(width):
+    """Return the smallest stored width that is at least width (the largest one otherwise)"""
+    return next((stored for stored in WIDTHS if stored >= width), WIDTHS[-1])
+
+
+class ThumbnailCache:
+    """Size-bounded LRU cache of resized thumbnails, fetched once per URL"""
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        # One fetch at a time per thumbnail URL, from a fixed set of locks so it doesn't grow with the URLs seen
+        self._fetch_locks = [threading.Lock() for _ in range(FETCH_LOCK_STRIPES)]
+        # Bytes on disk, counted on first use
+        self._bytes = None
+
+    @staticmethod
+    def _digest(url):
+        return hashlib.sha256(url.encode()).hexdigest()
+
+    def _path(self, url, width):
+        return os.path.join(self.root, f'{self._digest(url)[:32]}-{width}.webp')
+
+    def _fetch_lock(self, url):
+        return self._fetch_locks[int(self._digest(url)[:8], 16) % len(self._fetch_locks)]
+
+    def get(self, url, width=320, fetch=True, priority=ratelimit.INTERACTIVE):
+        """Return the path of the thumbnail resized to about width, or None
+
+        A thumbnail that isn't cached yet is fetched (as a request of the
+        given ratelimit priority) and resized, unless fetch is False. None
+        means the caller has to fall back to the remote URL.
+        """
+        if not url or not self.max_bytes:
+            return None
+        path = self._path(url, _fit(width))
+        if self._touch(path):
+            return path
+        if not fetch:
+            return None
+        with self._fetch_lock(url):
+            # Another session may have fetched it while we waited
+            if self._touch(path, count=False):
+                return path
+            with self._lock:
+                self.misses += 1
+            try:
+                self._store(url, self._fetch(url, priority))
+            except Exception as e:
+                logger.warning("Caching thumbnail %s failed: %s", url, e)
+                return None
+        return path if os.path.isfile(path) else None
+
+    def data_url(self, url, width=160, fetch=True):
+        """Return the thumbnail as a data: URL (for table image columns), or None"""
+        path = self.get(url, width, fetch)
+        if path is None:
+            return None
+        try:
+            with open(path, 'rb') as f:
+                return 'data:image/webp;base64,' + base64.b64encode(f.read()).decode()
+        except OSError:
+            return None
+
+    def _touch(self, path, count=True):
+        """Mark a cached file as used for LRU eviction; False if it isn't cached"""
+        try:
+            os.utime(path)
+        except OSError:
+            return False
+        if count:
+            with self._lock:
+                self.hits += 1
+        return True
+
+    @staticmethod
+    def _fetch(url, priority):
+        """Download a thumbnail through the host scheduler"""
+        ratelimit.scheduler.acquire(url, priority)
+        request = urllib.request.Request(url, headers={'User-Agent': 'Mozilla/5.0'})
+        try:
+            with urllib.request.urlopen(request, timeout=FETCH_TIMEOUT) as response:
+                data = response.read(MAX_SOURCE_BYTES + 1)
+        except urllib.error.HTTPError as e:
+            if e.code in ratelimit.THROTTLE_STATUSES:
+                ratelimit.scheduler.backoff(url, str(e.code))
+            raise
+        if len(data) > MAX_SOURCE_BYTES:
+            raise ValueError("thumbnail is too large")
+        ratelimit.scheduler.success(url)
+        return data
+
+    def _store(self, url, data):
+        """Write every stored width of an image, then evict down to the budget"""
+        os.makedirs(self.root, exist_ok=True)
+        image = Image.open(io.BytesIO(data))
+        # JPEG decoding can scale down by powers of two on the fly
+        image.draft('RGB', (WIDTHS[-1], WIDTHS[-1]))
+        image = image.convert('RGB')
+        written = 0
+        for width in WIDTHS:
+            resized = image
+            if image.width > width:
+                resized = image.resize((width, max(1, round(image.height * width / image.width))),
+                                       Image.LANCZOS, reducing_gap=2.0)
+            path = self._path(url, width)
+            tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+            resized.save(tmp_path, 'WEBP', quality=WEBP_QUALITY, method=4)
+            written += os.path.getsize(tmp_path)
+            os.replace(tmp_path, path)
+        with self._lock:
+            if self._bytes is not None:
+                self._bytes += written
+        self.evict()
+
+    def _files(self):
+        """Return (last used, size, path) for every cached file"""
+        files = []
+        try:
+            entries = list(os.scandir(self.root))
+        except OSError:
+            return files
+        for entry in entries:
+            if not entry.name.endswith('.webp'):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+        return files
+
+    def evict(self):
+        """Delete least-recently-used thumbnails until the cache fits its byte budget"""
+        with self._lock:
+            if self._bytes is not None and self._bytes <= self.max_bytes:
+                return
+            files = sorted(self._files())
+            total = sum(size for _, size, _ in files)
+            for _, size, path in files:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+                self.evictions += 1
+            self._bytes = total
+
+    def stats(self):
+        """Return hit/miss counters and current size"""
+        files = self._files()
+        with self._lock:
+            return {
+                'entries': len(files),
+                'bytes': sum(size for _, size, _ in files),
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+thumbnail_cache = ThumbnailCache(config.THUMBNAIL_DIR, config.THUMBNAIL_CACHE_MB * 1024 * 1024)
+metrics.register_cache('thumbnail', thumbnail_cache)
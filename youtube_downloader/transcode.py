@@ -0,0 +1,207 @@
+"""Planning and running the FFmpeg work of audio downloads
+
+Audio downloads used to be re-encoded to MP3 whatever the source was, each
+encode keeping a CPU core busy for the length of the track, with no limit on
+how many ran at once. The requested output format (one of AUDIO_FORMATS) is
+now planned against the source's codec: a source already in that codec is
+kept as it is or stream-copied into the right container, and only other
+sources are re-encoded. Format selection prefers sources that can be copied.
+
+The postprocessors carrying out the plans are in streaming, which is the
+module that needs yt-dlp. Encodes run on one process-wide TranscodePool: at most FFMPEG_CORES
+single-threaded FFmpeg processes at a time, at a lowered CPU priority, and
+the rest wait in line. Stream copies only move bytes, so they don't take a
+slot.
+"""
+import contextlib
+import logging
+import os
+import subprocess
+import threading
+import time
+from collections import namedtuple
+
+from . import config, ffmpeg, metrics
+from .formats import AUDIO_CODEC_FAMILIES, codec_family
+
+logger = logging.getLogger(__name__)
+
+# Output formats of audio downloads; 'best' keeps the source's codec
+AUDIO_FORMATS = ('mp3', 'm4a', 'opus', 'best')
+DEFAULT_AUDIO_FORMAT = 'mp3'
+DEFAULT_AUDIO_QUALITY = '192'  # kbps of re-encoded audio
+
+# Codec family each output format holds
+TARGET_CODECS = {'mp3': 'mp3', 'm4a': 'aac', 'opus': 'opus'}
+# File extension and FFmpeg muxer for audio of each codec family
+CONTAINERS = {
+    'aac': ('m4a', 'ipod'),
+    'opus': ('opus', 'opus'),
+    'vorbis': ('ogg', 'ogg'),
+    'mp3': ('mp3', 'mp3'),
+    'flac': ('flac', 'flac'),
+}
+# Encoders per codec family, most preferred first, with the options they need
+ENCODERS = {
+    'mp3': (('libmp3lame', []),),
+    'aac': (('aac', []),),
+    'opus': (('libopus', []), ('opus', ['-strict', '-2'])),
+}
+
+# Plan actions: leave the file alone, copy the stream into another container, or re-encode it
+KEEP = 'keep'
+REMUX = 'remux'
+TRANSCODE = 'transcode'
+
+PROBE_TIMEOUT = 30
+
+# What to do with a downloaded audio file: the action, the output extension and FFmpeg's output options
+Plan = namedtuple('Plan', ['action', 'ext', 'args'])
+
+audio_outputs = metrics.Counter('ytdl_audio_outputs_total', 'Audio downloads by how they were turned into the output',
+                                ['action'])
+ffmpeg_seconds = metrics.Histogram('ytdl_ffmpeg_seconds', 'Duration of FFmpeg runs on finished downloads', ['action'])
+ffmpeg_queue_wait_seconds = metrics.Histogram('ytdl_ffmpeg_queue_wait_seconds',
+                                              'Time encodes waited for a free FFmpeg slot')
+
+
+def audio_selector(audio_format):
+    """Return the yt-dlp format selector for an audio download, preferring sources that needn't be re-encoded"""
+    target = TARGET_CODECS.get(audio_format)
+    if target is None:
+        return 'bestaudio/best'
+    prefixes = [prefix for prefix, family in AUDIO_CODEC_FAMILIES if family == target]
+    preferred = '/'.join(f'bestaudio[acodec^={prefix}]' for prefix in prefixes)
+    return f'{preferred}/bestaudio/best'
+
+
+def _encoder_args(family, quality):
+    """Return FFmpeg's options for encoding to a codec family with the best encoder this FFmpeg has"""
+    available = ffmpeg.get_probe().encoders
+    candidates = ENCODERS[family]
+    name, extra = next(((name, extra) for name, extra in candidates if name in available), candidates[0])
+    # One core per encode, which is what the pool budgets for
+    return ['-c:a', name, *extra, '-b:a', f'{quality}k', '-threads', '1']
+
+
+def plan_audio(acodec, ext, audio_format=DEFAULT_AUDIO_FORMAT, quality=DEFAULT_AUDIO_QUALITY):
+    """Return the Plan that turns audio of codec acodec in an ext file into audio_format
+
+    Sources already in the target codec are kept, or remuxed when they sit
+    in another container; an unknown codec is re-encoded.
+    """
+    family = codec_family(acodec, AUDIO_CODEC_FAMILIES)
+    target = TARGET_CODECS.get(audio_format)
+    if target is None:
+        # 'best': keep codecs with a plain audio container, encode the rest to MP3
+        target = family if family in CONTAINERS else 'mp3'
+    target_ext, muxer = CONTAINERS[target]
+    if family == target:
+        if ext == target_ext:
+            return Plan(KEEP, ext, [])
+        return Plan(REMUX, target_ext, ['-c:a', 'copy', '-f', muxer])
+    return Plan(TRANSCODE, target_ext, [*_encoder_args(target, quality), '-f', muxer])
+
+
+def probe_codec(path):
+    """Return the codec name of a file's first audio stream according to ffprobe, or None"""
+    ffprobe_path = ffmpeg.get_probe().ffprobe_path
+    if not ffprobe_path:
+        return None
+    try:
+        output = subprocess.run(
+            [ffprobe_path, '-v', 'error', '-select_streams', 'a:0', '-show_entries', 'stream=codec_name',
+             '-of', 'csv=p=0', path],
+            capture_output=True, text=True, timeout=PROBE_TIMEOUT, check=True,
+        ).stdout
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return output.strip() or None
+
+
+class TranscodePool:
+    """A budget of CPU cores for FFmpeg encodes, shared by every download of the process
+
+    cores is the number of encodes running at once; niceness is added to
+    the CPU priority of every FFmpeg process started through the pool (0
+    keeps the app's priority).
+    """
+
+    def __init__(self, cores, niceness):
+        self.cores = max(1, cores)
+        self.niceness = niceness
+        self._running = 0
+        self._queued = 0
+        self._cond = threading.Condition()
+
+    def try_acquire(self):
+        """Take a slot if one is free right now (nobody waiting either); return True if taken"""
+        with self._cond:
+            if self._running < self.cores and not self._queued:
+                self._running += 1
+                return True
+            return False
+
+    def acquire(self):
+        """Wait for a free slot, in line behind earlier encodes"""
+        started = time.monotonic()
+        with self._cond:
+            self._queued += 1
+            try:
+                while self._running >= self.cores:
+                    self._cond.wait()
+            finally:
+                self._queued -= 1
+            self._running += 1
+        ffmpeg_queue_wait_seconds.observe(time.monotonic() - started)
+
+    def release(self):
+        with self._cond:
+            self._running -= 1
+            self._cond.notify()
+
+    @contextlib.contextmanager
+    def slot(self):
+        """Hold a slot for the duration of the block"""
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def popen(self, args, **kwargs):
+        """Start an FFmpeg process at the pool's lowered priority"""
+        if self.niceness and os.name == 'nt':
+            kwargs.setdefault('creationflags', subprocess.BELOW_NORMAL_PRIORITY_CLASS)
+        process = subprocess.Popen(args, **kwargs)
+        if self.niceness and hasattr(os, 'setpriority'):
+            try:
+                niceness = min(19, os.getpriority(os.PRIO_PROCESS, 0) + self.niceness)
+                os.setpriority(os.PRIO_PROCESS, process.pid, niceness)
+            except OSError:
+                pass
+        return process
+
+    def run(self, args, action=TRANSCODE):
+        """Run an FFmpeg command to completion (in a slot when it encodes)
+
+        Raises subprocess.CalledProcessError with FFmpeg's stderr when it fails.
+        """
+        with self.slot() if action == TRANSCODE else contextlib.nullcontext():
+            started = time.monotonic()
+            process = self.popen(args, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            _, stderr = process.communicate()
+            ffmpeg_seconds.observe(time.monotonic() - started, action=action)
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, args, stderr=stderr.decode(errors='replace'))
+
+    def stats(self):
+        """Return the number of encodes running and waiting for a slot"""
+        with self._cond:
+            return {'cores': self.cores, 'running': self._running, 'queued': self._queued}
+
+
+transcode_pool = TranscodePool(config.FFMPEG_CORES, config.FFMPEG_NICE)
+metrics.Gauge('ytdl_ffmpeg_encodes', 'FFmpeg encodes running or waiting for a slot', ['state'], collect=lambda: {
+    (state,): transcode_pool.stats()[state] for state in ('queued', 'running')
+})
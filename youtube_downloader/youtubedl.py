@@ -0,0 +1,176 @@
+"""YoutubeDL instances: scheduled requests and a pool of warm instances
+
+Every info extraction used to build a fresh YoutubeDL, which loads its
+extractors and request handlers, and to throw it away afterwards with its
+open connections, cookies and the player JS and signature functions its
+YouTube extractor had parsed. Extractions now borrow an idle instance built
+with the same options from the YoutubeDLPool, whose keep-alive connections
+(yt-dlp pools them when the requests package is installed) and parsed
+player code carry over to the next request. Instances are retired after
+YDL_POOL_MAX_AGE seconds. yt-dlp also caches player and signature data on
+disk in YTDLP_CACHE_DIR, so it survives restarts too.
+
+This is the module that loads yt-dlp. The rest of the package imports it
+(and parallel and streaming, which build on it) only when it first needs
+yt-dlp, so the app starts without paying for the import; info_cache.warm_up()
+does that in the background, along with compiling the URL patterns of every
+extractor, which yt-dlp otherwise does during a process's first extraction.
+"""
+import contextlib
+import itertools
+import json
+import threading
+import time
+from collections import OrderedDict
+
+import yt_dlp
+from yt_dlp.networking.exceptions import HTTPError
+
+from . import config, metrics
+from .ratelimit import NORMAL, RETRY_STATUSES, THROTTLE_STATUSES, parse_retry_after, scheduler
+
+# Option profiles the pool keeps instances for; the least recently used one is dropped first
+MAX_PROFILES = 32
+
+build_seconds = metrics.Histogram('ytdl_youtubedl_build_seconds', 'Time spent building YoutubeDL instances')
+
+
+def compile_url_patterns():
+    """Compile the URL pattern of every extractor (once per process; later calls return quickly)"""
+    from yt_dlp.extractor import gen_extractor_classes
+
+    for ie in gen_extractor_classes():
+        ie.suitable('')
+
+
+class ScheduledYoutubeDL(yt_dlp.YoutubeDL):
+    """YoutubeDL whose requests go through the host scheduler
+
+    The 'request_priority' param sets the priority of its requests (NORMAL
+    by default); it can also be a function returning the priority, which
+    is asked before every request, for jobs whose priority changes.
+    Requests answered with 429 or 503 are sent again after the host's
+    backoff, up to 'throttle_retries' times (THROTTLE_RETRIES by default),
+    on top of yt-dlp's own retries.
+    """
+
+    def urlopen(self, req):
+        url = req if isinstance(req, str) else getattr(req, 'url', None) or req.get_full_url()
+        retries = self.params.get('throttle_retries', config.THROTTLE_RETRIES)
+        # Requests with a body may not be safe to send twice
+        idempotent = getattr(req, 'data', None) is None
+        for attempt in itertools.count():
+            priority = self.params.get('request_priority', NORMAL)
+            scheduler.acquire(url, priority() if callable(priority) else priority)
+            try:
+                response = super().urlopen(req)
+            except HTTPError as e:
+                if e.status in THROTTLE_STATUSES:
+                    scheduler.backoff(url, str(e.status), parse_retry_after(e.response.headers.get('Retry-After')))
+                    if e.status in RETRY_STATUSES and idempotent and attempt < retries:
+                        e.response.close()
+                        continue
+                raise
+            scheduler.success(url)
+            return response
+
+
+class YoutubeDLPool:
+    """Idle ScheduledYoutubeDL instances per option profile, lent out one caller at a time
+
+    max_idle instances are kept per profile; an instance older than max_age
+    seconds is closed instead of lent out again.
+    """
+
+    def __init__(self, max_idle, max_age):
+        self.max_idle = max_idle
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        # Profile -> idle (created, instance) pairs, most recently returned last
+        self._idle = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _profile(opts):
+        return json.dumps(opts, sort_keys=True, default=repr)
+
+    def _take(self, profile):
+        """Return an idle (created, instance) pair of a profile, or None"""
+        now = time.monotonic()
+        stale = []
+        taken = None
+        with self._lock:
+            idle = self._idle.get(profile, [])
+            while idle and taken is None:
+                created, ydl = idle.pop()
+                if now - created > self.max_age:
+                    stale.append(ydl)
+                else:
+                    taken = created, ydl
+            if taken:
+                self.hits += 1
+            else:
+                self.misses += 1
+        for ydl in stale:
+            ydl.close()
+        return taken
+
+    def _give_back(self, profile, created, ydl):
+        closed = []
+        with self._lock:
+            idle = self._idle.setdefault(profile, [])
+            self._idle.move_to_end(profile)
+            if len(idle) < self.max_idle:
+                idle.append((created, ydl))
+            else:
+                closed.append(ydl)
+            while len(self._idle) > MAX_PROFILES:
+                _, dropped = self._idle.popitem(last=False)
+                closed.extend(instance for _, instance in dropped)
+        for instance in closed:
+            instance.close()
+
+    def _build(self, opts):
+        started = time.monotonic()
+        # YoutubeDL fills its defaults into the dict it is given, which would change the caller's profile
+        ydl = ScheduledYoutubeDL(dict(opts))
+        build_seconds.observe(time.monotonic() - started)
+        return time.monotonic(), ydl
+
+    @contextlib.contextmanager
+    def get(self, opts):
+        """Lend out an instance built with opts for the duration of the block
+
+        Instances that raised are closed rather than lent out again.
+        """
+        profile = self._profile(opts)
+        created, ydl = self._take(profile) or self._build(opts)
+        try:
+            yield ydl
+        except BaseException:
+            ydl.close()
+            raise
+        self._give_back(profile, created, ydl)
+
+    def warm(self, opts):
+        """Build an instance for opts now, unless one is idle, so the next get() finds it ready"""
+        profile = self._profile(opts)
+        with self._lock:
+            if self._idle.get(profile):
+                return
+        self._give_back(profile, *self._build(opts))
+
+    def stats(self):
+        """Return reuse counters and the number of idle instances"""
+        with self._lock:
+            return {
+                'entries': sum(len(idle) for idle in self._idle.values()),
+                'profiles': len(self._idle),
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+ydl_pool = YoutubeDLPool(config.YDL_POOL_SIZE, config.YDL_POOL_MAX_AGE)
+metrics.register_cache('youtubedl', ydl_pool)
@@ -1,10 +1,18 @@
 import streamlit as st
-import yt_dlp
-import os
-import tempfile
-import shutil
-import glob
-from pathlib import Path
+import time
+import uuid
+
+from youtube_downloader import config, ffmpeg, metrics
+from youtube_downloader.batch import parse_sources, run_batch
+from youtube_downloader.download import clip_section, request_key, resume_interrupted, run_download
+from youtube_downloader.info_cache import video_metadata, warm_up
+from youtube_downloader.jobs import (
+    CANCELLED, DONE, FAILED, QUEUED, RUNNING, QueueFull, TooManyJobs, job_manager,
+)
+from youtube_downloader.prefetch import prefetcher
+from youtube_downloader.progress import format_timings
+from youtube_downloader.ratelimit import INTERACTIVE
+from youtube_downloader.thumbnails import thumbnail_cache
 
 st.set_page_config(
     page_title="YouTube Downloader",
@@ -15,41 +23,23 @@ st.set_page_config(
 st.title("📥 YouTube Downloader")
 st.markdown("Download videos or audio from YouTube")
 
-# Check for ffmpeg availability
-def check_ffmpeg():
-    """Check if ffmpeg is available in the system PATH"""
-    ffmpeg_path = shutil.which('ffmpeg')
-    if ffmpeg_path:
-        return True
-    
-    # Also check common installation paths (for Windows)
-    import platform
-    if platform.system() == 'Windows':
-        # Check common fixed paths
-        common_paths = [
-            r'C:\ffmpeg\bin\ffmpeg.exe',
-            r'C:\Program Files\ffmpeg\bin\ffmpeg.exe',
-            r'C:\Program Files (x86)\ffmpeg\bin\ffmpeg.exe',
-        ]
-        for path in common_paths:
-            if os.path.exists(path):
-                return True
-        
-        # Check for any ffmpeg* directory in C:\ and Program Files
-        search_patterns = [
-            r'C:\ffmpeg*\bin\ffmpeg.exe',
-            r'C:\ffmpeg*\ffmpeg.exe',
-            r'C:\Program Files\ffmpeg*\bin\ffmpeg.exe',
-            r'C:\Program Files (x86)\ffmpeg*\bin\ffmpeg.exe',
-        ]
-        for pattern in search_patterns:
-            for path in glob.glob(pattern):
-                if os.path.exists(path):
-                    return True
-    
-    return False
+# Check for ffmpeg availability (probed once per process, not on every rerun)
+ffmpeg_probe = ffmpeg.get_probe()
+has_ffmpeg = ffmpeg_probe.available
+
+# Identify this browser across reruns and refreshes (used for per-user job limits)
+if 'client_id' not in st.session_state:
+    st.session_state['client_id'] = st.query_params.get('client') or uuid.uuid4().hex
+client_id = st.session_state['client_id']
+if st.query_params.get('client') != client_id:
+    st.query_params['client'] = client_id
 
-has_ffmpeg = check_ffmpeg()
+# Re-queue downloads that were running when the app last stopped (only does work on the first run)
+resume_interrupted()
+# Load yt-dlp and get an instance ready for "Get Video Info" while the page renders (once per process)
+warm_up()
+# Serve Prometheus metrics on a local port (started once per process)
+metrics.ensure_server()
 
 # Sidebar for settings
 with st.sidebar:
@@ -67,16 +57,81 @@ with st.sidebar:
             ["Best", "1080p", "720p", "480p", "360p", "Worst"],
             index=0
         )
+        
+        # Size-aware quality: step down from the chosen quality until the download fits
+        with st.expander("📦 Size Limit"):
+            max_size_mb = st.number_input(
+                "Maximum file size (MB, 0 = no limit):",
+                min_value=0,
+                max_value=config.MAX_DOWNLOAD_MB or None,
+                value=config.MAX_DOWNLOAD_MB,
+                step=50,
+                help="Downloads the highest quality whose estimated size fits",
+            )
+            target_seconds = st.number_input(
+                "Target download time (seconds, 0 = no limit):",
+                min_value=0,
+                max_value=config.TARGET_DOWNLOAD_SECONDS or None,
+                value=config.TARGET_DOWNLOAD_SECONDS,
+                step=30,
+                help="Downloads the highest quality that finishes in time at the speed measured on earlier downloads",
+            )
+            if config.MAX_DOWNLOAD_MB or config.TARGET_DOWNLOAD_SECONDS:
+                st.caption("The server sets the highest limits allowed")
+    else:
+        max_size_mb = target_seconds = 0
+        # Sources already in the chosen codec are only copied into the file, the others are re-encoded
+        audio_format_labels = {
+            "M4A (AAC)": 'm4a',
+            "MP3": 'mp3',
+            "Opus": 'opus',
+            "Original (no conversion)": 'best',
+        }
+        audio_format = audio_format_labels[st.selectbox(
+            "Audio format:",
+            list(audio_format_labels),
+            index=0,
+            help="M4A is available for nearly every video without re-encoding, so it is ready fastest. "
+                 "MP3 plays everywhere but usually has to be re-encoded",
+            disabled=not has_ffmpeg,
+        )]
+    
+    # Download only part of the video (fetches just the fragments or byte ranges it needs)
+    with st.expander("✂️ Clip"):
+        clip_start = st.text_input("Start time:", placeholder="e.g. 1:30", disabled=not has_ffmpeg,
+                                   help="Seconds or [HH:]MM:SS; leave empty to start at the beginning")
+        clip_end = st.text_input("End time:", placeholder="e.g. 2:00", disabled=not has_ffmpeg,
+                                 help="Seconds or [HH:]MM:SS; leave empty to go to the end")
+        precise_cuts = st.checkbox("Precise cuts", disabled=not has_ffmpeg,
+                                   help="Re-encode around the cuts so the clip starts and ends exactly at these "
+                                        "times (slower). Otherwise the cuts snap to the nearest keyframes")
+        if not has_ffmpeg:
+            st.caption("🔧 Clips need FFmpeg")
+    
+    # Library names for the selected format and quality
+    download_mode = 'audio' if download_format == "Audio only" else 'video'
+    download_quality = video_quality.lower() if download_mode == 'video' else None
+    if download_mode == 'video':
+        # (only audio downloads are converted)
+        audio_format = 'mp3'
     
     st.markdown("---")
     
     # Network settings
     with st.expander("🌐 Network Settings (Advanced)"):
-        retry_count = st.slider("Retry attempts on failure:", min_value=3, max_value=20, value=10, help="Number of times to retry if download fails")
+        retry_count = st.slider("Retry attempts on failure:", min_value=3, max_value=20, value=10, help="Number of times to retry if download fails. Requests a server refuses with 'Too Many Requests' are also retried after backing off")
         timeout_seconds = st.slider("Connection timeout (seconds):", min_value=30, max_value=300, value=60, help="How long to wait for server response")
+        connection_options = ["Auto", 1, 2, 4, 8, 16]
+        connections = st.select_slider(
+            "Parallel connections:",
+            options=connection_options,
+            value=config.DOWNLOAD_CONNECTIONS if config.DOWNLOAD_CONNECTIONS in connection_options else "Auto",
+            help="Connections used per stream. Auto adds connections while they still speed up the download",
+        )
         st.caption("Adjust these if you experience timeout errors or have slow internet")
         st.session_state['retry_count'] = retry_count
         st.session_state['timeout_seconds'] = timeout_seconds
+        st.session_state['connections'] = 0 if connections == "Auto" else connections
     
     st.markdown("---")
     st.markdown("### ℹ️ About")
@@ -84,7 +139,9 @@ with st.sidebar:
     # Show ffmpeg status
     if has_ffmpeg:
         st.success("✅ FFmpeg is installed")
-        st.caption("MP3 conversion available")
+        st.caption(f"MP3, M4A and Opus conversion available (FFmpeg {ffmpeg_probe.ffmpeg_version})")
+        if ffmpeg_probe.hardware_encoders:
+            st.caption(f"Hardware encoders: {', '.join(ffmpeg_probe.hardware_encoders)}")
     else:
         st.error("⚠️ FFmpeg not found - REQUIRED for most videos!")
         st.caption("Modern YouTube videos need FFmpeg to merge video and audio streams")
@@ -146,50 +203,31 @@ with st.sidebar:
         
         # Add a button to help diagnose
         if st.button("🔍 Check FFmpeg Installation", use_container_width=True, key="check_ffmpeg_btn"):
-            import platform
-            import subprocess
             st.write("**System Information:**")
-            st.write(f"- OS: {platform.system()}")
-            st.write(f"- Python: {platform.python_version()}")
+            st.write(f"- OS: {ffmpeg_probe.os}")
+            st.write(f"- Python: {ffmpeg_probe.python}")
             
-            # Try to find ffmpeg
-            ffmpeg_path = shutil.which('ffmpeg')
-            if ffmpeg_path:
-                st.success(f"✅ Found FFmpeg at: {ffmpeg_path}")
-                try:
-                    result = subprocess.run(['ffmpeg', '-version'], capture_output=True, text=True, timeout=5)
-                    st.code(result.stdout.split('\n')[0])
-                except:
+            if ffmpeg_probe.ffmpeg_path and ffmpeg_probe.in_path:
+                st.success(f"✅ Found FFmpeg at: {ffmpeg_probe.ffmpeg_path}")
+                if ffmpeg_probe.error:
+                    st.warning("FFmpeg found but couldn't execute - may need PATH update")
+            elif ffmpeg_probe.ffmpeg_path:
+                # Found by the Windows install-location scan
+                st.error("❌ FFmpeg not found in PATH")
+                st.warning("⚠️ FFmpeg found but not in PATH:")
+                st.write(f"  - {ffmpeg_probe.ffmpeg_path}")
+                if ffmpeg_probe.error:
                     st.warning("FFmpeg found but couldn't execute - may need PATH update")
+                st.info("Add FFmpeg to your PATH or restart the app - it should auto-detect now.")
             else:
                 st.error("❌ FFmpeg not found in PATH")
-                # Also check common paths
-                if platform.system() == 'Windows':
-                    found_paths = []
-                    search_patterns = [
-                        r'C:\ffmpeg*\bin\ffmpeg.exe',
-                        r'C:\ffmpeg*\ffmpeg.exe',
-                        r'C:\Program Files\ffmpeg*\bin\ffmpeg.exe',
-                        r'C:\Program Files (x86)\ffmpeg*\bin\ffmpeg.exe',
-                    ]
-                    for pattern in search_patterns:
-                        for path in glob.glob(pattern):
-                            if os.path.exists(path):
-                                found_paths.append(path)
-                    
-                    if found_paths:
-                        st.warning(f"⚠️ FFmpeg found but not in PATH:")
-                        for path in found_paths:
-                            st.write(f"  - {path}")
-                        st.info("Add FFmpeg to your PATH or restart the app - it should auto-detect now.")
-                    else:
-                        st.info("""
-                        **Troubleshooting:**
-                        1. Install FFmpeg using the instructions below
-                        2. Add FFmpeg to your system PATH
-                        3. Restart your terminal/IDE
-                        4. Restart the Streamlit app (Ctrl+C and run again)
-                        """)
+                st.info("""
+                **Troubleshooting:**
+                1. Install FFmpeg using the instructions below
+                2. Add FFmpeg to your system PATH
+                3. Restart your terminal/IDE
+                4. Click "🔄 Re-scan for FFmpeg" or restart the Streamlit app
+                """)
         
         with st.expander("📥 CRITICAL: Install FFmpeg (Required)"):
             st.markdown("""
@@ -233,18 +271,244 @@ with st.sidebar:
             ### After Installation:
             1. Close and restart your terminal/command prompt
             2. Verify: Run `ffmpeg -version` in a new terminal
-            3. Restart this Streamlit app (stop with Ctrl+C, then run again)
+            3. Click "🔄 Re-scan for FFmpeg" in the sidebar, or restart this Streamlit app (stop with Ctrl+C, then run again)
             
             **Note:** If FFmpeg still isn't detected after installation, the PATH may not be updated. Try restarting your computer.
             
             **For Streamlit Cloud:** The Dockerfile in the repo will install FFmpeg automatically.
             """)
     
+    # FFmpeg is only probed once per process; look again after installing or upgrading it
+    if st.button("🔄 Re-scan for FFmpeg", use_container_width=True, key="rescan_ffmpeg_btn"):
+        ffmpeg.invalidate()
+        st.rerun()
+    
     st.info(
         "This app uses yt-dlp to download content from YouTube. "
         "Please respect copyright and YouTube's terms of service."
     )
 
+# Download job rendering (the download itself runs on a background worker)
+def current_job(state_key, query_key):
+    """Return this user's job remembered in session state or the page URL, if it still exists"""
+    job_id = st.session_state.get(state_key) or st.query_params.get(query_key)
+    job = job_manager.get(job_id) if job_id else None
+    if job is None or not job.has_waiter(client_id):
+        return None
+    st.session_state[state_key] = job.id
+    return job
+
+
+def show_job_progress(job, cancel_label, key):
+    """Render a job's messages and, while it is queued or running, its progress and a cancel button"""
+    for level, text in job.messages:
+        getattr(st, level)(text)
+    if job.status == QUEUED:
+        # Jobs queued on another replica have no position here
+        position = job_manager.position(job)
+        st.info(f"⏳ Waiting for a free download slot{f' (position {position} in queue)' if position else ''}...")
+    elif job.status == RUNNING:
+        progress = job.progress
+        if progress is None:
+            st.info("⬇️ Starting download...")
+        else:
+            fraction = progress.fraction
+            st.progress(fraction if fraction is not None else 0.0, text=f"⬇️ {progress.describe()}")
+    if job.active and st.button(cancel_label, use_container_width=True, key=key):
+        job_manager.cancel(job.id, client_id)
+        st.rerun()
+
+
+def show_download_result(job):
+    """Render a finished download: link button, file details and diagnostics"""
+    result = job.result
+    mode = job.kwargs['mode']
+    title = result['title']
+    duration = result['duration']
+    format_id = result['format_id']
+    format_ext = result['ext']
+    vcodec = result['vcodec']
+    acodec = result['acodec']
+    extension = result['extension']
+    
+    # Store format info for display
+    format_info_text = f"Format: {format_id}, Container: {format_ext}"
+    if vcodec != 'unknown' and vcodec != 'none':
+        format_info_text += f", Video: {vcodec.split('.')[0]}"
+    if acodec != 'unknown' and acodec != 'none':
+        format_info_text += f", Audio: {acodec.split('.')[0]}"
+    
+    # Provide download button
+    if mode == 'audio':
+        format_label = f"Audio ({extension.upper()})"
+        if has_ffmpeg and extension == 'mp3':
+            format_label = "Audio (MP3)"
+    else:
+        format_label = "Video (MP4)"
+    
+    st.success("✅ Download complete!")
+    if result['cached']:
+        st.caption("⚡ Served from download cache")
+    st.link_button(
+        label=f"⬇️ Download {format_label}",
+        url=result['download_url'],
+        use_container_width=True
+    )
+    st.caption(f"🔗 Download link expires in {config.DELIVERY_TTL // 60} minutes")
+    
+    # Display video info
+    file_size_mb = result['file_size'] / (1024 * 1024)
+    st.info(f"📹 **Title:** {title}\n⏱️ **Duration:** {duration // 60}:{duration % 60:02d}\n📦 **File Size:** {file_size_mb:.2f} MB")
+    if format_info_text:
+        st.caption(f"ℹ️ {format_info_text}")
+    if result.get('timings'):
+        st.caption(f"⏱️ {format_timings(result['timings'])}")
+    
+    # Detailed validation and diagnostics
+    if mode == 'video':
+        if vcodec != 'none' and acodec != 'none':
+            st.success(f"✅ File structure verified: Video ({vcodec.split('.')[0] if vcodec != 'unknown' else 'N/A'}) + Audio ({acodec.split('.')[0] if acodec != 'unknown' else 'N/A'})")
+            
+            # Check file size against the size estimated from the selected formats
+            expected_size = result.get('estimated_size')
+            if expected_size and result['file_size'] < expected_size * 0.5:  # Less than 50% of expected
+                st.warning("⚠️ File size seems unusually small - download may be incomplete or corrupted")
+        else:
+            st.error("❌ CRITICAL: File is missing video or audio track!")
+            st.warning("🔧 **FFmpeg is REQUIRED** - this video needs stream merging")
+        
+        # Troubleshooting info
+        with st.expander("🔧 Troubleshooting: File won't play?"):
+            st.markdown("""
+            **If the downloaded file won't play:**
+            1. **Try VLC Media Player** - it supports the widest range of codecs
+            2. **Check file extension** - Make sure it's `.mp4`
+            3. **File may be corrupted** - Try downloading again
+            4. **Install FFmpeg** - Most modern videos require FFmpeg to merge streams properly
+            
+            **Recommended solution:** Install FFmpeg for guaranteed playable downloads
+            """)
+
+
+def show_batch_result(job):
+    """Render a finished batch: ZIP link and a table with a link per item"""
+    items = job.result['items']
+    finished = [item for item in items if item['status'] == DONE]
+    failed = len(items) - len(finished)
+    if not items:
+        st.warning("⚠️ No videos found in the given URLs")
+        return
+    st.success(f"✅ {len(finished)} of {len(items)} videos downloaded" + (f" ({failed} failed)" if failed else ""))
+    if job.result['zip_url']:
+        st.link_button("⬇️ Download all (ZIP)", url=job.result['zip_url'], use_container_width=True)
+    st.dataframe(
+        [
+            {
+                # Cached by the batch job; never fetched while rendering
+                "Thumbnail": thumbnail_cache.data_url(item.get('thumbnail'), fetch=False),
+                "Title": item.get('title') or item['url'],
+                "Status": "✅" if item['status'] == DONE else f"❌ {item.get('error') or item['status']}",
+                "Size (MB)": round(item['file_size'] / (1024 * 1024), 2) if item.get('file_size') else None,
+                "Link": item.get('download_url'),
+            }
+            for item in items
+        ],
+        column_config={
+            "Thumbnail": st.column_config.ImageColumn("", width="small"),
+            "Link": st.column_config.LinkColumn("Link", display_text="⬇️ Download"),
+        },
+        use_container_width=True,
+        hide_index=True,
+    )
+    st.caption(f"🔗 Download links expire in {config.DELIVERY_TTL // 60} minutes")
+
+
+def show_download_error(job):
+    """Render a failed download with advice for the most common causes"""
+    error_msg = job.error
+    
+    if job.error_kind == 'no_mp4':
+        st.error("❌ No complete MP4 format available for this video.")
+        st.info("This video doesn't have a complete MP4 format. Try a different video or install FFmpeg to merge streams.")
+        return
+    if job.error_kind == 'ffmpeg_required':
+        st.error("❌ This video only has separate video and audio streams.")
+        st.warning("🔧 **FFmpeg is REQUIRED** to merge them into a playable file.")
+        st.info("""
+        **Please install FFmpeg:**
+        - Windows: `winget install ffmpeg` or download from ffmpeg.org
+        - macOS: `brew install ffmpeg`
+        - Linux: `sudo apt install ffmpeg`
+        
+        Then restart the app and try again.
+        """)
+        return
+    if job.error_kind == 'section_ffmpeg':
+        st.error("❌ Downloading a clip needs FFmpeg.")
+        st.info("Install FFmpeg to cut clips, or clear the start and end times to download the whole video.")
+        return
+    if job.error_kind == 'multiple_files':
+        st.error("❌ Multiple files downloaded - video and audio are separate!")
+        st.warning("🔧 **FFmpeg is REQUIRED** to merge them into a playable file.")
+        st.info("""
+        **Please install FFmpeg and try again.**
+        - Windows: `winget install ffmpeg`
+        - macOS: `brew install ffmpeg`
+        - Linux: `sudo apt install ffmpeg`
+        """)
+        return
+    if job.error_kind in ('too_small', 'not_found'):
+        st.error(f"❌ {error_msg}")
+        return
+    
+    st.error(f"❌ Error downloading: {error_msg}")
+    
+    # Provide helpful error messages for common issues
+    category = metrics.classify_error(error_msg)
+    if category == 'timeout':
+        st.warning("⏱️ **Network Timeout Error**")
+        st.info("""
+        **The download timed out.** This can happen if:
+        - Your internet connection is slow
+        - YouTube servers are busy
+        - The video file is very large
+        
+        **Solutions:**
+        1. Try downloading again - network issues are often temporary
+        2. Increase timeout in Network Settings (sidebar)
+        3. Increase retry count in Network Settings
+        4. Try downloading at a lower quality (720p or 480p)
+        5. Check your internet connection
+        """)
+    elif category == 'ffmpeg':
+        st.warning("🔧 **FFmpeg error**")
+        st.info("""
+        FFmpeg is required for this video. Please install it:
+        - Windows: `winget install ffmpeg`
+        - macOS: `brew install ffmpeg`
+        - Linux: `sudo apt install ffmpeg`
+        """)
+    elif category == 'format':
+        st.warning("⚠️ **No complete MP4 format available**")
+        st.info("""
+        This video doesn't have a complete MP4 format available.
+        Try a different video or install FFmpeg to merge video and audio streams.
+        """)
+    elif category == 'network':
+        st.warning("🌐 **Network/Connection Error**")
+        st.info("""
+        **Connection problem detected.**
+        
+        **Try:**
+        1. Check your internet connection
+        2. Try again in a few moments
+        3. Increase retry count in Network Settings (sidebar)
+        4. Verify the YouTube URL is correct and accessible
+        """)
+    else:
+        st.info("💡 Tip: Make sure the URL is valid and the video is accessible. If problems persist, try adjusting Network Settings in the sidebar.")
+
+
 # Main content area
 url = st.text_input(
     "Enter YouTube URL:",
@@ -252,6 +516,34 @@ url = st.text_input(
     help="Paste the YouTube video URL here"
 )
 
+
+
+def download_request(url):
+    """Return the run_download arguments for a URL with the sidebar settings (ValueError for bad clip times)"""
+    section = clip_section(clip_start, clip_end, precise_cuts) if has_ffmpeg else None
+    return dict(
+        url=url,
+        mode=download_mode,
+        quality=download_quality,
+        has_ffmpeg=has_ffmpeg,
+        retry_count=st.session_state.get('retry_count', 10),
+        timeout_seconds=st.session_state.get('timeout_seconds', 60),
+        connections=st.session_state.get('connections'),
+        max_size_mb=max_size_mb,
+        target_seconds=target_seconds,
+        start_time=section.start if section else None,
+        end_time=section.end if section else None,
+        precise_cuts=section.precise if section else False,
+        audio_format=audio_format,
+    )
+
+
+# A download started speculatively by "Get Video Info" is dropped once the URL or settings change
+try:
+    prefetcher.keep(client_id, request_key(download_request(url)) if url else None)
+except ValueError:
+    prefetcher.discard(client_id)
+
 col1, col2 = st.columns([1, 1])
 
 with col1:
@@ -259,20 +551,27 @@ with col1:
         if url:
             try:
                 with st.spinner("Fetching video information..."):
-                    ydl_opts = {'quiet': True, 'no_warnings': True}
-                    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                        info = ydl.extract_info(url, download=False)
-                        
-                        st.success("✅ Video information retrieved!")
-                        st.json({
-                            "Title": info.get('title', 'N/A'),
-                            "Duration": f"{info.get('duration', 0) // 60}:{info.get('duration', 0) % 60:02d}",
-                            "Uploader": info.get('uploader', 'N/A'),
-                            "View Count": info.get('view_count', 0),
-                            "Upload Date": info.get('upload_date', 'N/A'),
-                        })
-                        
-                        st.session_state['video_info'] = info
+                    # Known videos come from the metadata store; otherwise the extraction is cached
+                    # per video ID, so the Download button can reuse it. Someone is waiting on it,
+                    # so it goes ahead of queued downloads to the same host
+                    info = video_metadata(url, {'request_priority': INTERACTIVE})
+                    duration = int(info.get('duration') or 0)
+                    
+                    st.success("✅ Video information retrieved!")
+                    st.json({
+                        "Title": info.get('title') or 'N/A',
+                        "Duration": f"{duration // 60}:{duration % 60:02d}",
+                        "Uploader": info.get('uploader') or 'N/A',
+                        "View Count": info.get('view_count') or 0,
+                        "Upload Date": info.get('upload_date') or 'N/A',
+                    })
+                    
+                    st.session_state['video_info'] = info
+                # Start the download the current settings would make while the user reads the info
+                try:
+                    prefetcher.start(client_id, download_request(url))
+                except ValueError:
+                    pass
             except Exception as e:
                 st.error(f"❌ Error: {str(e)}")
         else:
@@ -282,345 +581,109 @@ with col2:
     if st.button("📥 Download", type="primary", use_container_width=True):
         if url:
             try:
-                with st.spinner("Downloading..."):
-                    # Create temporary directory for downloads
-                    with tempfile.TemporaryDirectory() as tmpdir:
-                        # Get retry and timeout settings from session state or use defaults
-                        retry_count = st.session_state.get('retry_count', 10)
-                        timeout_seconds = st.session_state.get('timeout_seconds', 60)
-                        
-                        # Configure yt-dlp options with timeout and retry settings
-                        ydl_opts = {
-                            'outtmpl': os.path.join(tmpdir, '%(title)s.%(ext)s'),
-                            'quiet': False,
-                            # Network timeout settings
-                            'socket_timeout': timeout_seconds,  # Socket timeout in seconds
-                            'retries': retry_count,  # Number of retries for downloads
-                            'fragment_retries': retry_count,  # Retries for fragments
-                            'file_access_retries': 3,  # Retries for file access
-                            # Download settings
-                            'external_downloader_args': {
-                                'default': [f'--timeout={timeout_seconds}', f'--retries={retry_count}']
-                            },
-                            # Progress hooks
-                            'noprogress': False,
-                        }
-                        
-                        if download_format == "Audio only":
-                            # Download best audio format available
-                            if has_ffmpeg:
-                                # With FFmpeg, we can convert to MP3
-                                ydl_opts.update({
-                                    'format': 'bestaudio/best',
-                                    'postprocessors': [{
-                                        'key': 'FFmpegExtractAudio',
-                                        'preferredcodec': 'mp3',
-                                        'preferredquality': '192',
-                                    }],
-                                })
-                            else:
-                                # Without FFmpeg, download in native format
-                                ydl_opts.update({
-                                    'format': 'bestaudio[ext=m4a]/bestaudio[ext=webm]/bestaudio/best',
-                                })
-                        else:
-                            # Video download options
-                            if not has_ffmpeg:
-                                # First, inspect available formats and find ones with both video and audio
-                                ydl_check = yt_dlp.YoutubeDL({'quiet': True, 'no_warnings': True})
-                                with ydl_check:
-                                    try:
-                                        format_info = ydl_check.extract_info(url, download=False)
-                                        formats = format_info.get('formats', [])
-                                        
-                                        # Find formats that have BOTH video and audio codecs (complete files)
-                                        # Use format_note to identify progressive/complete streams
-                                        complete_formats = []
-                                        for fmt in formats:
-                                            vcodec = fmt.get('vcodec', 'none')
-                                            acodec = fmt.get('acodec', 'none')
-                                            format_note = fmt.get('format_note', '').lower()
-                                            protocol = fmt.get('protocol', '').lower()
-                                            # Must have both video AND audio (not "none")
-                                            # Prefer progressive formats or formats that are explicitly complete
-                                            # Avoid DASH/manifest formats which are adaptive
-                                            if (vcodec and vcodec != 'none' and 
-                                                acodec and acodec != 'none' and
-                                                'dash' not in protocol and
-                                                'manifest' not in protocol):
-                                                complete_formats.append(fmt)
-                                        
-                                        if complete_formats:
-                                            # Filter to ONLY MP4 formats (most compatible)
-                                            # Also prefer H.264 video codec for maximum compatibility
-                                            mp4_formats = [f for f in complete_formats if f.get('ext', '').lower() == 'mp4']
-                                            
-                                            if not mp4_formats:
-                                                st.error("❌ No complete MP4 format available for this video.")
-                                                st.info("This video doesn't have a complete MP4 format. Try a different video or install FFmpeg to merge streams.")
-                                                st.stop()
-                                            
-                                            # Sort: prefer H.264 video codec (best compatibility), then by resolution
-                                            mp4_formats.sort(key=lambda x: (
-                                                'avc' not in x.get('vcodec', '').lower() and 'h264' not in x.get('vcodec', '').lower(),  # H.264 first
-                                                -x.get('height', 0) if x.get('height') else 0,  # Higher resolution first
-                                            ))
-                                            
-                                            # Filter by quality if specified
-                                            if video_quality not in ["Best", "Worst"]:
-                                                target_height = int(video_quality.replace('p', ''))
-                                                matching = [f for f in mp4_formats 
-                                                          if f.get('height') and int(str(f.get('height')).replace('p', '')) <= target_height]
-                                                if matching:
-                                                    mp4_formats = matching
-                                            
-                                            if video_quality == "Worst":
-                                                mp4_formats.reverse()
-                                            
-                                            # Use the best matching format
-                                            selected = mp4_formats[0]
-                                            ydl_opts['format'] = selected['format_id']
-                                            
-                                            # Show selected format details for debugging
-                                            st.info(f"📋 Selected format: {selected.get('format_id')} | "
-                                                  f"Resolution: {selected.get('resolution', 'N/A')} | "
-                                                  f"Video: {selected.get('vcodec', 'N/A')[:10]} | "
-                                                  f"Audio: {selected.get('acodec', 'N/A')[:10]}")
-                                        else:
-                                            # No complete formats available - this video needs FFmpeg
-                                            st.error("❌ This video only has separate video and audio streams.")
-                                            st.warning("🔧 **FFmpeg is REQUIRED** to merge them into a playable file.")
-                                            st.info("""
-                                            **Please install FFmpeg:**
-                                            - Windows: `winget install ffmpeg` or download from ffmpeg.org
-                                            - macOS: `brew install ffmpeg`
-                                            - Linux: `sudo apt install ffmpeg`
-                                            
-                                            Then restart the app and try again.
-                                            """)
-                                            st.stop()
-                                    except Exception as e:
-                                        st.error(f"❌ Error checking formats: {str(e)}")
-                                        st.info("Trying MP4-only format selection...")
-                                        # Only MP4 formats with both video and audio (strict format selector)
-                                        # This format selector requires both vcodec and acodec to be present
-                                        quality_map = {
-                                            "Best": "best[ext=mp4][vcodec*=avc][acodec*=mp4a]/best[ext=mp4][vcodec][acodec]",
-                                            "1080p": "best[height<=1080][ext=mp4][vcodec*=avc][acodec*=mp4a]/best[height<=1080][ext=mp4][vcodec][acodec]",
-                                            "720p": "best[height<=720][ext=mp4][vcodec*=avc][acodec*=mp4a]/best[height<=720][ext=mp4][vcodec][acodec]",
-                                            "480p": "best[height<=480][ext=mp4][vcodec*=avc][acodec*=mp4a]/best[height<=480][ext=mp4][vcodec][acodec]",
-                                            "360p": "best[height<=360][ext=mp4][vcodec*=avc][acodec*=mp4a]/best[height<=360][ext=mp4][vcodec][acodec]",
-                                            "Worst": "worst[ext=mp4][vcodec][acodec]",
-                                        }
-                                        ydl_opts['format'] = quality_map.get(video_quality, "best[ext=mp4][vcodec][acodec]")
-                                
-                                ydl_opts['prefer_free_formats'] = False
-                            else:
-                                # With ffmpeg, we can merge best video + best audio
-                                quality_map = {
-                                    "Best": "bestvideo+bestaudio/best",
-                                    "1080p": "bestvideo[height<=1080]+bestaudio/best[height<=1080]",
-                                    "720p": "bestvideo[height<=720]+bestaudio/best[height<=720]",
-                                    "480p": "bestvideo[height<=480]+bestaudio/best[height<=480]",
-                                    "360p": "bestvideo[height<=360]+bestaudio/best[height<=360]",
-                                    "Worst": "worstvideo+worstaudio/worst",
-                                }
-                                ydl_opts['format'] = quality_map.get(video_quality, "bestvideo+bestaudio/best")
-                                ydl_opts['merge_output_format'] = 'mp4'
-                        
-                        # Download
-                        format_info_text = ""
-                        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                            info = ydl.extract_info(url, download=True)
-                            title = info.get('title', 'video')
-                            duration = info.get('duration', 0)
-                            
-                            # Get the format that was actually used
-                            format_id = info.get('format_id', 'unknown')
-                            format_ext = info.get('ext', 'unknown')
-                            vcodec = info.get('vcodec', 'unknown')
-                            acodec = info.get('acodec', 'unknown')
-                            
-                            # Store format info for display
-                            format_info_text = f"Format: {format_id}, Container: {format_ext}"
-                            if vcodec != 'unknown' and vcodec != 'none':
-                                format_info_text += f", Video: {vcodec.split('.')[0]}"
-                            if acodec != 'unknown' and acodec != 'none':
-                                format_info_text += f", Audio: {acodec.split('.')[0]}"
-                        
-                        # Find the downloaded file(s)
-                        downloaded_files = list(Path(tmpdir).glob('*'))
-                        
-                        # Filter out .part files (incomplete downloads)
-                        downloaded_files = [f for f in downloaded_files if not f.name.endswith('.part')]
-                        
-                        if downloaded_files:
-                            # Check if multiple files were downloaded (video + audio separate)
-                            if len(downloaded_files) > 1:
-                                st.error("❌ Multiple files downloaded - video and audio are separate!")
-                                st.warning("🔧 **FFmpeg is REQUIRED** to merge them into a playable file.")
-                                st.info("""
-                                **Please install FFmpeg and try again.**
-                                - Windows: `winget install ffmpeg`
-                                - macOS: `brew install ffmpeg`
-                                - Linux: `sudo apt install ffmpeg`
-                                """)
-                                st.stop()
-                            
-                            file_path = downloaded_files[0]
-                            
-                            # Validate file has both video and audio (if it's a video download)
-                            if download_format == "Video (MP4)":
-                                # Check if file is likely incomplete
-                                file_size = file_path.stat().st_size
-                                if file_size < 1024:  # Less than 1KB - probably broken
-                                    st.error("❌ Downloaded file is too small - download may have failed")
-                                    st.stop()
-                            
-                            # Read file
-                            with open(file_path, 'rb') as f:
-                                file_data = f.read()
-                            
-                            # Determine MIME type and extension from actual file
-                            file_ext = file_path.suffix.lower()
-                            if download_format == "Audio only":
-                                # Determine MIME type based on actual file extension
-                                audio_mime_map = {
-                                    '.mp3': 'audio/mpeg',
-                                    '.m4a': 'audio/mp4',
-                                    '.webm': 'audio/webm',
-                                    '.opus': 'audio/ogg',
-                                    '.ogg': 'audio/ogg',
-                                }
-                                mime_type = audio_mime_map.get(file_ext, 'audio/mpeg')
-                                extension = file_ext.lstrip('.') or 'mp3'
-                            else:
-                                # Video MIME type mapping
-                                video_mime_map = {
-                                    '.mp4': 'video/mp4',
-                                    '.webm': 'video/webm',
-                                    '.mkv': 'video/x-matroska',
-                                    '.flv': 'video/x-flv',
-                                }
-                                mime_type = video_mime_map.get(file_ext, 'video/mp4')
-                                extension = file_ext.lstrip('.') or 'mp4'
-                            
-                            # Provide download button
-                            if download_format == "Audio only":
-                                format_label = f"Audio ({extension.upper()})"
-                                if has_ffmpeg and extension == 'mp3':
-                                    format_label = "Audio (MP3)"
-                            else:
-                                format_label = "Video (MP4)"
-                            
-                            st.success("✅ Download complete!")
-                            st.download_button(
-                                label=f"⬇️ Download {format_label}",
-                                data=file_data,
-                                file_name=f"{title[:50]}.{extension}",
-                                mime=mime_type,
-                                use_container_width=True
-                            )
-                            
-                            # Display video info
-                            file_size_mb = len(file_data) / (1024 * 1024)
-                            st.info(f"📹 **Title:** {title}\n⏱️ **Duration:** {duration // 60}:{duration % 60:02d}\n📦 **File Size:** {file_size_mb:.2f} MB")
-                            if format_info_text:
-                                st.caption(f"ℹ️ {format_info_text}")
-                            
-                            # Detailed validation and diagnostics
-                            if download_format == "Video (MP4)":
-                                if vcodec != 'none' and acodec != 'none':
-                                    st.success(f"✅ File structure verified: Video ({vcodec.split('.')[0] if vcodec != 'unknown' else 'N/A'}) + Audio ({acodec.split('.')[0] if acodec != 'unknown' else 'N/A'})")
-                                    
-                                    # Check file size reasonableness
-                                    expected_size_mb_per_min = 10  # Rough estimate
-                                    expected_size = (duration / 60) * expected_size_mb_per_min
-                                    if file_size_mb < expected_size * 0.5:  # Less than 50% of expected
-                                        st.warning("⚠️ File size seems unusually small - download may be incomplete or corrupted")
-                                else:
-                                    st.error("❌ CRITICAL: File is missing video or audio track!")
-                                    st.warning("🔧 **FFmpeg is REQUIRED** - this video needs stream merging")
-                                
-                                # Troubleshooting info
-                                with st.expander("🔧 Troubleshooting: File won't play?"):
-                                    st.markdown("""
-                                    **If the downloaded file won't play:**
-                                    1. **Try VLC Media Player** - it supports the widest range of codecs
-                                    2. **Check file extension** - Make sure it's `.mp4`
-                                    3. **File may be corrupted** - Try downloading again
-                                    4. **Install FFmpeg** - Most modern videos require FFmpeg to merge streams properly
-                                    
-                                    **Recommended solution:** Install FFmpeg for guaranteed playable downloads
-                                    """)
-                            
-                            # Warning if we got multiple files
-                            if len(downloaded_files) > 1 and not has_ffmpeg:
-                                st.error("❌ Multiple files detected - video and audio are separate!")
-                                st.warning("🔧 **FFmpeg is REQUIRED** to merge them into one playable file.")
-                        else:
-                            st.error("❌ File not found after download")
-                            
-            except Exception as e:
-                error_msg = str(e)
-                st.error(f"❌ Error downloading: {error_msg}")
-                
-                # Provide helpful error messages for common issues
-                if "timeout" in error_msg.lower() or "timed out" in error_msg.lower():
-                    st.warning("⏱️ **Network Timeout Error**")
-                    st.info("""
-                    **The download timed out.** This can happen if:
-                    - Your internet connection is slow
-                    - YouTube servers are busy
-                    - The video file is very large
-                    
-                    **Solutions:**
-                    1. Try downloading again - network issues are often temporary
-                    2. Increase timeout in Network Settings (sidebar)
-                    3. Increase retry count in Network Settings
-                    4. Try downloading at a lower quality (720p or 480p)
-                    5. Check your internet connection
-                    """)
-                elif "ffmpeg" in error_msg.lower() or "ffprobe" in error_msg.lower():
-                    st.warning("🔧 **FFmpeg error**")
-                    st.info("""
-                    FFmpeg is required for this video. Please install it:
-                    - Windows: `winget install ffmpeg`
-                    - macOS: `brew install ffmpeg`
-                    - Linux: `sudo apt install ffmpeg`
-                    """)
-                elif "format" in error_msg.lower() or "no video" in error_msg.lower() or "mp4" in error_msg.lower():
-                    st.warning("⚠️ **No complete MP4 format available**")
-                    st.info("""
-                    This video doesn't have a complete MP4 format available.
-                    Try a different video or install FFmpeg to merge video and audio streams.
-                    """)
-                elif "connection" in error_msg.lower() or "network" in error_msg.lower() or "httperror" in error_msg.lower():
-                    st.warning("🌐 **Network/Connection Error**")
-                    st.info("""
-                    **Connection problem detected.**
-                    
-                    **Try:**
-                    1. Check your internet connection
-                    2. Try again in a few moments
-                    3. Increase retry count in Network Settings (sidebar)
-                    4. Verify the YouTube URL is correct and accessible
-                    """)
-                else:
-                    st.info("💡 Tip: Make sure the URL is valid and the video is accessible. If problems persist, try adjusting Network Settings in the sidebar.")
+                request = download_request(url)
+                key = request_key(request)
+                # Hand the download to the background workers; the page polls the job below.
+                # An identical download already in progress (including this session's prefetch) is joined
+                # instead of started again.
+                job = job_manager.submit(client_id, run_download, key=key, **request)
+                st.session_state['download_job'] = job.id
+                st.query_params['job'] = job.id
+                if prefetcher.claim(client_id, key):
+                    st.caption("⚡ Started downloading when you fetched the video info")
+                elif job.owner != client_id:
+                    st.caption("👥 Someone is already downloading this video - joined their download")
+            except ValueError as e:
+                st.warning(f"⚠️ {e}")
+            except TooManyJobs as e:
+                st.warning(f"⚠️ {e}. Please wait for them to finish.")
+            except QueueFull:
+                st.warning("⏳ The server is busy right now. Please try again in a minute.")
         else:
             st.warning("⚠️ Please enter a YouTube URL")
+    
+    # Show the current download job (survives reruns and, through the URL, page refreshes)
+    download_job = current_job('download_job', 'job')
+    if download_job:
+        show_job_progress(download_job, "✖️ Cancel download", key="cancel_download_btn")
+        if download_job.status == DONE:
+            show_download_result(download_job)
+        elif download_job.status == FAILED:
+            show_download_error(download_job)
+        elif download_job.status == CANCELLED:
+            st.warning("✖️ Download cancelled")
+
+# Batch / playlist downloads
+with st.expander("📚 Batch & Playlist Download"):
+    batch_text = st.text_area(
+        "Playlist, channel or video URLs (one per line):",
+        placeholder="https://www.youtube.com/playlist?list=...",
+        help="Playlists and channels are expanded into their videos"
+    )
+    batch_file = st.file_uploader("...or upload a text file with one URL per line", type=["txt", "csv"])
+    batch_concurrency = st.slider(
+        "Parallel downloads:",
+        min_value=1,
+        max_value=config.BATCH_MAX_CONCURRENCY,
+        value=min(config.BATCH_CONCURRENCY, config.BATCH_MAX_CONCURRENCY),
+        help="How many videos of the batch are downloaded at the same time"
+    )
+    batch_zip = st.checkbox("Bundle all files into one ZIP", value=False)
+    st.caption(f"Uses the format and quality selected in the sidebar. Up to {config.BATCH_MAX_ITEMS} videos per batch.")
+    
+    if st.button("📥 Download All", type="primary", use_container_width=True):
+        sources = parse_sources(batch_text)
+        if batch_file is not None:
+            sources += parse_sources(batch_file.getvalue().decode('utf-8', errors='replace'))
+        if sources:
+            try:
+                job = job_manager.submit(
+                    client_id,
+                    run_batch,
+                    sources=sources,
+                    mode=download_mode,
+                    quality=download_quality,
+                    has_ffmpeg=has_ffmpeg,
+                    retry_count=st.session_state.get('retry_count', 10),
+                    timeout_seconds=st.session_state.get('timeout_seconds', 60),
+                    connections=st.session_state.get('connections'),
+                    max_size_mb=max_size_mb,
+                    target_seconds=target_seconds,
+                    audio_format=audio_format,
+                    concurrency=batch_concurrency,
+                    make_zip=batch_zip,
+                )
+                st.session_state['batch_job'] = job.id
+                st.query_params['batch'] = job.id
+            except TooManyJobs as e:
+                st.warning(f"⚠️ {e}. Please wait for them to finish.")
+            except QueueFull:
+                st.warning("⏳ The server is busy right now. Please try again in a minute.")
+        else:
+            st.warning("⚠️ Please enter or upload at least one URL")
+    
+    batch_job = current_job('batch_job', 'batch')
+    if batch_job:
+        show_job_progress(batch_job, "✖️ Cancel batch", key="cancel_batch_btn")
+        if batch_job.status == DONE:
+            show_batch_result(batch_job)
+        elif batch_job.status == FAILED:
+            st.error(f"❌ Error expanding batch: {batch_job.error}")
+        elif batch_job.status == CANCELLED:
+            st.warning("✖️ Batch cancelled")
 
 # Display session state info if available
 if 'video_info' in st.session_state:
     with st.expander("📋 Last Retrieved Video Information"):
         info = st.session_state['video_info']
-        st.write(f"**Title:** {info.get('title', 'N/A')}")
-        st.write(f"**Channel:** {info.get('uploader', 'N/A')}")
-        st.write(f"**Duration:** {info.get('duration', 0) // 60}:{info.get('duration', 0) % 60:02d}")
-        st.write(f"**Views:** {info.get('view_count', 0):,}")
+        duration = int(info.get('duration') or 0)
+        st.write(f"**Title:** {info.get('title') or 'N/A'}")
+        st.write(f"**Channel:** {info.get('uploader') or 'N/A'}")
+        st.write(f"**Duration:** {duration // 60}:{duration % 60:02d}")
+        st.write(f"**Views:** {info.get('view_count') or 0:,}")
         if info.get('thumbnail'):
-            st.image(info.get('thumbnail'))
+            # Served from the local thumbnail cache instead of the video host on every rerun
+            st.image(thumbnail_cache.get(info['thumbnail'], 320) or info['thumbnail'])
 
 # Footer
 st.markdown("---")
@@ -630,3 +693,8 @@ st.markdown(
     "</div>",
     unsafe_allow_html=True
 )
+
+# Poll background jobs: rerun the page until they finish
+if any(job and job.active for job in (download_job, batch_job)):
+    time.sleep(1)
+    st.rerun()